@@ -1,23 +1,68 @@
+import asyncio
+import base64
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
 from requests.auth import AuthBase
 import requests
 
+from gen3.utils import atomic_write, file_lock
+
+# Number of seconds before an access token's expiration at which a new one
+# is requested in the background
+DEFAULT_REFRESH_SKEW = 60
+
 
 class Gen3AuthError(Exception):
     pass
 
 
+def decode_token(token_str):
+    """Returns the claims of a JWT as a dict.
+
+    The signature is NOT verified, this is only used to inspect claims such as
+    ``exp`` on tokens that fence issued to us.
+
+    Args:
+        token_str (str): The encoded JWT.
+
+    """
+    payload = token_str.split(".")[1]
+    # base64 padding is stripped from JWT segments
+    payload += "=" * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload.encode("utf-8")))
+
+
 class Gen3Auth(AuthBase):
     """Gen3 auth helper class for use with requests auth.
 
     Implements requests.auth.AuthBase in order to support JWT authentication.
     Generates access tokens from the provided refresh token file or string.
-    Automatically refreshes access tokens when they expire.
+    Automatically refreshes access tokens when they expire. When the access
+    token carries an ``exp`` claim, a new token is requested in the background
+    once the current one is within ``refresh_skew`` seconds of expiring, so
+    requests don't have to fail with a 401 and be resent.
+
+    Refreshes are single-flight: when many threads or coroutines need a new
+    access token at the same time, only one request is sent to fence and the
+    others wait for its result. See ``refresh_stats`` for counters.
+
+    With ``token_cache_dir`` set, access tokens are also shared through files
+    in that directory, keyed by commons and API key id. Sibling processes on
+    the same node then reuse a still valid token instead of each requesting
+    their own.
 
     Args:
         endpoint (str): The URL of the data commons.
         refresh_file (str): The file containing the downloaded json web token.
         refresh_token (str): The json web token.
+        refresh_skew (int): Seconds before expiration at which the access token
+            is proactively refreshed.
+        token_cache_dir (str): Optional directory for the cross-process access
+            token cache. Disabled by default.
 
     Examples:
         This generates the Gen3Auth class pointed at the sandbox commons while
@@ -27,7 +72,14 @@ class Gen3Auth(AuthBase):
 
     """
 
-    def __init__(self, endpoint, refresh_file=None, refresh_token=None):
+    def __init__(
+        self,
+        endpoint,
+        refresh_file=None,
+        refresh_token=None,
+        refresh_skew=DEFAULT_REFRESH_SKEW,
+        token_cache_dir=None,
+    ):
         if not refresh_file and not refresh_token:
             raise ValueError(
                 "Either parameter 'refresh_file' or parameter 'refresh_token' must be specified."
@@ -53,8 +105,39 @@ class Gen3Auth(AuthBase):
                 )
 
         self._access_token = None
+        self._access_token_exp = None
+        self._refresh_skew = refresh_skew
+        self._refresh_thread = None
+        self._refresh_lock = threading.Lock()
+        self._async_refresh = None
+        self._stats_lock = threading.Lock()
+        self._refresh_stats = {"issued": 0, "coalesced": 0, "cached": 0, "failed": 0}
         self._endpoint = endpoint
 
+        self._token_cache_path = None
+        if token_cache_dir:
+            os.makedirs(token_cache_dir, mode=0o700, exist_ok=True)
+            self._token_cache_path = os.path.join(
+                token_cache_dir,
+                _token_cache_key(endpoint, self._refresh_token) + ".json",
+            )
+
+    @property
+    def refresh_stats(self):
+        """dict: Counters of access token refreshes.
+
+        ``issued`` is the number of requests actually sent to fence,
+        ``coalesced`` the number of refreshes that were satisfied by another
+        in-flight refresh, ``cached`` the number of refreshes served from the
+        token cache and ``failed`` the number of failed requests.
+        """
+        with self._stats_lock:
+            return dict(self._refresh_stats)
+
+    def _count_refresh(self, stat):
+        with self._stats_lock:
+            self._refresh_stats[stat] += 1
+
     def __call__(self, request):
         """Adds authorization header to the request
 
@@ -90,8 +173,12 @@ class Gen3Auth(AuthBase):
         # copy the request to resend
         newreq = response.request.copy()
 
-        self._access_token = None
-        newreq.headers["Authorization"] = self._get_auth_value()
+        # only refresh if no other thread already replaced the rejected token
+        rejected_token = _token_from_auth_value(
+            response.request.headers.get("Authorization")
+        )
+        self._refresh_access_token(stale_token=rejected_token)
+        newreq.headers["Authorization"] = "Bearer " + self._access_token
 
         _response = response.connection.send(newreq, **kwargs)
         _response.history.append(response)
@@ -103,18 +190,226 @@ class Gen3Auth(AuthBase):
         """Returns the Authorization header value for the request
 
         This gets called when added the Authorization header to the request.
-        This fetches the access token from the refresh token if the access token is missing.
+        This fetches the access token from the refresh token if the access token
+        is missing or expired, and starts a background refresh if it is about
+        to expire.
 
         """
-        if not self._access_token:
-            auth_url = "{}/user/credentials/cdis/access_token".format(self._endpoint)
-            try:
-                self._access_token = requests.post(
-                    auth_url, json=self._refresh_token
-                ).json()["access_token"]
-            except Exception as e:
-                raise Gen3AuthError(
-                    "Failed to authenticate to {}\n{}".format(auth_url, str(e))
-                )
+        if self._access_token_expired():
+            self._refresh_access_token(stale_token=self._access_token)
+        elif self._access_token_expires_soon():
+            self._start_background_refresh()
 
         return "Bearer " + self._access_token
+
+    async def async_get_auth_header(self):
+        """Returns the Authorization header for an asynchronous request
+
+        For use with clients that don't go through python.requests, like
+        aiohttp. A required refresh doesn't block the event loop.
+
+        Returns:
+            dict: the header to add to the request
+
+        """
+        return {"Authorization": await self._async_get_auth_value()}
+
+    async def async_handle_401(self, auth_header):
+        """Refreshes the access token after an asynchronous request got a 401
+
+        Args:
+            auth_header (dict): The header the rejected request was sent with
+
+        Returns:
+            dict: the header to resend the request with
+
+        """
+        rejected_token = _token_from_auth_value(auth_header.get("Authorization"))
+        await self._async_refresh_access_token(stale_token=rejected_token)
+        return {"Authorization": "Bearer " + self._access_token}
+
+    async def _async_get_auth_value(self):
+        """Returns the Authorization header value without blocking the event loop
+
+        Same as ``_get_auth_value`` but a required refresh runs in the loop's
+        default executor, and concurrent coroutines share the same refresh.
+
+        """
+        if self._access_token_expired():
+            await self._async_refresh_access_token(stale_token=self._access_token)
+        elif self._access_token_expires_soon():
+            self._start_background_refresh()
+
+        return "Bearer " + self._access_token
+
+    def _access_token_expired(self):
+        """Returns True if there is no usable access token
+        """
+        if not self._access_token:
+            return True
+        if self._access_token_exp is None:
+            # no known expiration, rely on the 401 handling
+            return False
+        return self._access_token_exp <= time.time()
+
+    def _access_token_expires_soon(self):
+        """Returns True if the access token expires within the refresh skew
+        """
+        if self._access_token_exp is None:
+            return False
+        return self._access_token_exp - self._refresh_skew <= time.time()
+
+    def _start_background_refresh(self):
+        """Refreshes the access token in a daemon thread, unless a background
+        refresh is already running.
+        """
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(
+            target=self._background_refresh, args=(self._access_token,), daemon=True
+        )
+        self._refresh_thread.start()
+
+    def _background_refresh(self, stale_token):
+        try:
+            self._refresh_access_token(stale_token=stale_token)
+        except Gen3AuthError as e:
+            # the current token is still valid, the next request will retry
+            logging.warning(f"background access token refresh failed: {e}")
+
+    def _refresh_access_token(self, stale_token=None):
+        """Replaces ``stale_token`` with a new access token from fence
+
+        Only one thread fetches at a time. Threads that were waiting while
+        another one replaced ``stale_token`` reuse the new token instead of
+        sending their own request.
+
+        Args:
+            stale_token (str): The access token the caller found unusable.
+
+        """
+        with self._refresh_lock:
+            if self._access_token != stale_token and not self._access_token_expired():
+                self._count_refresh("coalesced")
+                return
+
+            if not self._token_cache_path:
+                self._set_access_token(self._fetch_access_token())
+                return
+
+            # hold the file lock while fetching so sibling processes wait for
+            # this token instead of requesting their own
+            with file_lock(self._token_cache_path + ".lock"):
+                access_token = self._read_token_cache(stale_token)
+                if access_token:
+                    self._count_refresh("cached")
+                else:
+                    access_token = self._fetch_access_token()
+                    self._write_token_cache(access_token)
+            self._set_access_token(access_token)
+
+    async def _async_refresh_access_token(self, stale_token=None):
+        """Coroutine version of ``_refresh_access_token``
+
+        Coroutines of the same event loop await a single in-flight refresh,
+        which itself goes through the thread-level single-flight above.
+
+        Args:
+            stale_token (str): The access token the caller found unusable.
+
+        """
+        loop = asyncio.get_event_loop()
+        in_flight = self._async_refresh
+        if in_flight and in_flight[0] is loop and not in_flight[1].done():
+            self._count_refresh("coalesced")
+            await asyncio.shield(in_flight[1])
+            return
+
+        future = loop.run_in_executor(None, self._refresh_access_token, stale_token)
+        self._async_refresh = (loop, future)
+        await asyncio.shield(future)
+
+    def _fetch_access_token(self):
+        """Returns a new access token from fence using the refresh token
+        """
+        auth_url = "{}/user/credentials/cdis/access_token".format(self._endpoint)
+        self._count_refresh("issued")
+        try:
+            return requests.post(auth_url, json=self._refresh_token).json()[
+                "access_token"
+            ]
+        except Exception as e:
+            self._count_refresh("failed")
+            raise Gen3AuthError(
+                "Failed to authenticate to {}\n{}".format(auth_url, str(e))
+            )
+
+    def _set_access_token(self, access_token):
+        try:
+            exp = decode_token(access_token).get("exp")
+        except Exception:
+            logging.debug("could not decode access token, no proactive refresh")
+            exp = None
+
+        self._access_token_exp = exp
+        self._access_token = access_token
+
+    def _read_token_cache(self, stale_token):
+        """Returns the cached access token if it is usable, else None
+
+        A token is only reused if it isn't ``stale_token`` and stays valid for
+        longer than the refresh skew.
+
+        """
+        try:
+            with open(self._token_cache_path) as cache_file:
+                access_token = json.load(cache_file)["access_token"]
+            exp = decode_token(access_token).get("exp")
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(
+                f"ignoring unreadable token cache {self._token_cache_path}: {e}"
+            )
+            return None
+
+        if access_token == stale_token:
+            return None
+        if exp is None or exp - self._refresh_skew <= time.time():
+            return None
+        return access_token
+
+    def _write_token_cache(self, access_token):
+        try:
+            atomic_write(
+                self._token_cache_path, json.dumps({"access_token": access_token})
+            )
+        except Exception as e:
+            # the cache is only an optimization
+            logging.warning(
+                f"could not write token cache {self._token_cache_path}: {e}"
+            )
+
+
+def _token_cache_key(endpoint, refresh_token):
+    """Returns the token cache file name for a commons and API key
+
+    Uses the API key's id when available, so the key itself never ends up in
+    a file name.
+
+    """
+    key_id = None
+    if isinstance(refresh_token, dict):
+        key_id = refresh_token.get("key_id")
+    if not key_id:
+        key_id = json.dumps(refresh_token, sort_keys=True)
+    key = "{}|{}".format(endpoint.rstrip("/"), key_id)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _token_from_auth_value(auth_value):
+    """Returns the token of a "Bearer <token>" header value, or None
+    """
+    if not auth_value or not auth_value.startswith("Bearer "):
+        return None
+    return auth_value[len("Bearer ") :]
@@ -0,0 +1,246 @@
+"""
+Circuit breakers for the services of a commons.
+
+When a service is down, sending it every request of a bulk job only makes each
+one fail slowly after its retries and adds load to the outage. A
+CircuitBreaker counts the consecutive failures (5xx responses, timeouts,
+dropped connections) of one service. Past a threshold it opens and requests
+fail immediately with a CircuitOpenError. After a recovery timeout it becomes
+half-open and lets one probe request through: a success closes it again, a
+failure opens it for another recovery timeout.
+
+Gen3Transport keeps one breaker per service and host, telling the services
+apart by the path of the request url (see SERVICE_PATHS).
+
+Attributes:
+    DEFAULT_FAILURE_THRESHOLD (int): consecutive failures that open a circuit
+    DEFAULT_RECOVERY_TIMEOUT (float): seconds an open circuit waits before it
+        lets a probe through
+    SERVICE_PATHS (list): (url path prefix, service name) pairs, most specific
+        first
+"""
+import asyncio
+import logging
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+import requests
+
+from gen3.retry import _status
+
+DEFAULT_FAILURE_THRESHOLD = 10
+DEFAULT_RECOVERY_TIMEOUT = 30
+SERVICE_PATHS = [
+    ("/api/v0/submission/graphql", "peregrine"),
+    ("/api/v0/submission", "sheepdog"),
+    ("/index", "indexd"),
+    ("/user", "fence"),
+]
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_FAILURE_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a service whose circuit is open.
+
+    Attributes:
+        service (str): name of the service
+        retry_in (float): seconds until the circuit lets a request through again
+    """
+
+    def __init__(self, service, retry_in):
+        super().__init__(
+            f"{service} is unavailable, not sending requests for the next "
+            f"{retry_in:.1f} seconds"
+        )
+        self.service = service
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit breaker for one service, shared by
+    threads and coroutines.
+
+    ``call`` and ``async_call`` send a request through a function returning a
+    ``requests`` or ``aiohttp`` response and record its outcome; they raise a
+    CircuitOpenError without calling it while the circuit is open. Callers that
+    would rather wait than fail can sleep ``retry_in`` seconds and try again.
+
+    Args:
+        name (str): name of the service, used in errors and log messages
+        failure_threshold (int): consecutive failures that open the circuit;
+            None to never open it
+        recovery_timeout (float): seconds the circuit stays open before it lets
+            a probe through
+        probe_interval (float): seconds other callers are told to wait while a
+            probe is in flight
+
+    Examples:
+        Pausing a bulk job while indexd is down.
+
+        >>> while True:
+        ...     try:
+        ...         record = index.get_record(guid)
+        ...         break
+        ...     except CircuitOpenError as exc:
+        ...         time.sleep(exc.retry_in)
+
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        recovery_timeout=DEFAULT_RECOVERY_TIMEOUT,
+        probe_interval=1.0,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.probe_interval = probe_interval
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Check that a request may be sent
+
+        Raises:
+            CircuitOpenError: the circuit is open, or half-open with a probe
+                already in flight
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+
+            if self.state == OPEN:
+                retry_in = self._opened_at + self.recovery_timeout - time.monotonic()
+                if retry_in > 0:
+                    raise CircuitOpenError(self.name, retry_in)
+                logging.info(f"circuit for {self.name} half-open, sending a probe")
+                self.state = HALF_OPEN
+
+            if self._probing:
+                raise CircuitOpenError(self.name, self.probe_interval)
+            self._probing = True
+
+    def record_success(self):
+        """
+        Record that the service answered a request
+        """
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self.state != CLOSED:
+                logging.info(f"circuit for {self.name} closed, service recovered")
+                self.state = CLOSED
+
+    def record_failure(self):
+        """
+        Record a failed request, opening the circuit past the threshold
+        """
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED
+                and self.failure_threshold is not None
+                and self._failures >= self.failure_threshold
+            ):
+                logging.warning(
+                    f"circuit for {self.name} open after {self._failures} failures, "
+                    f"failing requests for {self.recovery_timeout} seconds"
+                )
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def call(self, send):
+        """
+        Send a request unless the circuit is open and record its outcome.
+
+        Args:
+            send (Callable[[], requests.Response]): sends the request
+
+        Returns:
+            requests.Response: the response
+        """
+        self.before_request()
+        try:
+            response = send()
+        except Exception as exc:
+            self._record(isinstance(exc, _FAILURE_ERRORS))
+            raise
+        except BaseException:
+            # cancelled or interrupted, the outcome is unknown
+            self._release_probe()
+            raise
+        self._record(_status(response) >= 500)
+        return response
+
+    async def async_call(self, send):
+        """
+        Asynchronous version of call.
+
+        Args:
+            send (Callable[[], Awaitable[aiohttp.ClientResponse]]): sends the
+                request
+
+        Returns:
+            aiohttp.ClientResponse: the response
+        """
+        self.before_request()
+        try:
+            response = await send()
+        except Exception as exc:
+            self._record(isinstance(exc, _FAILURE_ERRORS))
+            raise
+        except BaseException:
+            # cancelled or interrupted, the outcome is unknown
+            self._release_probe()
+            raise
+        self._record(_status(response) >= 500)
+        return response
+
+    def _release_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def _record(self, failed):
+        if failed:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+def service_name(url):
+    """
+    Name of the service a url belongs to, like "indexd at example.com", or the
+    host for urls that don't match SERVICE_PATHS.
+
+    Args:
+        url (str): request url
+
+    Returns:
+        str: service name
+    """
+    parts = urllib.parse.urlsplit(url)
+    for prefix, service in SERVICE_PATHS:
+        if parts.path == prefix or parts.path.startswith(prefix + "/"):
+            return f"{service} at {parts.netloc}"
+    return parts.netloc
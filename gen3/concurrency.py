@@ -0,0 +1,199 @@
+"""
+Adaptive concurrency control for asynchronous requests.
+
+A fixed ``asyncio.Semaphore`` is either too small for a healthy service or too
+large for a degraded one. The AdaptiveConcurrencyLimiter adjusts the number of
+concurrent requests with additive-increase / multiplicative-decrease (AIMD),
+like TCP congestion control: while requests succeed and latency stays close to
+the best observed, the limit grows by one per round of requests; on overload
+signals (429, 5xx, timeouts, dropped connections) or a rising p95 latency it is
+cut by a factor.
+
+Attributes:
+    DEFAULT_MIN_LIMIT (int): lowest concurrency the limiter goes down to
+    DEFAULT_MAX_LIMIT (int): highest concurrency the limiter goes up to
+    DEFAULT_WINDOW_SIZE (int): number of recent latencies the p95 is computed over
+"""
+import asyncio
+import collections
+import logging
+import time
+
+import aiohttp
+import requests
+
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 256
+DEFAULT_WINDOW_SIZE = 100
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limiter, usable in place of an ``asyncio.Semaphore``.
+
+    The outcome of each request is taken from the ``async with`` block: a
+    normal exit is a success whose latency is recorded, an exception that
+    signals overload shrinks the limit. Overload signals from requests that
+    were started before the last decrease are ignored, so one burst of errors
+    only halves the limit once.
+
+    Args:
+        initial_limit (int): starting number of concurrent requests
+        min_limit (int): lower bound of the limit
+        max_limit (int): upper bound of the limit
+        increase (int): amount the limit grows by after a healthy round
+        decrease_factor (float): factor the limit is multiplied by on overload
+        latency_tolerance (float): p95 latency, relative to the baseline, above
+            which the service is considered overloaded
+        window_size (int): number of recent latencies the p95 is computed over
+        name (str): name used in log messages
+
+    Examples:
+        >>> limiter = AdaptiveConcurrencyLimiter(initial_limit=24)
+        ... async with limiter:
+        ...     record = await index.async_get_record(guid)
+        ... logging.info(limiter.stats)
+
+    """
+
+    def __init__(
+        self,
+        initial_limit,
+        min_limit=DEFAULT_MIN_LIMIT,
+        max_limit=DEFAULT_MAX_LIMIT,
+        increase=1,
+        decrease_factor=0.5,
+        latency_tolerance=2.0,
+        window_size=DEFAULT_WINDOW_SIZE,
+        name="requests",
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self.name = name
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._latency_tolerance = latency_tolerance
+
+        self._condition = None
+        self._in_flight = 0
+        self._start_times = {}
+        self._latencies = collections.deque(maxlen=window_size)
+        self._baseline_latency = None
+        self._successes_since_change = 0
+        self._last_decrease = 0
+        self._stats = {"requests": 0, "overloads": 0, "increases": 0, "decreases": 0}
+
+    @property
+    def stats(self):
+        """
+        dict: current limit, requests in flight, p95 latency and counters of
+        requests, overloads and limit changes
+        """
+        stats = dict(self._stats)
+        stats["limit"] = self.limit
+        stats["in_flight"] = self._in_flight
+        stats["p95_latency"] = self._p95_latency()
+        return stats
+
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            while self._in_flight >= self.limit:
+                await self._condition.wait()
+            self._in_flight += 1
+        self._start_times[_current_task()] = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        started = self._start_times.pop(_current_task(), time.monotonic())
+        self._stats["requests"] += 1
+        if exc is None:
+            self._record_success(time.monotonic() - started)
+        elif is_overload_error(exc):
+            self._stats["overloads"] += 1
+            if started >= self._last_decrease:
+                self._decrease(f"overload: {exc!r}")
+
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify(max(1, self.limit - self._in_flight))
+
+    def _record_success(self, latency):
+        self._latencies.append(latency)
+        self._successes_since_change += 1
+        if self._successes_since_change < self.limit:
+            return
+
+        # a full round of requests completed at this limit
+        p95 = self._p95_latency()
+        if self._baseline_latency is None or p95 < self._baseline_latency:
+            self._baseline_latency = p95
+        else:
+            # let the baseline follow slow, lasting changes
+            self._baseline_latency = 0.9 * self._baseline_latency + 0.1 * p95
+
+        if p95 > self._baseline_latency * self._latency_tolerance:
+            self._decrease(f"p95 latency {p95:.3f}s")
+        else:
+            self._set_limit(self.limit + self._increase, "healthy")
+
+    def _decrease(self, reason):
+        self._last_decrease = time.monotonic()
+        self._set_limit(int(self.limit * self._decrease_factor), reason)
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        self._successes_since_change = 0
+        if limit == self.limit:
+            return
+
+        self._stats["increases" if limit > self.limit else "decreases"] += 1
+        logging.info(
+            f"{self.name} concurrency limit {self.limit} -> {limit} ({reason})"
+        )
+        self.limit = limit
+
+    def _p95_latency(self):
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def is_overload_error(exc):
+    """
+    Whether an exception means the service is overloaded: an HTTP 429 or 5xx
+    from aiohttp or requests, a timeout, or a dropped connection.
+
+    Args:
+        exc (Exception): exception raised by a request
+
+    Returns:
+        bool: True if the request should count as an overload signal
+    """
+    status = getattr(exc, "status", None)
+    if status is None and isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+    if status is not None:
+        return status == 429 or status >= 500
+
+    return isinstance(
+        exc,
+        (
+            asyncio.TimeoutError,
+            aiohttp.ServerDisconnectedError,
+            aiohttp.ClientConnectionError,
+            requests.ConnectionError,
+            requests.Timeout,
+        ),
+    )
+
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except AttributeError:
+        # python 3.6
+        return asyncio.Task.current_task()
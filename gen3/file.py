@@ -1,5 +1,6 @@
 import json
-import requests
+
+from gen3.transport import Gen3Transport
 
 
 class Gen3FileError(Exception):
@@ -15,6 +16,12 @@ class Gen3File:
     Args:
         endpoint (str): The URL of the data commons.
         auth_provider (Gen3Auth): A Gen3Auth class instance.
+        transport (Gen3Transport): Optional HTTP transport to share pooled
+            connections with other clients. One is created if not provided.
+        timeout (float or tuple): Optional timeout of the requests in seconds,
+            either one value or a (connect, read) tuple. None, the default,
+            waits as long as the service takes, which long exports and large
+            submissions can need, whatever the transport's default.
 
     Examples:
         This generates the Gen3File class pointed at the sandbox commons while
@@ -26,9 +33,11 @@ class Gen3File:
 
     """
 
-    def __init__(self, endpoint, auth_provider):
+    def __init__(self, endpoint, auth_provider, transport=None, timeout=None):
         self._auth_provider = auth_provider
         self._endpoint = endpoint
+        self._transport = transport or Gen3Transport()
+        self._timeout = timeout
 
     def get_presigned_url(self, guid, protocol="http"):
         """Generates a presigned URL for a file.
@@ -47,7 +56,9 @@ class Gen3File:
         api_url = "{}/user/data/download/{}?protocol={}".format(
             self._endpoint, guid, protocol
         )
-        output = requests.get(api_url, auth=self._auth_provider).text
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        ).text
         try:
             data = json.loads(output)
         except:
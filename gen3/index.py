@@ -1,49 +1,79 @@
 import aiohttp
-import backoff
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import itertools
+import json
 import requests
+import sys
 import urllib.parse
 import logging
-import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import indexclient.client as client
 
-
-def __log_backoff_retry(details):
-    args_str = ", ".join(map(str, details["args"]))
-    kwargs_str = (
-        (", " + _print_kwargs(details["kwargs"])) if details.get("kwargs") else ""
-    )
-    func_call_log = "{}({}{})".format(
-        _print_func_name(details["target"]), args_str, kwargs_str
-    )
-    logging.warning(
-        "backoff: call {func_call} delay {wait:0.1f} seconds after {tries} tries".format(
-            func_call=func_call_log, **details
-        )
-    )
-
-
-def __log_backoff_giveup(details):
-    args_str = ", ".join(map(str, details["args"]))
-    kwargs_str = (
-        (", " + _print_kwargs(details["kwargs"])) if details.get("kwargs") else ""
-    )
-    func_call_log = "{}({}{})".format(
-        _print_func_name(details["target"]), args_str, kwargs_str
-    )
-    logging.error(
-        "backoff: gave up call {func_call} after {tries} tries; exception: {exc}".format(
-            func_call=func_call_log, exc=sys.exc_info(), **details
-        )
-    )
-
-
-# Default settings to control usage of backoff library.
-BACKOFF_SETTINGS = {
-    "on_backoff": __log_backoff_retry,
-    "on_giveup": __log_backoff_giveup,
-    "max_tries": 2,
-}
+from gen3.auth import Gen3Auth
+from gen3.records import RecordBatch
+from gen3.transport import Gen3Transport
+
+# dids per bulk/documents request, so 1M dids take 1k requests
+DEFAULT_BULK_BATCH_SIZE = 1000
+# bulk/documents requests sent at once
+DEFAULT_BULK_WORKERS = 4
+# record writes sent at once by bulk_upsert
+DEFAULT_WRITE_WORKERS = 16
+# hash lookups sent at once by get_guids_by_hash
+DEFAULT_HASH_LOOKUP_WORKERS = 32
+# records per page when listing the records matching a hash
+HASH_LOOKUP_PAGE_SIZE = 1024
+# longest request url sent by get_urls, well under the usual 8 KB server limit
+MAX_URL_LENGTH = 4096
+# urls per page of a /urls request, the most indexd returns at once
+URLS_PAGE_SIZE = 1024
+# fields compared by diff_records
+DIFF_FIELDS = (
+    "urls",
+    "authz",
+    "acl",
+    "hashes",
+    "size",
+    "file_name",
+    "version",
+    "metadata",
+    "urls_metadata",
+)
+
+# fields of a record indexd updates in place, compared by bulk_upsert
+UPDATABLE_FIELDS = (
+    "file_name",
+    "urls",
+    "version",
+    "metadata",
+    "acl",
+    "authz",
+    "urls_metadata",
+    "description",
+    "content_created_date",
+    "content_updated_date",
+)
+
+RecordChange = collections.namedtuple(
+    "RecordChange", ["change", "did", "old", "new", "fields"]
+)
+RecordChange.__doc__ = """
+A difference between a snapshot of indexd and indexd, see
+Gen3Index.diff_records
+
+Attributes:
+    change (str): "added", "removed" or "modified"
+    did (str): record id
+    old (dict): record in the snapshot, None if it was added
+    new (dict): record in indexd, None if it was removed
+    fields (Tuple[str]): fields that differ between old and new
+"""
 
 
 class Gen3Index:
@@ -54,6 +84,16 @@ class Gen3Index:
     Args:
         endpoint (str): The URL of the data commons.
         auth_provider (Gen3Auth): A Gen3Auth class instance.
+        transport (Gen3Transport): Optional HTTP transport to share pooled
+            connections with other clients. One is created if not provided.
+            Failed requests are retried according to its retry policy.
+        record_cache (RecordCache): Optional cache for the records returned by
+            get, get_record and get_latest_version, kept up to date by the
+            write methods of this class. Records are not cached by default.
+        refetch (bool): Whether create_blank, create_new_version, update_blank
+            and update_record get the written record from indexd again to
+            return it, or return it as assembled from the request and the
+            response. The methods' own refetch argument overrides it.
 
     Examples:
         This generates the Gen3Index class pointed at the sandbox commons while
@@ -63,9 +103,35 @@ class Gen3Index:
         ... auth = Gen3Auth(endpoint, refresh_file="credentials.json")
         ... sub = Gen3Submission(endpoint, auth)
 
+        Used as an async context manager, the asynchronous methods share one
+        aiohttp session and connection pool until the block exits. Connection
+        limits and DNS caching are configured on the transport.
+
+        >>> transport = Gen3Transport(max_connections=64, dns_cache_ttl=600)
+        ... async with Gen3Index(endpoint, auth, transport=transport) as index:
+        ...     records = await asyncio.gather(
+        ...         *(index.async_get_record(guid) for guid in guids)
+        ...     )
+
+        With a record cache, looking up the same guids again in a later stage
+        of a job doesn't send any request.
+
+        >>> index = Gen3Index(endpoint, auth, record_cache=RecordCache(ttl=600))
+        ... index.get_record(guid)  # sent to indexd
+        ... index.get_record(guid)  # from the cache
+        ... index.record_cache.stats()
+
     """
 
-    def __init__(self, endpoint, auth_provider=None, service_location="index"):
+    def __init__(
+        self,
+        endpoint,
+        auth_provider=None,
+        service_location="index",
+        transport=None,
+        record_cache=None,
+        refetch=True,
+    ):
         endpoint = endpoint.strip("/")
         # if running locally, indexd is deployed by itself without a location relative
         # to the commons
@@ -75,7 +141,18 @@ class Gen3Index:
         if not endpoint.endswith(service_location):
             endpoint += "/" + service_location
 
-        self.client = client.IndexClient(endpoint, auth=auth_provider)
+        self._auth_provider = auth_provider
+        self._transport = transport or Gen3Transport()
+        self.client = _IndexClient(endpoint, self._transport, auth=auth_provider)
+        self.record_cache = record_cache
+        self.refetch = refetch
+
+    async def __aenter__(self):
+        await self._transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._transport.__aexit__(*exc_info)
 
     ### Get Requests
     def is_healthy(self):
@@ -91,7 +168,6 @@ class Gen3Index:
             return False
         return response.text == "Healthy"
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_version(self):
         """
 
@@ -102,7 +178,6 @@ class Gen3Index:
         response.raise_for_status()
         return response.json()
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_stats(self):
         """
 
@@ -113,52 +188,252 @@ class Gen3Index:
         response.raise_for_status()
         return response.json()
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
-    def get_all_records(self, limit=None, paginate=False, start=None):
+    def get_all_records(self, limit=None, paginate=False, start=None, compact=False):
         """
 
         Get a list of all records
 
+        Args:
+            limit (int): number of records per page
+            paginate (bool): get every page instead of only the first one
+            start (str): only get records with a did after this one
+            compact (bool): return a RecordBatch, which takes several times
+                less memory than a list of dicts
+
+        Returns:
+            List[dict] or RecordBatch: indexd records
+
+        Note: this keeps every record in memory; use iter_records to go over
+        a large index.
+
         """
-        all_records = []
-        url = "index/"
+        if paginate:
+            records = self.iter_records(page_size=limit, start=start)
+            return RecordBatch(records) if compact else list(records)
 
-        if limit:
-            url += f"?limit={limit}"
+        records = self._get_records_after(start, limit)
+        return RecordBatch(records or []) if compact else records
 
-        response = self.client._get(url)
-        response.raise_for_status()
+    def iter_records(
+        self, page_size=None, start=None, end=None, pages=False, prefetch=False
+    ):
+        """
+
+        Iterate over all records in did order, requesting them a page at a time
+        with indexd's ``start`` cursor, so only the current page (and with
+        prefetch the next one) is held in memory.
+
+        Args:
+            page_size (int): number of records per page, indexd's default if None
+            start (str): only yield records with a did after this one
+            end (str): only yield records with a did up to and including this one
+            pages (bool): yield each page as a list instead of single records
+            prefetch (bool): request the next page in a background thread while
+                the caller processes the current one
 
-        records = response.json().get("records")
-        all_records.extend(records)
+        Yields:
+            dict or List[dict]: indexd records, or pages of them
 
-        if paginate and records:
-            previous_did = None
-            start_did = records[-1].get("did")
+        Examples:
+            >>> for record in index.iter_records(page_size=1024, prefetch=True):
+            ...     writer.writerow([record["did"], record["size"]])
 
-            while start_did != previous_did:
-                previous_did = start_did
+        """
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            records = self._get_records_after(start, page_size)
+            while records:
+                start = records[-1].get("did")
+                finished = end is not None and start >= end
+                if end is not None:
+                    records = [r for r in records if r.get("did") <= end]
+
+                next_page = None
+                if executor and not finished:
+                    next_page = executor.submit(
+                        self._get_records_after, start, page_size
+                    )
+
+                if pages and records:
+                    yield records
+                elif not pages:
+                    yield from records
+
+                if finished:
+                    break
+                if next_page:
+                    records = next_page.result()
+                else:
+                    records = self._get_records_after(start, page_size)
+
+                if records and records[-1].get("did") == start:
+                    # the cursor didn't move
+                    break
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def get_shards(self, num_shards):
+        """
 
-                params = {"start": f"{start_did}"}
-                url_parts = list(urllib.parse.urlparse(url))
-                query = dict(urllib.parse.parse_qsl(url_parts[4]))
-                query.update(params)
+        Split the did keyspace into ranges that can be scanned independently
+        with ``iter_records(start=start, end=end)``.
 
-                url_parts[4] = urllib.parse.urlencode(query)
+        The ranges are cut at evenly spaced hex prefixes after the prefix of
+        the first did (like ``dg.1234/``), which spreads UUID based dids evenly.
+        Every did falls in exactly one range whatever its format, dids that
+        don't share the prefix just make the first or last range larger.
 
-                url = urllib.parse.urlunparse(url_parts)
-                response = self.client._get(url)
-                response.raise_for_status()
+        Args:
+            num_shards (int): number of ranges, at most 65536
+
+        Returns:
+            List[Tuple[str, str]]: (start, end) ranges in did order; start is
+            exclusive, end inclusive, and None means unbounded
+
+        """
+        return _shards(self._get_records_after(None, 1), num_shards)
+
+    def scan_records(self, num_shards=8, page_size=None, shards=None, ordered=False):
+        """
+
+        Iterate over all records like iter_records, scanning key ranges of the
+        index concurrently in threads. Each shard follows indexd's ``start``
+        cursor, so there are no deep page offsets, and each record is yielded
+        exactly once: shards are disjoint ranges and only yield records inside
+        their range.
+
+        This relies on indexd ordering dids the way python compares strings,
+        which holds for the usual ``prefix/uuid`` dids.
+
+        Args:
+            num_shards (int): number of key ranges to scan at once
+            page_size (int): number of records per page
+            shards (List[Tuple[str, str]]): key ranges to scan instead of
+                get_shards(num_shards)
+            ordered (bool): yield records in did order; otherwise records are
+                yielded as soon as any shard gets them
+
+        Yields:
+            dict: indexd records
+
+        Examples:
+            >>> for record in index.scan_records(num_shards=16, page_size=1024):
+            ...     writer.writerow([record["did"], record["size"]])
+
+        """
+        shards = shards or self.get_shards(num_shards)
+        if ordered:
+            queues = [queue.Queue(maxsize=2) for _ in shards]
+        else:
+            queues = [queue.Queue(maxsize=2 * len(shards))] * len(shards)
+        stop = threading.Event()
+
+        def scan(shard, pages):
+            try:
+                for page in self.iter_records(
+                    page_size, start=shard[0], end=shard[1], pages=True
+                ):
+                    if not _put_unless_stopped(pages, page, stop):
+                        return
+                _put_unless_stopped(pages, None, stop)
+            except Exception as exc:
+                _put_unless_stopped(pages, exc, stop)
+
+        executor = ThreadPoolExecutor(max_workers=len(shards))
+        try:
+            for shard, pages in zip(shards, queues):
+                executor.submit(scan, shard, pages)
+
+            # one None per shard marks the end of its records
+            for pages in queues if ordered else [queues[0]]:
+                remaining = 1 if ordered else len(shards)
+                while remaining:
+                    page = pages.get()
+                    if page is None:
+                        remaining -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield from page
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def diff_records(self, snapshot, fields=DIFF_FIELDS, num_shards=8, page_size=None):
+        """
+
+        Compare a snapshot of the index with the records in indexd now and
+        yield the records that were added, removed or modified since.
+
+        The snapshot and a concurrent scan of indexd (see scan_records) are
+        both read in did order and merged as they go, so neither is held in
+        memory and changes are yielded as soon as they are found. A record
+        counts as modified when its rev changed and one of the compared fields
+        differs; records are only compared field by field when their rev
+        changed, or when the snapshot has no rev.
+
+        indexd can't list records by ``updated_date``, so the whole index is
+        scanned; keep the snapshot up to date with Gen3IndexMirror.sync.
+
+        Args:
+            snapshot (Iterable[dict]): earlier records of the index in did
+                order, like Gen3IndexMirror.iter_records(), a RecordBatch or
+                the records of an earlier get_all_records(paginate=True)
+            fields (Iterable[str]): record fields to compare
+            num_shards (int): number of key ranges of the index to scan at once
+            page_size (int): number of records per page
+
+        Yields:
+            RecordChange: each change, in did order
+
+        Raises:
+            ValueError: the snapshot or indexd's listing isn't in did order
 
-                records = response.json().get("records")
-                all_records.extend(records)
+        Examples:
+            >>> with Gen3IndexMirror("indexd.sqlite") as mirror:
+            ...     for change in index.diff_records(mirror.iter_records()):
+            ...         if "authz" in change.fields:
+            ...             logging.info(f"{change.did} moved to {change.new['authz']}")
 
-                if records:
-                    start_did = response.json().get("records")[-1].get("did")
+        """
+        fields = tuple(fields)
+        old_records = _in_did_order(snapshot, "snapshot")
+        new_records = _in_did_order(
+            self.scan_records(num_shards=num_shards, page_size=page_size, ordered=True),
+            "indexd listing",
+        )
+        old = next(old_records, None)
+        new = next(new_records, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old["did"] < new["did"]):
+                yield RecordChange("removed", old["did"], old, None, ())
+                old = next(old_records, None)
+            elif old is None or new["did"] < old["did"]:
+                yield RecordChange("added", new["did"], None, new, ())
+                new = next(new_records, None)
+            else:
+                if old.get("rev") is None or old.get("rev") != new.get("rev"):
+                    changed = tuple(f for f in fields if old.get(f) != new.get(f))
+                    if changed:
+                        yield RecordChange("modified", new["did"], old, new, changed)
+                old = next(old_records, None)
+                new = next(new_records, None)
+
+    def _get_records_after(self, start=None, limit=None):
+        """
+        Get one page of records with a did after start
+        """
+        params = {}
+        if limit is not None:
+            params["limit"] = limit
+        if start is not None:
+            params["start"] = start
 
-        return all_records
+        response = self.client._get("index/", params=params)
+        response.raise_for_status()
+        return response.json().get("records")
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_records_on_page(self, limit=None, page=None):
         """
 
@@ -181,7 +456,6 @@ class Gen3Index:
 
         return response.json().get("records")
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     async def async_get_record(self, guid=None, _ssl=None):
         """
         Asynchronous function to request a record from indexd.
@@ -191,21 +465,43 @@ class Gen3Index:
 
         Returns:
             dict: indexd record
+
+        Raises:
+            aiohttp.ClientResponseError: indexd answered 429 or 5xx after the
+                transport's retries
         """
+        key = ("get_record", guid)
+        if self.record_cache is not None:
+            record = self.record_cache.get(key)
+            if record is not None:
+                return record
+
         url = f"{self.client.url}/index/{guid}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, ssl=_ssl) as response:
+        async with self._transport.aiohttp_session() as session:
+            async with await self._async_request(
+                session, "GET", url, ssl=_ssl
+            ) as response:
+                # raised so a concurrency limiter around the call backs off,
+                # see gen3.concurrency.is_overload_error
+                if response.status == 429 or response.status >= 500:
+                    response.raise_for_status()
+                found = response.status == 200
                 response = await response.json()
 
+        if found and self.record_cache is not None:
+            self.record_cache.put(key, response)
         return response
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
-    async def async_get_records_on_page(self, limit=None, page=None, _ssl=None):
+    async def async_get_records_on_page(
+        self, limit=None, page=None, start=None, _ssl=None
+    ):
         """
         Asynchronous function to request a page from indexd.
 
         Args:
             page (int/str): indexd page to request
+            start (str): only get records with a did after this one, to page
+                with a cursor instead of offsets
 
         Returns:
             List[dict]: List of indexd records from the page
@@ -219,16 +515,163 @@ class Gen3Index:
         if page is not None:
             params["page"] = page
 
+        if start is not None:
+            params["start"] = start
+
         query = urllib.parse.urlencode(params)
 
         url = f"{self.client.url}/index" + "?" + query
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, ssl=_ssl) as response:
+        async with self._transport.aiohttp_session() as session:
+            async with await self._async_request(
+                session, "GET", url, ssl=_ssl
+            ) as response:
+                response.raise_for_status()
                 response = await response.json()
 
         return response.get("records")
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
+    async def async_bulk_get_records(
+        self,
+        dids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_concurrency=DEFAULT_BULK_WORKERS,
+        compact=False,
+        _ssl=None,
+    ):
+        """
+        Asynchronous version of bulk_get_records.
+
+        Args:
+            dids (Iterable[str]): record ids
+            batch_size (int): number of dids per bulk/documents request
+            max_concurrency (int): number of requests sent at once
+            compact (bool): return the records found as a RecordBatch
+
+        Returns:
+            Tuple[List[dict], List[str]]: records found, in the order of the
+            dids, and the dids that were not found
+        """
+        records = RecordBatch() if compact else []
+        missing = []
+        async for batch_records, batch_missing in self.async_get_records_in_batches(
+            dids, batch_size=batch_size, max_concurrency=max_concurrency, _ssl=_ssl
+        ):
+            records.extend(batch_records)
+            missing.extend(batch_missing)
+        return records, missing
+
+    async def async_get_records_in_batches(
+        self,
+        dids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_concurrency=DEFAULT_BULK_WORKERS,
+        ordered=True,
+        _ssl=None,
+    ):
+        """
+        Asynchronous version of get_records_in_batches.
+
+        Args:
+            dids (Iterable[str]): record ids
+            batch_size (int): number of dids per bulk/documents request
+            max_concurrency (int): number of requests sent at once
+            ordered (bool): yield the batches in the order of the dids;
+                otherwise each batch is yielded as soon as it's complete
+
+        Yields:
+            Tuple[List[dict], List[str]]: for each batch, the records found, in
+            the order of the dids, and the dids that were not found
+        """
+        url = f"{self.client.url}/bulk/documents"
+
+        async def get_batch(session, batch):
+            async with await self._async_request(
+                session, "POST", url, json=batch, ssl=_ssl, idempotent=True
+            ) as response:
+                if response.status == 404:
+                    return [], list(batch)
+                response.raise_for_status()
+                return _match_records(batch, await response.json())
+
+        batches = _batches(dids, batch_size)
+        pending = collections.deque()
+        async with self._transport.aiohttp_session() as session:
+            try:
+                for batch in itertools.islice(batches, max_concurrency):
+                    pending.append(asyncio.ensure_future(get_batch(session, batch)))
+
+                while pending:
+                    if ordered:
+                        done = pending.popleft()
+                        await asyncio.wait([done])
+                    else:
+                        finished, _ = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        done = finished.pop()
+                        pending.remove(done)
+
+                    for batch in itertools.islice(batches, 1):
+                        pending.append(asyncio.ensure_future(get_batch(session, batch)))
+                    yield done.result()
+            finally:
+                for task in pending:
+                    task.cancel()
+
+    async def _async_request(self, session, method, url, **kwargs):
+        """
+        Send an authenticated request with the given aiohttp session.
+
+        With a Gen3Auth provider the access token is added as a bearer header
+        and, if the request gets a 401, the token is refreshed and the request
+        is sent once more. A (username, password) tuple is sent as basic auth.
+        Transient failures are retried according to the transport's retry
+        policy, and requests to an unavailable indexd fail fast through the
+        transport's circuit breaker.
+
+        Args:
+            session (aiohttp.ClientSession): session to send the request with
+            method (str): HTTP method
+            url (str): full url to request
+            **kwargs: passed to aiohttp.ClientSession.request
+
+        Returns:
+            aiohttp.ClientResponse: the response, to be used as a context manager
+        """
+        idempotent = kwargs.pop("idempotent", None)
+        circuit_breaker = self._transport.circuit_breaker(url)
+        return await self._transport.retry_policy.async_call(
+            lambda: circuit_breaker.async_call(
+                lambda: self._async_send(session, method, url, **kwargs)
+            ),
+            method,
+            url,
+            idempotent=idempotent,
+        )
+
+    async def _async_send(self, session, method, url, **kwargs):
+        auth = self._auth_provider
+        headers = dict(kwargs.pop("headers", None) or {})
+        if isinstance(auth, tuple):
+            credentials = "{}:{}".format(*auth).encode("utf-8")
+            headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode()
+
+        if not isinstance(auth, Gen3Auth):
+            return await session.request(method, url, headers=headers, **kwargs)
+
+        auth_header = await auth.async_get_auth_header()
+        response = await session.request(
+            method, url, headers={**headers, **auth_header}, **kwargs
+        )
+        if response.status != 401:
+            return response
+
+        response.release()
+        auth_header = await auth.async_handle_401(auth_header)
+        return await session.request(
+            method, url, headers={**headers, **auth_header}, **kwargs
+        )
+
     def get(self, guid, dist_resolution=True):
         """
 
@@ -242,19 +685,82 @@ class Gen3Index:
                 - *optional* Specify if we want distributed dist_resolution or not
 
         """
-        rec = self.client.global_get(guid, dist_resolution)
 
-        if not rec:
-            return rec
+        def lookup():
+            rec = self.client.global_get(guid, no_dist=not dist_resolution)
+            return rec.to_json() if rec else rec
 
-        return rec.to_json()
+        return self._cached(("get", guid, dist_resolution), lookup)
+
+    def get_guids_by_hash(
+        self, files, max_workers=DEFAULT_HASH_LOOKUP_WORKERS, mirror=None
+    ):
+        """
+
+        Find the records already indexed with the md5 and size of each file,
+        for instance to skip uploading duplicates.
+
+        The (md5, size) pairs are de-duplicated and each distinct pair is
+        looked up once, concurrently. With a Gen3IndexMirror the pairs are
+        looked up in the mirror instead, without any request to indexd.
+
+        Args:
+            files (Iterable[Tuple[str, int]]): (md5, size) pairs; a size of None
+                matches any size
+            max_workers (int): number of lookups sent at once
+            mirror (Gen3IndexMirror): local mirror to look the pairs up in
+
+        Returns:
+            Dict[Tuple[str, int], List[str]]: for each distinct pair, the dids
+            of the records with that md5 and size, empty if there are none
+
+        Examples:
+            >>> existing = index.get_guids_by_hash(
+            ...     (row["md5"], int(row["size"])) for row in manifest_rows
+            ... )
+            ... to_upload = [
+            ...     row for row in manifest_rows
+            ...     if not existing[(row["md5"], int(row["size"]))]
+            ... ]
+
+        """
+        pairs = _distinct_pairs(files)
+        if mirror is not None:
+            return _guids_in_mirror(mirror, pairs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            guids = executor.map(lambda pair: self._get_guids_by_hash(*pair), pairs)
+            return dict(zip(pairs, guids))
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
-    def get_urls(self, size=None, hashes=None, guids=None):
+    def _get_guids_by_hash(self, md5, size):
+        """
+        Dids of every record with the md5 and size, following indexd's cursor
+        """
+        dids = []
+        params = {"hash": f"md5:{md5}", "limit": HASH_LOOKUP_PAGE_SIZE}
+        if size is not None:
+            params["size"] = size
+        while True:
+            response = self.client._get("index/", params=params)
+            records = response.json().get("records") or []
+            dids.extend(record["did"] for record in records)
+            if len(records) < HASH_LOOKUP_PAGE_SIZE:
+                return dids
+            params["start"] = records[-1]["did"]
+
+    def get_urls(
+        self, size=None, hashes=None, guids=None, max_workers=DEFAULT_BULK_WORKERS
+    ):
         """
 
         Get a list of urls that match query params
 
+        indexd returns at most URLS_PAGE_SIZE urls per request, so the urls
+        are read page by page. Long lists of guids are split into several
+        requests that each fit in MAX_URL_LENGTH, sent concurrently, and their
+        results concatenated. To know which urls belong to which guid, use
+        iter_urls.
+
         Args:
             size: integer
                 - object size
@@ -262,29 +768,90 @@ class Gen3Index:
                 - hashes specified as algorithm:value
             guids: list
                 - list of ids
+            max_workers: integer
+                - *optional* number of requests sent at once for long lists
+                  of guids
+
+        """
+        p = {"size": size, "hash": hashes}
+        if not guids:
+            return self._get_urls(p)
+
+        max_length = MAX_URL_LENGTH - _urls_query_length(self.client.url_for("urls"), p)
+        chunks = list(_chunks_by_length(guids, max_length))
+        if len(chunks) == 1:
+            return self._get_urls({**p, "ids": ",".join(chunks[0])})
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                lambda chunk: self._get_urls({**p, "ids": ",".join(chunk)}), chunks
+            )
+            return [url for urls in results for url in urls]
+
+    def _get_urls(self, params):
+        params = {**params, "limit": URLS_PAGE_SIZE, "start": 0}
+        urls = []
+        while True:
+            page = self.client._get("urls", params=params).json()["urls"]
+            urls.extend(url["url"] for url in page)
+            if len(page) < URLS_PAGE_SIZE:
+                return urls
+            params["start"] += len(page)
+
+    def iter_urls(
+        self,
+        guids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_workers=DEFAULT_BULK_WORKERS,
+        ordered=True,
+    ):
+        """
+
+        Resolve the urls of many guids, streaming the results.
+
+        The records are requested in batches with concurrent bulk/documents
+        requests (see get_records_in_batches), whose guids are sent in the
+        request body, so there is no limit on the number of guids, and only
+        the batches being requested are held in memory.
+
+        Args:
+            guids (Iterable[str]): record ids
+            batch_size (int): number of guids per request
+            max_workers (int): number of requests sent at once
+            ordered (bool): yield the batches in the order of the guids;
+                otherwise each batch is yielded as soon as it's complete
+
+        Yields:
+            Tuple[str, List[str]]: each guid and its urls, or None if it isn't
+            indexed; in each batch the guids that aren't indexed come last
+
+        Examples:
+            >>> with open("cohort_urls.tsv", "w") as output:
+            ...     for guid, urls in index.iter_urls(cohort_guids):
+            ...         output.write(f"{guid}\t{' '.join(urls or [])}\n")
 
         """
-        if guids:
-            guids = ",".join(guids)
-        p = {"size": size, "hash": hashes, "ids": guids}
-        urls = self.client._get("urls", params=p).json()
-        return [url for _, url in urls.items()]
+        for records, missing in self.get_records_in_batches(
+            guids, batch_size=batch_size, max_workers=max_workers, ordered=ordered
+        ):
+            for record in records:
+                yield record["did"], record.get("urls") or []
+            for guid in missing:
+                yield guid, None
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_record(self, guid):
         """
 
         Get the metadata associated with a given id
 
         """
-        rec = self.client.get(guid)
 
-        if not rec:
-            return rec
+        def lookup():
+            rec = self.client.get(guid)
+            return rec.to_json() if rec else rec
 
-        return rec.to_json()
+        return self._cached(("get_record", guid), lookup)
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_record_doc(self, guid):
         """
 
@@ -293,7 +860,6 @@ class Gen3Index:
         """
         return self.client.get(guid)
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_with_params(self, params=None):
         """
 
@@ -312,7 +878,6 @@ class Gen3Index:
 
         return rec.to_json()
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_latest_version(self, guid, has_version=False):
         """
 
@@ -326,14 +891,33 @@ class Gen3Index:
                 - *optional* exclude entries without a version
 
         """
-        rec = self.client.get_latest_version(guid, has_version)
 
-        if not rec:
-            return rec
+        def lookup():
+            rec = self.client.get_latest_version(guid, has_version)
+            return rec.to_json() if rec else rec
 
-        return rec.to_json()
+        return self._cached(("get_latest_version", guid, has_version), lookup)
+
+    def _cached(self, key, lookup):
+        """
+        Return the record cached for a lookup, or look it up and cache it
+        """
+        if self.record_cache is None:
+            return lookup()
+
+        record = self.record_cache.get(key)
+        if record is None:
+            record = lookup()
+            self.record_cache.put(key, record)
+        return record
+
+    def _invalidate(self, guid, baseid=None):
+        """
+        Drop the cached records made stale by a write to guid
+        """
+        if self.record_cache is not None:
+            self.record_cache.invalidate(guid, baseid)
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_versions(self, guid):
         """
 
@@ -353,7 +937,6 @@ class Gen3Index:
 
     ### Post Requests
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def create_record(
         self,
         hashes,
@@ -402,10 +985,131 @@ class Gen3Index:
             version,
             authz,
         )
+        # a new version of baseid changes its latest version
+        self._invalidate(rec.did, baseid)
         return rec.to_json()
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
-    def create_blank(self, uploader, file_name=None):
+    def bulk_upsert(
+        self,
+        records,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_workers=DEFAULT_WRITE_WORKERS,
+    ):
+        """
+
+        Create or update many records, sending the writes concurrently.
+
+        The records are read in batches. The existing records of each batch
+        are fetched with one bulk/documents request, then each record is
+        created if its did isn't indexed (or it has no did), updated if any of
+        its updatable fields differ from the indexed record, and left alone
+        otherwise. An update sends one request using the prefetched rev, and
+        only when the record was changed since then is it fetched again.
+
+        Hashes and size can't be updated, a record whose hashes or size differ
+        from the indexed ones fails; use create_new_version instead.
+
+        Args:
+            records (Iterable[dict]): records with the fields of
+                create_record; fields that are missing or None are left as
+                they are on existing records. Updated urls, acl and authz
+                replace the indexed lists.
+            batch_size (int): number of records fetched at once
+            max_workers (int): number of writes sent at once; the transport
+                should keep as many connections per host
+
+        Returns:
+            List[dict]: for each record, in order, its ``did``, the ``result``
+            ("created", "updated", "unchanged" or "failed") and the ``error``
+            message of failed records
+
+        Examples:
+            >>> results = index.bulk_upsert(
+            ...     {"did": row["guid"], "hashes": {"md5": row["md5"]},
+            ...      "size": int(row["size"]), "urls": [row["url"]],
+            ...      "authz": [row["authz"]]}
+            ...     for row in csv.DictReader(manifest)
+            ... )
+            ... collections.Counter(result["result"] for result in results)
+
+        """
+        results = []
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in _batches(records, batch_size):
+                dids = [record["did"] for record in batch if record.get("did")]
+                found, _ = self._get_records_batch(dids) if dids else ([], [])
+                existing = {record["did"]: record for record in found}
+                pending.append(
+                    [
+                        executor.submit(
+                            self._upsert, record, existing.get(record.get("did"))
+                        )
+                        for record in batch
+                    ]
+                )
+                # fetch the next batch while this one is written
+                if len(pending) > 1:
+                    results.extend(future.result() for future in pending.popleft())
+
+            while pending:
+                results.extend(future.result() for future in pending.popleft())
+
+        return results
+
+    def _upsert(self, record, existing):
+        """
+        Create or update one record of bulk_upsert and return its result
+        """
+        did = record.get("did")
+        try:
+            if existing is None:
+                return {"did": self._create(record), "result": "created", "error": None}
+
+            changes = _record_changes(existing, record)
+            if not changes:
+                return {"did": did, "result": "unchanged", "error": None}
+            try:
+                self._update(existing, changes)
+            except requests.HTTPError as exception:
+                if exception.response.status_code != 409:
+                    raise
+                # the record changed since it was fetched, compare it again
+                existing = self.client._get("index", did).json()
+                changes = _record_changes(existing, record)
+                if not changes:
+                    return {"did": did, "result": "unchanged", "error": None}
+                self._update(existing, changes)
+            return {"did": did, "result": "updated", "error": None}
+        except Exception as exception:
+            logging.error(f"failed to create or update record {did}: {exception}")
+            return {"did": did, "result": "failed", "error": str(exception)}
+
+    def _create(self, record):
+        json = {"form": "object", "urls": []}
+        json.update({k: v for k, v in record.items() if v is not None})
+        response = self.client._post(
+            "index/",
+            headers={"content-type": "application/json"},
+            data=client.json_dumps(json),
+            auth=self.client.auth,
+        )
+        rec = response.json()
+        self._invalidate(rec["did"], rec.get("baseid"))
+        return rec["did"]
+
+    def _update(self, existing, changes):
+        self.client._put(
+            "index",
+            existing["did"],
+            headers={"content-type": "application/json"},
+            params={"rev": existing["rev"]},
+            data=client.json_dumps(changes),
+            auth=self.client.auth,
+        )
+        self._invalidate(existing["did"], existing.get("baseid"))
+
+    def create_blank(self, uploader, file_name=None, refetch=None):
         """
 
         Create a blank record
@@ -416,6 +1120,9 @@ class Gen3Index:
                 'uploader': type(string)
                 'file_name': type(string) (optional*)
             }
+            refetch (bool): get the created record from indexd instead of
+                returning the fields sent with the did, rev and baseid indexd
+                returned; defaults to the client's refetch
 
         """
         json = {"uploader": uploader, "file_name": file_name}
@@ -428,9 +1135,8 @@ class Gen3Index:
         response.raise_for_status()
         rec = response.json()
 
-        return self.get_record(rec["did"])
+        return self._written_record(rec["did"], json, rec, refetch)
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def create_new_version(
         self,
         guid,
@@ -444,6 +1150,7 @@ class Gen3Index:
         urls_metadata=None,
         version=None,
         authz=None,
+        refetch=None,
     ):
         """
 
@@ -467,6 +1174,9 @@ class Gen3Index:
             urls_metadata (dict): metadata attached to each url
             version (str): entry version string
             authz (str): RBAC string
+            refetch (bool): get the new version from indexd instead of
+                returning the fields sent with the did, rev and baseid indexd
+                returned; defaults to the client's refetch
 
             body: json/dictionary format
             - Metadata object that needs to be added to the store.
@@ -500,41 +1210,125 @@ class Gen3Index:
         )
         response.raise_for_status()
         rec = response.json()
+        self._invalidate(guid, rec.get("baseid") if rec else None)
 
         if rec and "did" in rec:
-            return self.get_record(rec["did"])
+            return self._written_record(rec["did"], json, rec, refetch)
         return None
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def get_records(self, dids):
         """
 
-        Get a list of documents given a list of dids
+        Get a list of documents given a list of dids. Large lists are requested
+        in batches, see bulk_get_records.
 
         Args:
             dids: list
                  - a list of record ids
 
         Returns:
-            list: json representing index records
+            list: json representing index records, None if none were found
+
+        """
+        records, _ = self.bulk_get_records(dids)
+        return records or None
+
+    def bulk_get_records(
+        self,
+        dids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_workers=DEFAULT_BULK_WORKERS,
+        compact=False,
+    ):
+        """
+
+        Get the records of any number of dids, requesting them in batches in
+        parallel
+
+        Args:
+            dids (Iterable[str]): record ids
+            batch_size (int): number of dids per bulk/documents request
+            max_workers (int): number of requests sent at once
+            compact (bool): return the records found as a RecordBatch, which
+                takes several times less memory than a list of dicts
+
+        Returns:
+            Tuple[List[dict], List[str]]: records found, in the order of the
+            dids, and the dids that were not found
+
+        """
+        records = RecordBatch() if compact else []
+        missing = []
+        for batch_records, batch_missing in self.get_records_in_batches(
+            dids, batch_size=batch_size, max_workers=max_workers
+        ):
+            records.extend(batch_records)
+            missing.extend(batch_missing)
+        return records, missing
+
+    def get_records_in_batches(
+        self,
+        dids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_workers=DEFAULT_BULK_WORKERS,
+        ordered=True,
+    ):
+        """
+
+        Request the records of any number of dids in batches, sent in parallel
+        from a thread pool. The dids are read lazily and at most
+        ``2 * max_workers`` batches are pending at a time, so memory stays
+        bounded for large inputs.
+
+        Args:
+            dids (Iterable[str]): record ids
+            batch_size (int): number of dids per bulk/documents request
+            max_workers (int): number of requests sent at once
+            ordered (bool): yield the batches in the order of the dids;
+                otherwise each batch is yielded as soon as it's complete
+
+        Yields:
+            Tuple[List[dict], List[str]]: for each batch, the records found, in
+            the order of the dids, and the dids that were not found
+
+        Examples:
+            >>> for records, missing in index.get_records_in_batches(guids):
+            ...     for guid in missing:
+            ...         logging.warning(f"{guid} is not indexed")
 
         """
+        batches = _batches(dids, batch_size)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in itertools.islice(batches, 2 * max_workers):
+                pending.append(executor.submit(self._get_records_batch, batch))
+
+            while pending:
+                if ordered:
+                    done = pending.popleft()
+                else:
+                    done = next(concurrent.futures.as_completed(pending))
+                    pending.remove(done)
+
+                for batch in itertools.islice(batches, 1):
+                    pending.append(executor.submit(self._get_records_batch, batch))
+                yield done.result()
+
+    def _get_records_batch(self, dids):
         try:
             response = self.client._post(
-                "bulk/documents", json=dids, auth=self.client.auth
+                "bulk/documents", json=dids, auth=self.client.auth, idempotent=True
             )
         except requests.HTTPError as exception:
-            if exception.response.status_code == 404:
-                return None
-            else:
-                raise exception
+            if exception.response.status_code != 404:
+                raise
+            return [], list(dids)
 
-        return response.json()
+        return _match_records(dids, response.json())
 
     ### Put Requests
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
-    def update_blank(self, guid, rev, hashes, size):
+    def update_blank(self, guid, rev, hashes, size, refetch=None):
         """
 
         Update only hashes and size for a blank index
@@ -545,6 +1339,9 @@ class Gen3Index:
             hashes (dict): {hash type: hash value,}
                 eg ``hashes={'md5': ab167e49d25b488939b1ede42752458b'}``
             size (int): file size metadata associated with a given uuid
+            refetch (bool): get the updated record from indexd instead of
+                returning the hashes and size sent with the did, rev and
+                baseid indexd returned; defaults to the client's refetch
 
         """
         p = {"rev": rev}
@@ -559,10 +1356,10 @@ class Gen3Index:
         )
         response.raise_for_status()
         rec = response.json()
+        self._invalidate(rec["did"], rec.get("baseid"))
 
-        return self.get_record(rec["did"])
+        return self._written_record(rec["did"], json, rec, refetch)
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def update_record(
         self,
         guid,
@@ -573,6 +1370,8 @@ class Gen3Index:
         acl=None,
         authz=None,
         urls_metadata=None,
+        rev=None,
+        refetch=None,
     ):
         """
 
@@ -584,6 +1383,15 @@ class Gen3Index:
              body: json/dictionary format
                  - index record information that needs to be updated.
                  - can not update size or hash, use new version for that
+             rev: string
+                 - *optional* rev of the record the update is based on. The
+                   record isn't fetched before the update then, and the update
+                   fails with a 409 error if the record changed since.
+             refetch: boolean
+                 - *optional* get the updated record from indexd instead of
+                   returning the current record (or with a rev, only the
+                   updated fields) with the did, rev and baseid indexd
+                   returned; defaults to the client's refetch
 
         """
         updatable_attrs = {
@@ -595,16 +1403,38 @@ class Gen3Index:
             "authz": authz,
             "urls_metadata": urls_metadata,
         }
-        rec = self.client.get(guid)
-        for k, v in updatable_attrs.items():
-            if v is not None:
-                exec(f"rec.{k} = v")
-        rec.patch()
-        return rec.to_json()
+        changes = {k: v for k, v in updatable_attrs.items() if v is not None}
+        record = {}
+        if rev is None:
+            record = self.client.get(guid).to_json()
+            rev = record["rev"]
+
+        response = self.client._put(
+            "index",
+            guid,
+            headers={"content-type": "application/json"},
+            params={"rev": rev},
+            auth=self.client.auth,
+            data=client.json_dumps(changes),
+        )
+        rec = response.json()
+        self._invalidate(guid, rec.get("baseid"))
+
+        return self._written_record(guid, {**record, **changes}, rec, refetch)
+
+    def _written_record(self, guid, sent, response, refetch=None):
+        """
+        Record returned by a write: fetched again from indexd, or the fields
+        sent updated with the did, rev and baseid of the response
+        """
+        if refetch is None:
+            refetch = self.refetch
+        if refetch:
+            return self.get_record(guid)
+        return {**sent, **response}
 
     ### Delete Requests
 
-    @backoff.on_exception(backoff.expo, Exception, **BACKOFF_SETTINGS)
     def delete_record(self, guid):
         """
 
@@ -619,12 +1449,1015 @@ class Gen3Index:
         """
         rec = self.client.get(guid)
         rec.delete()
+        self._invalidate(guid, getattr(rec, "baseid", None))
         return rec
 
 
-def _print_func_name(function):
-    return "{}.{}".format(function.__module__, function.__name__)
+class AsyncGen3Index:
+    """
+
+    Asynchronous counterpart of Gen3Index: the same methods, as coroutines.
+
+    Requests are sent with the transport's aiohttp session, authenticated with
+    the auth provider and retried, rate limited and circuit broken like the
+    requests of Gen3Index. Use it as an async context manager so every request
+    shares one session and connection pool; otherwise each call opens its own.
+
+    Args:
+        endpoint (str): The URL of the data commons.
+        auth_provider (Gen3Auth): A Gen3Auth class instance.
+        service_location (str): path of indexd relative to the commons
+        transport (Gen3Transport): Optional HTTP transport, shared with other
+            clients. One is created if not provided.
+        record_cache (RecordCache): Optional record cache, see Gen3Index.
+        refetch (bool): Whether write methods get the written record from
+            indexd again to return it, see Gen3Index.
+
+    Examples:
+        Updating the authz of many records concurrently.
+
+        >>> transport = Gen3Transport(max_connections_per_host=128)
+        ... async with AsyncGen3Index(endpoint, auth, transport=transport) as index:
+        ...     await asyncio.gather(
+        ...         *(
+        ...             index.update_record(record["did"], authz=authz, rev=record["rev"])
+        ...             async for record in index.iter_records(page_size=1024)
+        ...         )
+        ...     )
+
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        auth_provider=None,
+        service_location="index",
+        transport=None,
+        record_cache=None,
+        refetch=True,
+    ):
+        self._index = Gen3Index(
+            endpoint,
+            auth_provider=auth_provider,
+            service_location=service_location,
+            transport=transport,
+            record_cache=record_cache,
+            refetch=refetch,
+        )
+        self._transport = self._index._transport
+        self.url = self._index.client.url
+        self.record_cache = record_cache
+        self.refetch = refetch
+
+    async def __aenter__(self):
+        await self._transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._transport.__aexit__(*exc_info)
+
+    async def _request(
+        self, method, path, params=None, json=None, idempotent=None, not_found=False
+    ):
+        """
+        Send a request to indexd and return the json of the response. None
+        values of a json object are left out, as indexclient does, since
+        indexd rejects null fields
+
+        Args:
+            not_found (bool): return None for a 404 instead of raising
+        """
+        if isinstance(json, dict):
+            json = {key: value for key, value in json.items() if value is not None}
+        if idempotent is None and _rev_guarded(method, params):
+            idempotent = False
+        url = f"{self.url}/{path}"
+        async with self._transport.aiohttp_session() as session:
+            async with await self._index._async_request(
+                session,
+                method,
+                url,
+                params=_query(params),
+                json=json,
+                idempotent=idempotent,
+            ) as response:
+                if not_found and response.status == 404:
+                    return None
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def _cached(self, key, lookup):
+        if self.record_cache is None:
+            return await lookup()
+
+        record = self.record_cache.get(key)
+        if record is None:
+            record = await lookup()
+            self.record_cache.put(key, record)
+        return record
+
+    ### Get Requests
+
+    async def is_healthy(self):
+        """
+
+        Return if indexd is healthy or not
+
+        """
+        try:
+            async with self._transport.aiohttp_session() as session:
+                async with await self._index._async_request(
+                    session, "GET", f"{self.url}/_status"
+                ) as response:
+                    response.raise_for_status()
+                    return await response.text() == "Healthy"
+        except Exception:
+            return False
+
+    async def get_version(self):
+        """
+
+        Return the version of indexd
+
+        """
+        return await self._request("GET", "_version")
+
+    async def get_stats(self):
+        """
+
+        Return basic info about the records in indexd
+
+        """
+        return await self._request("GET", "_stats")
+
+    async def get_all_records(
+        self, limit=None, paginate=False, start=None, compact=False
+    ):
+        """
+
+        Get a list of all records, see Gen3Index.get_all_records
+
+        """
+        records = RecordBatch() if compact else []
+        if paginate:
+            async for record in self.iter_records(page_size=limit, start=start):
+                records.append(record)
+        else:
+            records.extend(await self._get_records_after(start, limit) or [])
+        return records
+
+    async def iter_records(self, page_size=None, start=None, end=None, pages=False):
+        """
+
+        Iterate over all records in did order, following indexd's ``start``
+        cursor a page at a time, see Gen3Index.iter_records
+
+        Args:
+            page_size (int): number of records per page, indexd's default if None
+            start (str): only yield records with a did after this one
+            end (str): only yield records with a did up to and including this one
+            pages (bool): yield each page as a list instead of single records
+
+        Yields:
+            dict or List[dict]: indexd records, or pages of them
+
+        """
+        while True:
+            records = await self._get_records_after(start, page_size)
+            if not records or records[-1].get("did") == start:
+                return
+
+            start = records[-1].get("did")
+            finished = end is not None and start >= end
+            if end is not None:
+                records = [r for r in records if r.get("did") <= end]
+
+            if pages and records:
+                yield records
+            elif not pages:
+                for record in records:
+                    yield record
+
+            if finished:
+                return
+
+    async def get_shards(self, num_shards):
+        """
+
+        Split the did keyspace into ranges, see Gen3Index.get_shards
+
+        """
+        return _shards(await self._get_records_after(None, 1), num_shards)
+
+    async def scan_records(
+        self, num_shards=8, page_size=None, shards=None, ordered=False
+    ):
+        """
+
+        Iterate over all records like iter_records, scanning key ranges of the
+        index concurrently, see Gen3Index.scan_records
+
+        Args:
+            num_shards (int): number of key ranges to scan at once
+            page_size (int): number of records per page
+            shards (List[Tuple[str, str]]): key ranges to scan instead of
+                get_shards(num_shards)
+            ordered (bool): yield records in did order; otherwise records are
+                yielded as soon as any shard gets them
+
+        Yields:
+            dict: indexd records
+
+        """
+        shards = shards or await self.get_shards(num_shards)
+        if ordered:
+            queues = [asyncio.Queue(maxsize=2) for _ in shards]
+        else:
+            queues = [asyncio.Queue(maxsize=2 * len(shards))] * len(shards)
+
+        async def scan(shard, pages):
+            try:
+                async for page in self.iter_records(
+                    page_size, start=shard[0], end=shard[1], pages=True
+                ):
+                    await pages.put(page)
+                await pages.put(None)
+            except Exception as exc:
+                await pages.put(exc)
+
+        tasks = [
+            asyncio.ensure_future(scan(shard, pages))
+            for shard, pages in zip(shards, queues)
+        ]
+        try:
+            # one None per shard marks the end of its records
+            for pages in queues if ordered else [queues[0]]:
+                remaining = 1 if ordered else len(shards)
+                while remaining:
+                    page = await pages.get()
+                    if page is None:
+                        remaining -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        for record in page:
+                            yield record
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _get_records_after(self, start=None, limit=None):
+        response = await self._request(
+            "GET", "index/", params={"limit": limit, "start": start}
+        )
+        return response.get("records")
+
+    async def get_records_on_page(self, limit=None, page=None):
+        """
+
+        Get a list of all records given the page and page size limit
+
+        """
+        return await self._index.async_get_records_on_page(limit=limit, page=page)
+
+    async def get(self, guid, dist_resolution=True):
+        """
+
+        Get the metadata associated with the given id, alias, or
+        distributed identifier
+
+        Args:
+             guid: string
+                 - record id
+             dist_resolution: boolean
+                - *optional* Specify if we want distributed dist_resolution or not
+
+        """
+        params = None if dist_resolution else {"no_dist": ""}
+        return await self._cached(
+            ("get", guid, dist_resolution),
+            lambda: self._request("GET", guid, params=params, not_found=True),
+        )
+
+    async def get_guids_by_hash(
+        self, files, max_concurrency=DEFAULT_HASH_LOOKUP_WORKERS, mirror=None
+    ):
+        """
+
+        Find the records already indexed with the md5 and size of each file,
+        see Gen3Index.get_guids_by_hash
+
+        Args:
+            files (Iterable[Tuple[str, int]]): (md5, size) pairs; a size of None
+                matches any size
+            max_concurrency (int): number of lookups sent at once
+            mirror (Gen3IndexMirror): local mirror to look the pairs up in
+
+        Returns:
+            Dict[Tuple[str, int], List[str]]: for each distinct pair, the dids
+            of the records with that md5 and size, empty if there are none
+
+        """
+        pairs = _distinct_pairs(files)
+        if mirror is not None:
+            return _guids_in_mirror(mirror, pairs)
+
+        guids = {}
+        remaining = iter(pairs)
+
+        async def lookup():
+            for md5, size in remaining:
+                guids[(md5, size)] = await self._get_guids_by_hash(md5, size)
+
+        await asyncio.gather(*(lookup() for _ in range(max_concurrency)))
+        return {pair: guids[pair] for pair in pairs}
+
+    async def _get_guids_by_hash(self, md5, size):
+        dids = []
+        params = {"hash": f"md5:{md5}", "size": size, "limit": HASH_LOOKUP_PAGE_SIZE}
+        while True:
+            response = await self._request("GET", "index/", params=params)
+            records = response.get("records") or []
+            dids.extend(record["did"] for record in records)
+            if len(records) < HASH_LOOKUP_PAGE_SIZE:
+                return dids
+            params["start"] = records[-1]["did"]
+
+    async def get_urls(
+        self, size=None, hashes=None, guids=None, max_concurrency=DEFAULT_BULK_WORKERS
+    ):
+        """
+
+        Get a list of urls that match query params, see Gen3Index.get_urls
+
+        """
+        params = {"size": size, "hash": hashes}
+        if not guids:
+            return await self._get_urls(params)
+
+        url = self._index.client.url_for("urls")
+        max_length = MAX_URL_LENGTH - _urls_query_length(url, params)
+        chunks = _chunks_by_length(guids, max_length)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def get_chunk(chunk):
+            async with semaphore:
+                return await self._get_urls({**params, "ids": ",".join(chunk)})
+
+        results = await asyncio.gather(*(get_chunk(chunk) for chunk in chunks))
+        return [url for urls in results for url in urls]
+
+    async def _get_urls(self, params):
+        params = {**params, "limit": URLS_PAGE_SIZE, "start": 0}
+        urls = []
+        while True:
+            page = (await self._request("GET", "urls", params=params))["urls"]
+            urls.extend(url["url"] for url in page)
+            if len(page) < URLS_PAGE_SIZE:
+                return urls
+            params["start"] += len(page)
+
+    async def iter_urls(
+        self,
+        guids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_concurrency=DEFAULT_BULK_WORKERS,
+        ordered=True,
+    ):
+        """
+
+        Resolve the urls of many guids, streaming the results, see
+        Gen3Index.iter_urls
+
+        Yields:
+            Tuple[str, List[str]]: each guid and its urls, or None if it isn't
+            indexed
+
+        """
+        async for records, missing in self.get_records_in_batches(
+            guids,
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            ordered=ordered,
+        ):
+            for record in records:
+                yield record["did"], record.get("urls") or []
+            for guid in missing:
+                yield guid, None
+
+    async def get_record(self, guid):
+        """
+
+        Get the metadata associated with a given id
+
+        """
+        return await self._cached(
+            ("get_record", guid),
+            lambda: self._request("GET", f"index/{guid}", not_found=True),
+        )
+
+    async def get_with_params(self, params=None):
+        """
+
+        Return the first record matching the supplied parameters, such as
+        ``{'hashes': {'md5': '...'}, 'size': '...', 'metadata': {'file_state': '...'}}``,
+        see Gen3Index.get_with_params
+
+        """
+        params = dict(params or {})
+        query = {"limit": 1}
+        for param, name in [("hashes", "hash"), ("metadata", "metadata")]:
+            if param in params:
+                query[name] = [f"{k}:{v}" for k, v in params.pop(param).items()]
+        query.update(params)
+
+        response = await self._request("GET", "index", params=query, not_found=True)
+        if not response or not response.get("records"):
+            return None
+        return response["records"][0]
+
+    async def get_latest_version(self, guid, has_version=False):
+        """
+
+        Get the metadata of the latest index record version associated
+        with the given id
+
+        Args:
+            guid: string
+                - record id
+            has_version: boolean
+                - *optional* exclude entries without a version
+
+        """
+        return await self._cached(
+            ("get_latest_version", guid, has_version),
+            lambda: self._request(
+                "GET",
+                f"index/{guid}/latest",
+                params={"has_version": has_version},
+                not_found=True,
+            ),
+        )
+
+    async def get_versions(self, guid):
+        """
+
+        Get the metadata of index record version associated with the
+        given id
+
+        """
+        versions = await self._request("GET", f"index/{guid}/versions")
+        return [r for _, r in versions.items()]
+
+    async def get_records(self, dids):
+        """
+
+        Get a list of documents given a list of dids, see
+        Gen3Index.get_records
+
+        """
+        return (await self.bulk_get_records(dids))[0] or None
+
+    async def bulk_get_records(
+        self,
+        dids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_concurrency=DEFAULT_BULK_WORKERS,
+        compact=False,
+    ):
+        """
+
+        Get many records with concurrent bulk/documents requests, see
+        Gen3Index.bulk_get_records
+
+        Returns:
+            Tuple[List[dict], List[str]]: records found, in the order of the
+            dids, and the dids that were not found
+
+        """
+        return await self._index.async_bulk_get_records(
+            dids,
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            compact=compact,
+        )
+
+    def get_records_in_batches(
+        self,
+        dids,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_concurrency=DEFAULT_BULK_WORKERS,
+        ordered=True,
+    ):
+        """
+
+        Get many records a batch at a time, see
+        Gen3Index.get_records_in_batches
+
+        Yields:
+            Tuple[List[dict], List[str]]: for each batch, the records found and
+            the dids that were not found
+
+        """
+        return self._index.async_get_records_in_batches(
+            dids,
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            ordered=ordered,
+        )
+
+    ### Post Requests
+
+    async def create_record(
+        self,
+        hashes,
+        size,
+        did=None,
+        urls=None,
+        file_name=None,
+        metadata=None,
+        baseid=None,
+        acl=None,
+        urls_metadata=None,
+        version=None,
+        authz=None,
+        refetch=None,
+    ):
+        """
+
+        Create a new record and add it to the index, see
+        Gen3Index.create_record
+
+        Returns:
+            dict: the new record
+
+        """
+        json = {
+            "urls": urls or [],
+            "form": "object",
+            "hashes": hashes,
+            "size": size,
+            "file_name": file_name,
+            "metadata": metadata,
+            "urls_metadata": urls_metadata,
+            "baseid": baseid,
+            "acl": acl,
+            "authz": authz,
+            "version": version,
+        }
+        if did:
+            json["did"] = did
+        rec = await self._request("POST", "index/", json=json)
+        self._index._invalidate(rec["did"], baseid)
+        return await self._written_record(rec["did"], json, rec, refetch)
+
+    async def create_blank(self, uploader, file_name=None, refetch=None):
+        """
+
+        Create a blank record, see Gen3Index.create_blank
+
+        """
+        json = {"uploader": uploader, "file_name": file_name}
+        rec = await self._request("POST", "index/blank", json=json)
+        return await self._written_record(rec["did"], json, rec, refetch)
+
+    async def create_new_version(
+        self,
+        guid,
+        hashes,
+        size,
+        did=None,
+        urls=None,
+        file_name=None,
+        metadata=None,
+        acl=None,
+        urls_metadata=None,
+        version=None,
+        authz=None,
+        refetch=None,
+    ):
+        """
+
+        Add new version for the document associated to the provided uuid, see
+        Gen3Index.create_new_version
+
+        """
+        json = {
+            "urls": urls or [],
+            "form": "object",
+            "hashes": hashes,
+            "size": size,
+            "file_name": file_name,
+            "metadata": metadata,
+            "urls_metadata": urls_metadata,
+            "acl": acl,
+            "authz": authz,
+            "version": version,
+        }
+        if did:
+            json["did"] = did
+        rec = await self._request("POST", f"index/{guid}", json=json)
+        self._index._invalidate(guid, rec.get("baseid") if rec else None)
+
+        if rec and "did" in rec:
+            return await self._written_record(rec["did"], json, rec, refetch)
+        return None
+
+    async def bulk_upsert(
+        self,
+        records,
+        batch_size=DEFAULT_BULK_BATCH_SIZE,
+        max_concurrency=DEFAULT_WRITE_WORKERS,
+    ):
+        """
+
+        Create or update many records, see Gen3Index.bulk_upsert
+
+        Args:
+            records (Iterable[dict]): records with the fields of create_record
+            batch_size (int): number of records fetched at once
+            max_concurrency (int): number of writes sent at once
+
+        Returns:
+            List[dict]: for each record, in order, its ``did``, the ``result``
+            ("created", "updated", "unchanged" or "failed") and the ``error``
+            message of failed records
+
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def upsert(record, existing):
+            async with semaphore:
+                return await self._upsert(record, existing)
+
+        results = []
+        writing = None
+        try:
+            for batch in _batches(records, batch_size):
+                dids = [record["did"] for record in batch if record.get("did")]
+                found, _ = await self.bulk_get_records(dids) if dids else ([], [])
+                existing = {record["did"]: record for record in found}
+                batch_writes = asyncio.ensure_future(
+                    asyncio.gather(
+                        *(
+                            upsert(record, existing.get(record.get("did")))
+                            for record in batch
+                        )
+                    )
+                )
+                # the next batch is fetched while this one is written
+                if writing:
+                    results.extend(await writing)
+                writing = batch_writes
+
+            if writing:
+                results.extend(await writing)
+        finally:
+            if writing:
+                writing.cancel()
+        return results
+
+    async def _upsert(self, record, existing):
+        did = record.get("did")
+        try:
+            if existing is None:
+                rec = await self._request(
+                    "POST", "index/", json={"form": "object", "urls": [], **record}
+                )
+                self._index._invalidate(rec["did"], rec.get("baseid"))
+                return {"did": rec["did"], "result": "created", "error": None}
+
+            changes = _record_changes(existing, record)
+            if not changes:
+                return {"did": did, "result": "unchanged", "error": None}
+            try:
+                await self._update(existing, changes)
+            except aiohttp.ClientResponseError as exception:
+                if exception.status != 409:
+                    raise
+                # the record changed since it was fetched, compare it again
+                existing = await self._request("GET", f"index/{did}")
+                changes = _record_changes(existing, record)
+                if not changes:
+                    return {"did": did, "result": "unchanged", "error": None}
+                await self._update(existing, changes)
+            return {"did": did, "result": "updated", "error": None}
+        except Exception as exception:
+            logging.error(f"failed to create or update record {did}: {exception}")
+            return {"did": did, "result": "failed", "error": str(exception)}
+
+    async def _update(self, existing, changes):
+        await self._request(
+            "PUT",
+            f"index/{existing['did']}",
+            params={"rev": existing["rev"]},
+            json=changes,
+        )
+        self._index._invalidate(existing["did"], existing.get("baseid"))
+
+    ### Put Requests
+
+    async def update_blank(self, guid, rev, hashes, size, refetch=None):
+        """
+
+        Update only hashes and size for a blank index, see
+        Gen3Index.update_blank
+
+        """
+        json = {"hashes": hashes, "size": size}
+        rec = await self._request(
+            "PUT", f"index/blank/{guid}", params={"rev": rev}, json=json
+        )
+        self._index._invalidate(rec["did"], rec.get("baseid"))
+        return await self._written_record(rec["did"], json, rec, refetch)
+
+    async def update_record(
+        self,
+        guid,
+        file_name=None,
+        urls=None,
+        version=None,
+        metadata=None,
+        acl=None,
+        authz=None,
+        urls_metadata=None,
+        rev=None,
+        refetch=None,
+    ):
+        """
+
+        Update an existing entry in the index, see Gen3Index.update_record.
+        With the rev of the record, the update is a single request.
+
+        """
+        updatable_attrs = {
+            "file_name": file_name,
+            "urls": urls,
+            "version": version,
+            "metadata": metadata,
+            "acl": acl,
+            "authz": authz,
+            "urls_metadata": urls_metadata,
+        }
+        changes = {k: v for k, v in updatable_attrs.items() if v is not None}
+        record = {}
+        if rev is None:
+            record = await self._request("GET", f"index/{guid}")
+            rev = record["rev"]
+
+        rec = await self._request(
+            "PUT", f"index/{guid}", params={"rev": rev}, json=changes
+        )
+        self._index._invalidate(guid, rec.get("baseid"))
+        return await self._written_record(guid, {**record, **changes}, rec, refetch)
+
+    async def _written_record(self, guid, sent, response, refetch=None):
+        if refetch is None:
+            refetch = self.refetch
+        if refetch:
+            return await self.get_record(guid)
+        return {**sent, **response}
+
+    ### Delete Requests
+
+    async def delete_record(self, guid, rev=None):
+        """
+
+        Delete an entry from the index
+
+        Args:
+            guid: string
+                 - record id
+            rev: string
+                 - *optional* rev of the record, to delete it without fetching
+                   it first; the delete fails with a 409 error if the record
+                   changed since
+
+        Returns:
+            dict: the deleted record, or None when it wasn't fetched
+
+        """
+        record = None
+        if rev is None:
+            record = await self._request("GET", f"index/{guid}")
+            rev = record["rev"]
+
+        await self._request("DELETE", f"index/{guid}", params={"rev": rev})
+        self._index._invalidate(guid, record.get("baseid") if record else None)
+        return record
+
+
+def _batches(items, size):
+    """
+    Split an iterable into lists of at most size items, lazily
+    """
+    items = iter(items)
+    batch = list(itertools.islice(items, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(items, size))
+
+
+def _shards(first, num_shards):
+    """
+    Key ranges of get_shards, given the first page of records of the index
+    """
+    prefix = ""
+    if first:
+        did = first[0].get("did")
+        prefix = did[: did.rfind("/") + 1]
+
+    num_shards = min(max(1, num_shards), 0x10000)
+    cuts = [
+        prefix + format(shard * 0x10000 // num_shards, "04x")
+        for shard in range(1, num_shards)
+    ]
+    bounds = [None] + cuts + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _query(params):
+    """
+    Query parameters for aiohttp, which takes neither None nor bool values:
+    None values are left out, lists repeat the parameter, bools are sent as
+    "true" or "false" and other values as strings
+    """
+    if not params:
+        return None
+    query = []
+    for key, value in params.items():
+        if value is None:
+            continue
+        for item in value if isinstance(value, list) else [value]:
+            if isinstance(item, bool):
+                item = "true" if item else "false"
+            query.append((key, str(item)))
+    return query
+
+
+def _rev_guarded(method, params):
+    """
+    Whether a request is a write that indexd only accepts for the current rev
+    of the record. Sent again after it was processed, such a write fails with
+    a 409 rev conflict although it succeeded, so it isn't idempotent.
+    """
+    return method.upper() in ("PUT", "DELETE") and "rev" in (params or {})
+
+
+def _urls_query_length(url, params):
+    """
+    Length of a /urls request url before its ids, counting the paging
+    parameters with the longest start offset
+    """
+    query = {k: v for k, v in params.items() if v is not None}
+    query.update(limit=URLS_PAGE_SIZE, start=sys.maxsize)
+    return len(url) + len("?") + len(urllib.parse.urlencode(query))
+
+
+def _chunks_by_length(guids, max_length):
+    """
+    Split guids into lists whose url encoded, comma separated ids parameter
+    fits in max_length characters, lazily
+    """
+    chunk = []
+    length = len("&ids=")
+    for guid in guids:
+        guid_length = len(urllib.parse.quote(guid, safe="")) + len("%2C")
+        if chunk and length + guid_length > max_length:
+            yield chunk
+            chunk = []
+            length = len("&ids=")
+        chunk.append(guid)
+        length += guid_length
+    if chunk:
+        yield chunk
+
+
+def _distinct_pairs(files):
+    """
+    Distinct (md5, size) pairs, in the order they first appear
+    """
+    return list(dict.fromkeys((md5, size) for md5, size in files))
+
+
+def _guids_in_mirror(mirror, pairs):
+    return {
+        (md5, size): [record["did"] for record in mirror.find(md5=md5, size=size)]
+        for md5, size in pairs
+    }
+
+
+def _in_did_order(records, name):
+    """
+    Yield the records, checking that they are in did order
+    """
+    last = None
+    for record in records:
+        if last is not None and record["did"] <= last:
+            raise ValueError(f"{name} isn't in did order at {record['did']}")
+        last = record["did"]
+        yield record
+
+
+def _match_records(dids, records):
+    """
+    Order the records returned for a batch of dids like the dids
+
+    Returns:
+        Tuple[List[dict], List[str]]: records found and dids not found
+    """
+    records_by_did = {record.get("did"): record for record in records}
+    found = []
+    missing = []
+    for did in dids:
+        if did in records_by_did:
+            found.append(records_by_did[did])
+        else:
+            missing.append(did)
+    return found, missing
+
+
+def _record_changes(existing, record):
+    """
+    Updatable fields of record that differ from the existing record
+
+    Raises:
+        ValueError: the hashes or size differ, which needs a new version
+    """
+    existing_hashes = existing.get("hashes") or {}
+    for hash_type, value in (record.get("hashes") or {}).items():
+        if existing_hashes.get(hash_type) != value:
+            raise ValueError(f"{hash_type} hash differs from the indexed one")
+    if record.get("size") is not None and record["size"] != existing.get("size"):
+        raise ValueError("size differs from the indexed one")
+
+    return {
+        field: record[field]
+        for field in UPDATABLE_FIELDS
+        if record.get(field) is not None
+        and _recursive_sort(record[field]) != _recursive_sort(existing.get(field))
+    }
+
+
+def _recursive_sort(value):
+    """
+    value with all its lists sorted, recursively, so that values with the same
+    contents in a different order compare equal. Items are sorted by their
+    json, since lists can mix types or hold dicts, which don't compare
+    """
+    if isinstance(value, dict):
+        return {key: _recursive_sort(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return sorted(
+            (_recursive_sort(item) for item in value),
+            key=lambda item: json.dumps(item, sort_keys=True),
+        )
+    return value
+
+
+def _put_unless_stopped(items, item, stop):
+    """
+    Put an item in a bounded queue unless stop gets set while waiting for room
+
+    Returns:
+        bool: whether the item was put
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class _IndexClient(client.IndexClient):
+    """
+    indexclient's IndexClient, sending its requests through a Gen3Transport
+    instead of the module level requests functions so connections are reused.
+    Writes guarded by a rev aren't retried once they may have been processed,
+    see _rev_guarded.
+    """
+
+    def __init__(self, baseurl, transport, version="v0", auth=None):
+        super().__init__(baseurl, version=version, auth=auth)
+        self.transport = transport
+
+    def _request(self, method, *path, **kwargs):
+        if _rev_guarded(method, kwargs.get("params")):
+            kwargs.setdefault("idempotent", False)
+        resp = self.transport.request(method, self.url_for(*path), **kwargs)
+        client.handle_error(resp)
+        return resp
+
+    def _get(self, *path, **kwargs):
+        return self._request("GET", *path, **kwargs)
+
+    def _post(self, *path, **kwargs):
+        return self._request("POST", *path, **kwargs)
 
+    def _put(self, *path, **kwargs):
+        return self._request("PUT", *path, **kwargs)
 
-def _print_kwargs(kwargs):
-    return ", ".join("{}={}".format(k, repr(v)) for k, v in list(kwargs.items()))
+    def _delete(self, *path, **kwargs):
+        return self._request("DELETE", *path, **kwargs)
@@ -0,0 +1,334 @@
+"""
+Local SQLite mirror of the records of an indexd instance.
+
+Jobs that only need to know what is in indexd can query a mirror on disk
+instead of going over the whole index again. The mirror is filled by scanning
+indexd (see Gen3Index.scan_records) and kept up to date by syncing it again:
+a sync compares the ``rev`` of every listed record with the stored one and
+only writes the records that were added or changed, then drops the records
+that are gone from indexd.
+
+indexd can't list records by ``updated_date``, so a sync still lists the whole
+index, only much faster than a manifest download since the shards are scanned
+concurrently and unchanged records aren't written. Records written by the job
+itself can be refreshed right away by guid with ``refresh``.
+"""
+import datetime
+import json
+import logging
+import sqlite3
+
+from gen3.index import DEFAULT_BULK_BATCH_SIZE, _batches
+
+# records written to the mirror per transaction during a sync
+SYNC_BATCH_SIZE = 1000
+# sqlite limits the number of parameters of a statement
+_MAX_PARAMS = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    did TEXT PRIMARY KEY,
+    rev TEXT,
+    baseid TEXT,
+    md5 TEXT,
+    size INTEGER,
+    updated_date TEXT,
+    record TEXT NOT NULL,
+    sync_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_md5 ON records (md5);
+CREATE INDEX IF NOT EXISTS records_size ON records (size);
+CREATE TABLE IF NOT EXISTS record_authz (
+    did TEXT NOT NULL,
+    authz TEXT NOT NULL,
+    PRIMARY KEY (did, authz)
+);
+CREATE INDEX IF NOT EXISTS record_authz_authz ON record_authz (authz);
+CREATE TABLE IF NOT EXISTS syncs (
+    sync_id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    added INTEGER,
+    updated INTEGER,
+    unchanged INTEGER,
+    deleted INTEGER
+);
+"""
+
+
+class Gen3IndexMirror:
+    """
+    Local copy of the records of indexd in a SQLite database, indexed by guid,
+    md5, size and authz.
+
+    A mirror uses one SQLite connection, so use it from one thread at a time;
+    other processes can read the same file while it syncs.
+
+    Args:
+        path (str): path of the database file, created if it doesn't exist
+        index (Gen3Index): indexd client to sync from; only needed to sync
+
+    Examples:
+        Syncing a mirror every night and querying it in the jobs of the day.
+
+        >>> mirror = Gen3IndexMirror("indexd.sqlite", Gen3Index(endpoint, auth))
+        ... mirror.sync(num_shards=16, page_size=1024)
+        {'added': 12, 'updated': 3, 'unchanged': 2500000, 'deleted': 1}
+
+        >>> with Gen3IndexMirror("indexd.sqlite") as mirror:
+        ...     duplicates = mirror.find(md5=md5, size=size)
+
+    """
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self._db.close()
+
+    def sync(self, num_shards=8, page_size=None):
+        """
+        Bring the mirror up to date with indexd.
+
+        Lists every record of indexd, writes the ones whose rev differs from
+        the mirror's and deletes the ones indexd doesn't list anymore. Changes
+        are committed as they are found, and records are only deleted once the
+        whole index was listed, so an interrupted sync can just be run again.
+
+        Args:
+            num_shards (int): number of key ranges of the index to scan at once
+            page_size (int): number of records per page
+
+        Returns:
+            dict: number of records added, updated, unchanged and deleted
+        """
+        if self.index is None:
+            raise ValueError("a Gen3Index is needed to sync the mirror")
+
+        with self._db:
+            sync_id = self._db.execute(
+                "INSERT INTO syncs (started_at) VALUES (?)", (_now(),)
+            ).lastrowid
+        counts = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+
+        batch = []
+        records = self.index.scan_records(num_shards=num_shards, page_size=page_size)
+        for record in records:
+            batch.append(record)
+            if len(batch) >= SYNC_BATCH_SIZE:
+                self._write(batch, sync_id, counts)
+                batch = []
+        self._write(batch, sync_id, counts)
+
+        with self._db:
+            stale = "SELECT did FROM records WHERE sync_id < ?"
+            self._db.execute(
+                f"DELETE FROM record_authz WHERE did IN ({stale})", (sync_id,)
+            )
+            counts["deleted"] = self._db.execute(
+                "DELETE FROM records WHERE sync_id < ?", (sync_id,)
+            ).rowcount
+            self._db.execute(
+                "UPDATE syncs SET finished_at = ?, added = ?, updated = ?, "
+                "unchanged = ?, deleted = ? WHERE sync_id = ?",
+                (
+                    _now(),
+                    counts["added"],
+                    counts["updated"],
+                    counts["unchanged"],
+                    counts["deleted"],
+                    sync_id,
+                ),
+            )
+
+        logging.info(f"synced indexd mirror {self.path}: {counts}")
+        return counts
+
+    def refresh(self, guids, batch_size=DEFAULT_BULK_BATCH_SIZE):
+        """
+        Update the given records from indexd without a full sync, for instance
+        after the job created or updated them. Records indexd doesn't have
+        anymore are deleted.
+
+        Args:
+            guids (List[str]): record ids
+            batch_size (int): number of records requested at once
+        """
+        if self.index is None:
+            raise ValueError("a Gen3Index is needed to refresh the mirror")
+
+        sync_id = self._last_sync_id()
+        for records, missing in self.index.get_records_in_batches(
+            guids, batch_size=batch_size
+        ):
+            self._write(records, sync_id, {"added": 0, "updated": 0, "unchanged": 0})
+            with self._db:
+                for chunk in _batches(missing, _MAX_PARAMS):
+                    self._delete(chunk)
+
+    def get(self, guid):
+        """
+        Get a record
+
+        Args:
+            guid (str): record id
+
+        Returns:
+            dict: the indexd record, or None if the mirror doesn't have it
+        """
+        row = self._db.execute(
+            "SELECT record FROM records WHERE did = ?", (guid,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find(self, md5=None, size=None, authz=None):
+        """
+        Find the records matching all of the given fields
+
+        Args:
+            md5 (str): md5 hash
+            size (int): file size
+            authz (str): one of the record's authz resources
+
+        Returns:
+            List[dict]: matching indexd records, in did order
+        """
+        conditions = []
+        params = []
+        if md5 is not None:
+            conditions.append("md5 = ?")
+            params.append(md5)
+        if size is not None:
+            conditions.append("size = ?")
+            params.append(size)
+        if authz is not None:
+            conditions.append("did IN (SELECT did FROM record_authz WHERE authz = ?)")
+            params.append(authz)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        rows = self._db.execute(
+            f"SELECT record FROM records {where} ORDER BY did", params
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def iter_records(self):
+        """
+        Iterate over all the records of the mirror in did order
+
+        Yields:
+            dict: indexd records
+        """
+        for (record,) in self._db.execute("SELECT record FROM records ORDER BY did"):
+            yield json.loads(record)
+
+    def last_sync(self):
+        """
+        Summary of the last complete sync
+
+        Returns:
+            dict: started_at and finished_at as UTC ISO timestamps and the
+            number of records added, updated, unchanged and deleted; None if
+            the mirror was never synced
+        """
+        cursor = self._db.execute(
+            "SELECT * FROM syncs WHERE finished_at IS NOT NULL "
+            "ORDER BY sync_id DESC LIMIT 1"
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return {
+            column[0]: value
+            for column, value in zip(cursor.description, row)
+            if column[0] != "sync_id"
+        }
+
+    def _last_sync_id(self):
+        row = self._db.execute("SELECT MAX(sync_id) FROM syncs").fetchone()
+        return row[0] or 0
+
+    def _write(self, records, sync_id, counts):
+        """
+        Write the records that changed and mark all of them as seen by the sync
+        """
+        revs = {}
+        for chunk in _batches([record["did"] for record in records], _MAX_PARAMS):
+            revs.update(
+                self._db.execute(
+                    "SELECT did, rev FROM records WHERE did IN "
+                    f"({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+
+        changed = []
+        unchanged = []
+        for record in records:
+            if record["did"] not in revs:
+                counts["added"] += 1
+                changed.append(record)
+            elif revs[record["did"]] != record.get("rev"):
+                counts["updated"] += 1
+                changed.append(record)
+            else:
+                counts["unchanged"] += 1
+                unchanged.append((sync_id, record["did"]))
+
+        with self._db:
+            self._db.executemany(
+                "UPDATE records SET sync_id = ? WHERE did = ?", unchanged
+            )
+            for chunk in _batches([record["did"] for record in changed], _MAX_PARAMS):
+                self._delete(chunk)
+            self._db.executemany(
+                "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        record["did"],
+                        record.get("rev"),
+                        record.get("baseid"),
+                        (record.get("hashes") or {}).get("md5"),
+                        record.get("size"),
+                        record.get("updated_date"),
+                        json.dumps(record),
+                        sync_id,
+                    )
+                    for record in changed
+                ],
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO record_authz VALUES (?, ?)",
+                [
+                    (record["did"], authz)
+                    for record in changed
+                    for authz in record.get("authz") or []
+                ],
+            )
+
+    def _delete(self, dids):
+        if not dids:
+            return
+        placeholders = ",".join("?" * len(dids))
+        self._db.execute(
+            f"DELETE FROM record_authz WHERE did IN ({placeholders})", dids
+        )
+        self._db.execute(f"DELETE FROM records WHERE did IN ({placeholders})", dids)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -0,0 +1,113 @@
+"""
+Client-side request rate limiting.
+
+A RateLimiter is a token bucket: requests may be sent at ``rate`` per second on
+average, with bursts of up to ``burst`` requests. It is implemented as the
+equivalent generic cell rate algorithm, which only has to remember when the
+next request is allowed. That single timestamp can live in a file, so
+processes that use the same ``state_file`` share one budget.
+
+Give a RateLimiter to a Gen3Transport to limit every request sent through it.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from gen3.utils import file_lock
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared by threads, coroutines and, with a
+    ``state_file``, processes.
+
+    ``acquire`` blocks the calling thread and ``async_acquire`` suspends the
+    calling coroutine until a request is allowed. A caller reserves its slot
+    immediately and then waits for it, so waiters are served in order and
+    don't poll.
+
+    Args:
+        rate (float): allowed requests per second
+        burst (int): number of requests that may be sent at once after the
+            limiter was idle
+        state_file (str): optional path of a file holding the limiter's state,
+            shared by all processes using the same path
+
+    Examples:
+        Limiting all indexd and sheepdog requests of this process and of any
+        other process using the same file to 50 per second.
+
+        >>> limiter = RateLimiter(50, state_file="/tmp/indexd-rate")
+        ... transport = Gen3Transport(rate_limiter=limiter)
+        ... index = Gen3Index(endpoint, auth, transport=transport)
+        ... sub = Gen3Submission(endpoint, auth, transport=transport)
+
+    """
+
+    def __init__(self, rate, burst=1, state_file=None):
+        if rate <= 0:
+            raise ValueError("rate must be a positive number of requests per second")
+
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.state_file = state_file
+        self._interval = 1.0 / rate
+        self._tolerance = (self.burst - 1) * self._interval
+        self._lock = threading.Lock()
+        # earliest time the next request conforms to the rate, like a bucket
+        # that is full when this is in the past
+        self._next_allowed = 0.0
+
+    def acquire(self):
+        """
+        Wait until a request may be sent
+        """
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def async_acquire(self):
+        """
+        Wait until a request may be sent, without blocking the event loop
+        """
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _reserve(self):
+        """
+        Reserve the next slot and return how many seconds to wait for it
+        """
+        with self._lock:
+            if not self.state_file:
+                delay, self._next_allowed = self._schedule(self._next_allowed)
+                return delay
+
+            with file_lock(self.state_file + ".lock"):
+                delay, next_allowed = self._schedule(self._read_state())
+                self._write_state(next_allowed)
+            return delay
+
+    def _schedule(self, next_allowed):
+        now = time.time()
+        start = max(next_allowed, now)
+        delay = max(0.0, start - self._tolerance - now)
+        return delay, start + self._interval
+
+    def _read_state(self):
+        try:
+            with open(self.state_file) as state:
+                return float(state.read() or 0)
+        except FileNotFoundError:
+            return 0.0
+        except ValueError:
+            logging.warning(
+                f"resetting unreadable rate limiter state {self.state_file}"
+            )
+            return 0.0
+
+    def _write_state(self, next_allowed):
+        with open(self.state_file, "w") as state:
+            state.write(repr(next_allowed))
@@ -0,0 +1,199 @@
+"""
+In-memory cache of indexd records.
+
+Pipelines tend to look up the same GUIDs in several stages, and without a
+cache every lookup is a request to indexd. A RecordCache keeps the records
+returned by Gen3Index lookups for ``ttl`` seconds, evicting the least recently
+used ones past ``max_size``. Records keep their ``rev``, and the Gen3Index
+write methods drop the entries they make stale, so within a job a cached
+record is the one indexd would return.
+
+Writes by other clients are only seen once the ttl expires.
+
+Attributes:
+    DEFAULT_MAX_SIZE (int): records kept by default
+    DEFAULT_TTL (float): seconds a record is kept by default
+"""
+import collections
+import copy
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 300
+
+
+class RecordCache:
+    """
+    TTL and LRU bounded cache of indexd records, shared by threads.
+
+    Entries are keyed by the lookup that returned them, like
+    ``("get_record", guid)``, since an alias or a latest version lookup for a
+    GUID returns another record than a plain get. Records that were not found
+    are not cached.
+
+    Args:
+        max_size (int): maximum number of records kept
+        ttl (float): seconds a record is kept; None to keep records until they
+            are evicted or invalidated
+
+    Examples:
+        Sharing a cache between the stages of a job.
+
+        >>> cache = RecordCache(max_size=100000, ttl=600)
+        ... index = Gen3Index(endpoint, auth, record_cache=cache)
+        ... ...
+        ... logging.info(f"record cache: {cache.stats()}")
+
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        # guid, did and baseid -> keys of the entries to drop on writes
+        self._keys_by_id = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get a cached record
+
+        Args:
+            key (tuple): lookup name followed by its arguments, the GUID first
+
+        Returns:
+            dict: a copy of the record, or None if it is not cached or expired
+        """
+        with self._lock:
+            record = self._live_record(key)
+            if record is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return copy.deepcopy(record)
+
+    def put(self, key, record):
+        """
+        Cache the record returned by a lookup
+
+        Args:
+            key (tuple): lookup name followed by its arguments, the GUID first
+            record (dict): indexd record
+        """
+        if not record:
+            return
+
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (copy.deepcopy(record), expires)
+            for id_ in _ids(key, record):
+                self._keys_by_id[id_].add(key)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def rev(self, guid):
+        """
+        Revision of the cached record of a GUID. Not counted as a lookup in
+        the stats, since it's a check before a write rather than a read
+
+        Args:
+            guid (str): record id
+
+        Returns:
+            str: rev of the record, or None if it is not cached
+        """
+        with self._lock:
+            record = self._live_record(("get_record", guid))
+            return record.get("rev") if record else None
+
+    def invalidate(self, guid, baseid=None):
+        """
+        Drop the entries for a GUID that was written, and with a baseid, the
+        entries of every version of the record
+
+        Args:
+            guid (str): record id
+            baseid (str): baseid shared by the versions of the record
+        """
+        with self._lock:
+            keys = set(self._keys_by_id.get(guid, ()))
+            baseids = {baseid} if baseid else set()
+            baseids.update(
+                self._entries[key][0].get("baseid")
+                for key in keys
+                if key in self._entries
+            )
+            for id_ in baseids:
+                keys.update(self._keys_by_id.get(id_, ()))
+
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        """
+        Drop every entry
+        """
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+
+    def stats(self):
+        """
+        Hit and miss counts of the cache
+
+        Returns:
+            dict: hits, misses, hit_rate, evictions and size
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+    def _live_record(self, key):
+        """
+        Record of an entry that hasn't expired, or None; drops expired entries
+        """
+        entry = self._entries.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            self._remove(key)
+            entry = None
+        return entry[0] if entry else None
+
+    def _remove(self, key):
+        record, _ = self._entries.pop(key)
+        for id_ in _ids(key, record):
+            keys = self._keys_by_id.get(id_)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_id[id_]
+
+
+def _ids(key, record):
+    """
+    Ids an entry is invalidated by: the GUID it was looked up with, and the
+    did and baseid of the record
+    """
+    return {id_ for id_ in (key[1], record.get("did"), record.get("baseid")) if id_}
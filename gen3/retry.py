@@ -0,0 +1,288 @@
+"""
+Retrying failed requests.
+
+A RetryPolicy decides whether a failed request is sent again and how long to
+wait first. Only failures that are likely to be transient are retried (429,
+5xx gateway errors, dropped connections, timeouts), and only when sending the
+request again is safe: requests that are idempotent by their method or
+declared idempotent by the caller, or requests that the server can't have
+processed (a 429, or a connection that was never established). Waits follow
+the server's ``Retry-After`` header when there is one and use decorrelated
+jitter otherwise, and all the attempts of a call have to fit in a deadline.
+
+Attributes:
+    IDEMPOTENT_METHODS (frozenset): HTTP methods that are safe to send again
+    RETRY_STATUSES (frozenset): HTTP statuses that are retried by default
+    DEFAULT_MAX_TRIES (int): attempts per call, including the first one
+    DEFAULT_BASE_DELAY (float): seconds to wait before the first retry, at least
+    DEFAULT_MAX_DELAY (float): longest wait between two attempts in seconds
+    DEFAULT_DEADLINE (float): seconds all the attempts of a call have to fit in
+"""
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import time
+
+import aiohttp
+import requests
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+DEFAULT_MAX_TRIES = 3
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+DEFAULT_DEADLINE = 120
+
+# the request never reached the server, so any method can be sent again
+_NOT_SENT_ERRORS = (requests.exceptions.ConnectTimeout, aiohttp.ClientConnectorError)
+# the request may or may not have been processed
+_TRANSIENT_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+class RetryPolicy:
+    """
+    Classifies request failures and schedules the retries of a call.
+
+    ``call`` and ``async_call`` send a request through a function that returns
+    a ``requests`` or ``aiohttp`` response and send it again while the policy
+    allows it. The last response is returned as is, so the caller still checks
+    its status; exceptions are raised once they can't be retried.
+
+    Args:
+        max_tries (int): attempts per call, including the first one; 1 disables
+            retries
+        base_delay (float): seconds to wait before the first retry, at least
+        max_delay (float): longest wait between two attempts in seconds. A
+            ``Retry-After`` asking for longer ends the call.
+        deadline (float): seconds all the attempts of a call have to fit in
+        retry_statuses (Iterable[int]): HTTP statuses to retry
+
+    Examples:
+        Giving indexd bulk jobs more room to ride out a restart.
+
+        >>> policy = RetryPolicy(max_tries=8, max_delay=60, deadline=600)
+        ... index = Gen3Index(endpoint, auth, transport=Gen3Transport(retry_policy=policy))
+
+    """
+
+    def __init__(
+        self,
+        max_tries=DEFAULT_MAX_TRIES,
+        base_delay=DEFAULT_BASE_DELAY,
+        max_delay=DEFAULT_MAX_DELAY,
+        deadline=DEFAULT_DEADLINE,
+        retry_statuses=RETRY_STATUSES,
+    ):
+        self.max_tries = max(1, max_tries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def copy(self, **changes):
+        """
+        Return a policy with the same settings except for the given ones
+        """
+        settings = {
+            "max_tries": self.max_tries,
+            "base_delay": self.base_delay,
+            "max_delay": self.max_delay,
+            "deadline": self.deadline,
+            "retry_statuses": self.retry_statuses,
+        }
+        settings.update(changes)
+        return RetryPolicy(**settings)
+
+    def should_retry(self, method, status=None, exc=None, idempotent=None):
+        """
+        Whether a request that got the given status or raised the given
+        exception may be sent again, ignoring the attempts left.
+
+        Args:
+            method (str): HTTP method of the request
+            status (int): HTTP status of the response
+            exc (Exception): exception raised while sending the request
+            idempotent (bool): whether the request is safe to send again after
+                it may have been processed; by default derived from the method
+
+        Returns:
+            bool: True if the failure is transient and a retry is safe
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if status is not None:
+            if status not in self.retry_statuses:
+                return False
+            # a 429 is rejected before the request is processed
+            return idempotent or status == 429
+        if isinstance(exc, _NOT_SENT_ERRORS):
+            return True
+        return idempotent and isinstance(exc, _TRANSIENT_ERRORS)
+
+    def call(self, send, method, url="", idempotent=None):
+        """
+        Send a request and retry it while the policy allows it.
+
+        Args:
+            send (Callable[[], requests.Response]): sends the request once
+            method (str): HTTP method of the request
+            url (str): url of the request, for log messages
+            idempotent (bool): see should_retry
+
+        Returns:
+            requests.Response: the last response
+        """
+        attempts = _Attempts(self, method, url, idempotent)
+        while True:
+            try:
+                response = send()
+            except Exception as exc:
+                delay = attempts.retry_delay(exc=exc)
+                if delay is None:
+                    raise
+            else:
+                delay = attempts.retry_delay(response=response)
+                if delay is None:
+                    return response
+                _release(response)
+            time.sleep(delay)
+
+    async def async_call(self, send, method, url="", idempotent=None):
+        """
+        Asynchronous version of call.
+
+        Args:
+            send (Callable[[], Awaitable[aiohttp.ClientResponse]]): sends the
+                request once
+            method (str): HTTP method of the request
+            url (str): url of the request, for log messages
+            idempotent (bool): see should_retry
+
+        Returns:
+            aiohttp.ClientResponse: the last response
+        """
+        attempts = _Attempts(self, method, url, idempotent)
+        while True:
+            try:
+                response = await send()
+            except Exception as exc:
+                delay = attempts.retry_delay(exc=exc)
+                if delay is None:
+                    raise
+            else:
+                delay = attempts.retry_delay(response=response)
+                if delay is None:
+                    return response
+                _release(response)
+            await asyncio.sleep(delay)
+
+
+class _Attempts:
+    """
+    State of the retries of one call
+    """
+
+    def __init__(self, policy, method, url, idempotent):
+        self.policy = policy
+        self.method = method
+        self.url = url
+        self.idempotent = idempotent
+        self.tries = 0
+        self.started = time.monotonic()
+        self.delay = policy.base_delay
+
+    def retry_delay(self, response=None, exc=None):
+        """
+        Seconds to wait before the next attempt, or None to stop
+        """
+        self.tries += 1
+        retry_after = None
+        if response is not None:
+            status = _status(response)
+            if not self.policy.should_retry(
+                self.method, status=status, idempotent=self.idempotent
+            ):
+                return None
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            reason = f"HTTP {status}"
+        else:
+            if not self.policy.should_retry(
+                self.method, exc=exc, idempotent=self.idempotent
+            ):
+                return None
+            reason = repr(exc)
+
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            # decorrelated jitter
+            self.delay = min(
+                self.policy.max_delay,
+                random.uniform(self.policy.base_delay, self.delay * 3),
+            )
+            delay = self.delay
+
+        elapsed = time.monotonic() - self.started
+        if self.tries >= self.policy.max_tries:
+            give_up = f"after {self.tries} tries"
+        elif delay > self.policy.max_delay:
+            give_up = f"server asked to wait {delay:.1f} seconds"
+        elif elapsed + delay > self.policy.deadline:
+            give_up = f"{self.policy.deadline} second deadline would pass"
+        else:
+            logging.warning(
+                f"retry: {self.method} {self.url} in {delay:.1f} seconds after "
+                f"{self.tries} tries ({reason})"
+            )
+            return delay
+
+        logging.error(f"retry: gave up {self.method} {self.url}, {give_up} ({reason})")
+        return None
+
+
+def parse_retry_after(value):
+    """
+    Parse a ``Retry-After`` header, given in seconds or as an HTTP date.
+
+    Args:
+        value (str): header value
+
+    Returns:
+        float: seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def _status(response):
+    status = getattr(response, "status_code", None)
+    if status is None:
+        status = getattr(response, "status", None)
+    return status
+
+
+def _release(response):
+    # free the connection of a response that is thrown away
+    if hasattr(response, "release"):
+        response.release()
+    else:
+        response.close()
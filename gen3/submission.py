@@ -3,6 +3,8 @@ import requests
 import pandas as pd
 import os
 
+from gen3.transport import Gen3Transport
+
 
 class Gen3Error(Exception):
     pass
@@ -26,6 +28,12 @@ class Gen3Submission:
     Args:
         endpoint (str): The URL of the data commons.
         auth_provider (Gen3Auth): A Gen3Auth class instance.
+        transport (Gen3Transport): Optional HTTP transport to share pooled
+            connections with other clients. One is created if not provided.
+        timeout (float or tuple): Optional timeout of the requests in seconds,
+            either one value or a (connect, read) tuple. None, the default,
+            waits as long as the service takes, which long exports and large
+            submissions can need, whatever the transport's default.
 
     Examples:
         This generates the Gen3Submission class pointed at the sandbox commons while
@@ -37,9 +45,11 @@ class Gen3Submission:
 
     """
 
-    def __init__(self, endpoint, auth_provider):
+    def __init__(self, endpoint, auth_provider, transport=None, timeout=None):
         self._auth_provider = auth_provider
         self._endpoint = endpoint
+        self._transport = transport or Gen3Transport()
+        self._timeout = timeout
 
     def __export_file(self, filename, output):
         """Writes an API response to a file.
@@ -56,7 +66,9 @@ class Gen3Submission:
 
         """
         api_url = f"{self._endpoint}/api/v0/submission/"
-        output = requests.get(api_url, auth=self._auth_provider)
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -71,7 +83,9 @@ class Gen3Submission:
             >>> Gen3Submission.create_program(json)
         """
         api_url = "{}/api/v0/submission/".format(self._endpoint)
-        output = requests.post(api_url, auth=self._auth_provider, json=json)
+        output = self._transport.post(
+            api_url, auth=self._auth_provider, json=json, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -90,7 +104,9 @@ class Gen3Submission:
 
         """
         api_url = "{}/api/v0/submission/{}".format(self._endpoint, program)
-        output = requests.delete(api_url, auth=self._auth_provider)
+        output = self._transport.delete(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output
 
@@ -109,7 +125,9 @@ class Gen3Submission:
 
         """
         api_url = f"{self._endpoint}/api/v0/submission/{program}"
-        output = requests.get(api_url, auth=self._auth_provider)
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -125,7 +143,9 @@ class Gen3Submission:
             >>> Gen3Submission.create_project("DCF", json)
         """
         api_url = "{}/api/v0/submission/{}".format(self._endpoint, program)
-        output = requests.put(api_url, auth=self._auth_provider, json=json)
+        output = self._transport.put(
+            api_url, auth=self._auth_provider, json=json, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -145,7 +165,9 @@ class Gen3Submission:
 
         """
         api_url = "{}/api/v0/submission/{}/{}".format(self._endpoint, program, project)
-        output = requests.delete(api_url, auth=self._auth_provider)
+        output = self._transport.delete(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output
 
@@ -162,7 +184,9 @@ class Gen3Submission:
 
         """
         api_url = f"{self._endpoint}/api/v0/submission/{program}/{project}/_dictionary"
-        output = requests.get(api_url, auth=self._auth_provider)
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -179,7 +203,9 @@ class Gen3Submission:
 
         """
         api_url = f"{self._endpoint}/api/v0/submission/{program}/{project}/open"
-        output = requests.put(api_url, auth=self._auth_provider)
+        output = self._transport.put(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -200,7 +226,9 @@ class Gen3Submission:
 
         """
         api_url = "{}/api/v0/submission/{}/{}".format(self._endpoint, program, project)
-        output = requests.put(api_url, auth=self._auth_provider, json=json)
+        output = self._transport.put(
+            api_url, auth=self._auth_provider, json=json, timeout=self._timeout
+        )
         output.raise_for_status()
         return output.json()
 
@@ -219,7 +247,9 @@ class Gen3Submission:
         api_url = "{}/api/v0/submission/{}/{}/entities/{}".format(
             self._endpoint, program, project, uuid
         )
-        output = requests.delete(api_url, auth=self._auth_provider)
+        output = self._transport.delete(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         output.raise_for_status()
         return output
 
@@ -246,7 +276,9 @@ class Gen3Submission:
         api_url = "{}/api/v0/submission/{}/{}/export?ids={}&format={}".format(
             self._endpoint, program, project, uuid, fileformat
         )
-        output = requests.get(api_url, auth=self._auth_provider).text
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        ).text
         if filename is None:
             if fileformat == "json":
                 output = json.loads(output)
@@ -278,7 +310,9 @@ class Gen3Submission:
         api_url = "{}/api/v0/submission/{}/{}/export/?node_label={}&format={}".format(
             self._endpoint, program, project, node_type, fileformat
         )
-        output = requests.get(api_url, auth=self._auth_provider).text
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        ).text
         if filename is None:
             if fileformat == "json":
                 output = json.loads(output)
@@ -289,13 +323,16 @@ class Gen3Submission:
 
     ### Query functions
 
-    def query(self, query_txt, variables=None, max_tries=1):
+    def query(self, query_txt, variables=None, max_tries=None):
         """Execute a GraphQL query against a data commons.
 
+        Queries only read, so failed requests are retried like GET requests.
+
         Args:
             query_txt (str): Query text.
             variables (:obj:`object`, optional): Dictionary of variables to pass with the query.
-            max_tries (:obj:`int`, optional): Number of times to retry if the request fails.
+            max_tries (:obj:`int`, optional): Number of times to try the request if it fails,
+                instead of the transport's retry policy setting.
 
         Examples:
             This executes a query to get the list of all the project codes for all the projects
@@ -311,19 +348,26 @@ class Gen3Submission:
         else:
             query = {"query": query_txt, "variables": variables}
 
-        tries = 0
-        while tries < max_tries:
-            output = requests.post(api_url, auth=self._auth_provider, json=query).text
-            data = json.loads(output)
-
-            if "errors" in data:
-                raise Gen3SubmissionQueryError(data["errors"])
+        retry_policy = None
+        if max_tries:
+            retry_policy = self._transport.retry_policy.copy(max_tries=max_tries)
+
+        output = self._transport.post(
+            api_url,
+            auth=self._auth_provider,
+            json=query,
+            idempotent=True,
+            retry_policy=retry_policy,
+            timeout=self._timeout,
+        ).text
+        data = json.loads(output)
 
-            if not "data" in data:
-                print(query_txt)
-                print(data)
+        if "errors" in data:
+            raise Gen3SubmissionQueryError(data["errors"])
 
-            tries += 1
+        if not "data" in data:
+            print(query_txt)
+            print(data)
 
         return data
 
@@ -339,7 +383,7 @@ class Gen3Submission:
 
         """
         api_url = "{}/api/v0/submission/getschema".format(self._endpoint)
-        output = requests.get(api_url).text
+        output = self._transport.get(api_url, timeout=self._timeout).text
         data = json.loads(output)
         return data
 
@@ -362,7 +406,7 @@ class Gen3Submission:
         api_url = "{}/api/v0/submission/_dictionary/{}".format(
             self._endpoint, node_type
         )
-        output = requests.get(api_url).text
+        output = self._transport.get(api_url, timeout=self._timeout).text
         data = json.loads(output)
         return data
 
@@ -394,7 +438,9 @@ class Gen3Submission:
 
         """
         api_url = f"{self._endpoint}/api/v0/submission/{program}/{project}/manifest"
-        output = requests.get(api_url, auth=self._auth_provider)
+        output = self._transport.get(
+            api_url, auth=self._auth_provider, timeout=self._timeout
+        )
         return output
 
     def submit_file(self, project_id, filename, chunk_size=30, row_offset=0):
@@ -475,11 +521,12 @@ class Gen3Submission:
             )
 
             try:
-                response = requests.put(
+                response = self._transport.put(
                     api_url,
                     auth=self._auth_provider,
                     data=chunk.to_csv(sep="\t", index=False),
                     headers=headers,
+                    timeout=self._timeout,
                 ).text
             except requests.exceptions.ConnectionError as e:
                 results["details"].append(e.message)
@@ -9,34 +9,65 @@ guid,authz,acl,file_size,md5,urls,file_name
 
 Fields that are lists (like acl, authz, and urls) separate the values with spaces.
 
+The did keyspace is split into key ranges that a pool of worker processes reads
+concurrently, each range into its own part file in a scratch directory next to the
+output. A journal there records the key ranges and a checkpoint for each page
+written. A range that fails is read again, continuing after its last checkpoint,
+and the parts are combined in did order, so the manifest is sorted by guid. A run
+that stopped keeps its scratch directory and can be resumed the same way. A lock
+file next to the scratch directory makes a second run into the same output fail
+while the first is in progress.
+
+When an auth provider is given, its API key is handed to the worker processes so
+they can read controlled-access records. They share access tokens through the auth
+provider's token cache directory, or one in the scratch directory, so that only
+one of them requests a token from fence at a time.
+
+When a maximum request rate is given, all worker processes draw from one
+RateLimiter whose state is kept in the scratch directory, so the rate holds across
+processes.
+
 Attributes:
-    CURRENT_DIR (str): directory this file is in
     INDEXD_RECORD_PAGE_SIZE (int): number of records to request per page
     MAX_CONCURRENT_REQUESTS (int): maximum number of desired concurrent requests across
         processes/threads
-    TMP_FOLDER (str): Folder directory for placing temporary files
-        NOTE - We have to use a temporary folder b/c Python's file writing is not
-              thread-safe so we can't have all processes writing to the same file.
-              To workaround this, we have each process write to a file and concat
-              them all post-processing.
+        NOTE - This is where concurrency starts. Each process adapts its own limit to
+              indexd's latency and errors (see gen3.concurrency), up to its share of
+              MAX_ADAPTIVE_CONCURRENT_REQUESTS.
+    MAX_ADAPTIVE_CONCURRENT_REQUESTS (int): ceiling for the adapted number of concurrent
+        requests across processes
+    MAX_SHARD_ATTEMPTS (int): number of times a key range is read before giving up
+    COPY_BUFFER_SIZE (int): size of the reads combining the parts where the kernel
+        can't copy them
 """
 import asyncio
-import click
+import collections
+import contextlib
 import time
 import csv
-import glob
+import json
 import logging
+import multiprocessing.util
 import os
-import sys
 import shutil
-import math
+from concurrent.futures import ProcessPoolExecutor
 
+from gen3.auth import Gen3Auth
+from gen3.circuit_breaker import CircuitOpenError
+from gen3.concurrency import AdaptiveConcurrencyLimiter
 from gen3.index import Gen3Index
+from gen3.rate_limit import RateLimiter
+from gen3.transport import Gen3Transport
+from gen3.utils import atomic_write, file_lock
 
 INDEXD_RECORD_PAGE_SIZE = 1024
 MAX_CONCURRENT_REQUESTS = 24
-CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
-TMP_FOLDER = os.path.abspath(CURRENT_DIR + "/tmp") + "/"
+MAX_ADAPTIVE_CONCURRENT_REQUESTS = 256
+MAX_SHARD_ATTEMPTS = 3
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# state of a worker process of the download pool, set by _init_worker
+_worker = {}
 
 
 async def async_download_object_manifest(
@@ -44,6 +75,9 @@ async def async_download_object_manifest(
     output_filename="object-manifest.csv",
     num_processes=4,
     max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+    auth=None,
+    max_requests_per_second=None,
+    resume=False,
 ):
     """
     Download all file object records into a manifest csv
@@ -56,19 +90,30 @@ async def async_download_object_manifest(
         max_concurrent_requests (int): the maximum number of concurrent requests allowed
             NOTE: This is the TOTAL number, not just for this process. Used to help
             determine how many requests a process should be making at one time
+        auth (Gen3Auth, optional): auth provider, required to include records the
+            anonymous user can't read
+        max_requests_per_second (float, optional): maximum rate of requests to
+            indexd across all processes
+        resume (bool, optional): continue the last run into output_filename that
+            didn't finish, reading only the pages it hadn't written. The manifest
+            is the same as if that run had finished, as long as the records in
+            indexd didn't change in between. Starts a new run if there is none.
+
+    Raises:
+        RuntimeError: a key range still failed after MAX_SHARD_ATTEMPTS attempts,
+            or another download into output_filename is in progress
     """
     start_time = time.perf_counter()
     logging.info(f"start time: {start_time}")
 
-    # ensure tmp directory exists and is empty
-    os.makedirs(TMP_FOLDER, exist_ok=True)
-    for file in os.listdir(TMP_FOLDER):
-        file_path = os.path.join(TMP_FOLDER, file)
-        if os.path.isfile(file_path):
-            os.unlink(file_path)
-
     result = await _write_all_index_records_to_file(
-        commons_url, output_filename, num_processes, max_concurrent_requests
+        commons_url,
+        output_filename,
+        num_processes,
+        max_concurrent_requests,
+        auth,
+        max_requests_per_second,
+        resume,
     )
 
     end_time = time.perf_counter()
@@ -77,7 +122,13 @@ async def async_download_object_manifest(
 
 
 async def _write_all_index_records_to_file(
-    commons_url, output_filename, num_processes, max_concurrent_requests
+    commons_url,
+    output_filename,
+    num_processes,
+    max_concurrent_requests,
+    auth=None,
+    max_requests_per_second=None,
+    resume=False,
 ):
     """
     Spins up number of processes provided to parse indexd records and eventually
@@ -91,223 +142,545 @@ async def _write_all_index_records_to_file(
         max_concurrent_requests (int): the maximum number of concurrent requests allowed
             NOTE: This is the TOTAL number, not just for this process. Used to help
             determine how many requests a process should be making at one time
+        auth (Gen3Auth, optional): auth provider
+        max_requests_per_second (float, optional): maximum rate of requests to
+            indexd across all processes
+        resume (bool, optional): continue the last unfinished run
     """
-    index = Gen3Index(commons_url)
-    logging.debug(f"requesting indexd stats...")
-    num_files = int(index.get_stats().get("fileCount"))
-    logging.debug(f"number files: {num_files}")
-    # paging is 0-based, so subtract 1 from ceiling
-    # note: float() is necessary to force Python 3 to not floor the result
-    max_page = int(math.ceil(float(num_files) / INDEXD_RECORD_PAGE_SIZE)) - 1
-    logging.debug(f"max page: {max_page}")
-    logging.debug(f"num processes: {num_processes}")
-
-    pages = [x for x in range(max_page + 1)]
-
-    # batch pages into subprocesses
-    chunk_size = int(math.ceil(float(len(pages)) / num_processes))
-    logging.debug(f"page chunk size: {chunk_size}")
-
-    if not chunk_size:
-        page_chunks = []
-    else:
-        page_chunks = [
-            pages[i : i + chunk_size] for i in range(0, len(pages), chunk_size)
-        ]
-
-    processes = []
-    for x in range(len(page_chunks)):
-        pages = ",".join(map(str, page_chunks[x]))
+    # next to the output, so runs into different files don't share it and the
+    # parts can be combined without copying them through this process
+    scratch_dir = os.path.join(
+        os.path.dirname(os.path.abspath(output_filename)),
+        f".{os.path.basename(output_filename)}.download",
+    )
+    with _run_lock(scratch_dir):
+        if not resume:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        os.makedirs(scratch_dir, exist_ok=True)
+
+        try:
+            await _run_download_processes(
+                commons_url,
+                output_filename,
+                num_processes,
+                max_concurrent_requests,
+                auth,
+                max_requests_per_second,
+                scratch_dir,
+            )
+        except BaseException:
+            logging.error(
+                f"download stopped, run it again with resume=True to continue it "
+                f"from {scratch_dir}"
+            )
+            raise
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def _run_lock(scratch_dir):
+    """
+    Lock held for a whole run, so that another run into the same output fails
+    right away instead of clearing the scratch directory while this one is
+    writing to it. The lock file is removed at the end of the run.
 
-        # call the cli function below and pass in chunks of pages for each process
-        command = (
-            f"python {CURRENT_DIR}/download_manifest.py --commons_url "
-            f"{commons_url} --pages {pages} --num_processes {num_processes} "
-            f"--max_concurrent_requests {max_concurrent_requests}"
+    Raises:
+        RuntimeError: another run into the same output is in progress
+    """
+    path = f"{scratch_dir}.lock"
+    in_progress = RuntimeError(
+        f"another download is using {scratch_dir}, wait for it to finish or "
+        f"download into another file"
+    )
+    with contextlib.ExitStack() as stack:
+        try:
+            lock_file = stack.enter_context(file_lock(path, blocking=False))
+        except BlockingIOError:
+            raise in_progress from None
+        try:
+            # the run that held the lock may have removed the file since this
+            # one opened it, and another run may have created a new one
+            locked = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+        except FileNotFoundError:
+            locked = False
+        if not locked:
+            raise in_progress
+
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+
+async def _run_download_processes(
+    commons_url,
+    output_filename,
+    num_processes,
+    max_concurrent_requests,
+    auth,
+    max_requests_per_second,
+    scratch_dir,
+):
+    """
+    Read the key ranges of indexd in a pool of worker processes and combine
+    their outputs. The key ranges and the pages written are kept in a journal
+    in scratch_dir, so a run that stopped can be continued.
+    """
+    # the worker processes share the limiter's state through this file
+    rate_limit_file = os.path.join(scratch_dir, "rate-limit")
+    transport = None
+    if max_requests_per_second:
+        transport = Gen3Transport(
+            rate_limiter=RateLimiter(
+                max_requests_per_second, state_file=rate_limit_file
+            )
         )
-        logging.info(command)
-
-        process = await asyncio.create_subprocess_shell(command)
-
-        logging.info(f"Process_{process.pid} - Started w/: {command}")
-        processes.append(process)
-
-    for process in processes:
-        # wait for the subprocesses to finish
-        stdout, stderr = await process.communicate()
+    index = Gen3Index(commons_url, auth_provider=auth, transport=transport)
+    logging.debug(f"num processes: {num_processes}")
 
-        if process.returncode == 0:
-            logging.info(f"Process_{process.pid} - Done")
-        else:
-            logging.info(f"Process_{process.pid} - FAILED")
+    journal = os.path.join(scratch_dir, "journal")
+    shards = None
+    if os.path.exists(journal):
+        # the ranges must be the ones the pages were written for
+        shards, checkpoints = _read_journal(journal)
+        if shards is None:
+            raise RuntimeError(
+                f"journal {journal} has no key ranges, rerun without resume"
+            )
+        done = sum(1 for checkpoint in checkpoints.values() if checkpoint["done"])
+        logging.info(f"resuming, {done} of {len(shards)} key ranges already done")
+    else:
+        # split the did keyspace into one range per concurrent request; each
+        # range is read with a cursor, so the scan doesn't depend on a record
+        # count or use slow deep page offsets
+        shards_per_process = max(1, int(max_concurrent_requests / num_processes))
+        shards = index.get_shards(num_processes * shards_per_process)
+        # whole or not at all, so a resumed run always finds the key ranges
+        atomic_write(journal, json.dumps({"shards": shards}) + "\n")
+    logging.debug(f"number of key ranges: {len(shards)}")
+
+    settings = {
+        "commons_url": commons_url,
+        # handed to the workers through the pool's pipes, not the command line
+        "refresh_token": auth._refresh_token if auth else None,
+        "auth_endpoint": auth._endpoint if auth else None,
+        "token_cache_dir": _token_cache_dir(auth, scratch_dir),
+        "page_size": INDEXD_RECORD_PAGE_SIZE,
+        "max_requests": int(max_concurrent_requests / num_processes),
+        "max_adaptive_requests": MAX_ADAPTIVE_CONCURRENT_REQUESTS // num_processes,
+        "max_requests_per_second": max_requests_per_second,
+        "rate_limit_file": rate_limit_file,
+        "scratch_dir": scratch_dir,
+        "journal": journal,
+    }
+    checkpoints = await _download_in_worker_pool(shards, settings, num_processes)
 
     logging.info(f"done processing, combining outputs to single file {output_filename}")
 
-    # remove existing output if it exists
-    if os.path.isfile(output_filename):
-        os.unlink(output_filename)
-
-    with open(output_filename, "wb") as outfile:
+    # the ranges are in did order, and so are the parts of each range, so the
+    # manifest is in did order
+    manifest = os.path.join(scratch_dir, "manifest.csv")
+    with open(manifest, "wb", buffering=0) as outfile:
         outfile.write(
             "guid, urls, authz, acl, md5, file_size, file_name\n".encode("utf8")
         )
-        for filename in glob.glob(TMP_FOLDER + "*"):
-            if output_filename == filename:
-                # don't want to copy the output into the output
-                continue
-            logging.info(f"combining {filename} into {output_filename}")
+        for (shard, part), checkpoint in sorted(checkpoints.items()):
+            filename = _part_filename(scratch_dir, shard, part)
+            logging.debug(f"combining {filename} into {output_filename}")
+            # past the last checkpoint are rows of a page that was cut short
             with open(filename, "rb") as readfile:
-                shutil.copyfileobj(readfile, outfile)
+                _append_file(readfile, outfile, checkpoint["size"])
+    # replaces any existing output at once, never leaving a partial manifest
+    os.replace(manifest, output_filename)
 
     logging.info(f"done writing output to file {output_filename}")
 
 
-@click.command()
-@click.option(
-    "--commons_url", help="Root domain (url) for a commons containing indexd."
-)
-@click.option(
-    "--pages",
-    help='Comma-Separated string of integers representing pages. ex: "2,4,5,6"',
-)
-@click.option(
-    "--num_processes",
-    type=int,
-    help="number of processes you are running so we can make sure we don't open "
-    'too many http connections. ex: "4"',
-)
-@click.option(
-    "--max_concurrent_requests",
-    type=int,
-    help="number of processes you are running so we can make sure we don't open "
-    'too many http connections. ex: "4"',
-)
-def write_page_records_to_files(
-    commons_url, pages, num_processes, max_concurrent_requests
-):
+def _append_file(readfile, outfile, size):
+    """
+    Append the first size bytes of readfile to outfile, an unbuffered binary
+    file. Where the platform allows, the kernel copies the data without it
+    going through this process, or shares it between the files on file
+    systems that support it (Btrfs, XFS) so nothing is written twice.
     """
-    Command line interface function for requesting a number of pages of
-    records from indexd and writing to a file in that process. num_processes
-    is only used to calculate how many open connections this process should request.
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(
+                readfile.fileno(), outfile.fileno(), size - copied
+            )
+            if not count:
+                break
+            copied += count
+    except (AttributeError, OSError) as exc:
+        # no copy_file_range before python 3.8 or outside linux, or not
+        # between these files
+        logging.debug(f"copying {readfile.name} through this process: {exc!r}")
+        readfile.seek(copied)
+        while copied < size:
+            data = readfile.read(min(COPY_BUFFER_SIZE, size - copied))
+            if not data:
+                break
+            outfile.write(data)
+            copied += len(data)
+
+
+async def _download_in_worker_pool(shards, settings, num_processes):
+    """
+    Read key ranges in a pool of worker processes until the journal shows
+    them all done, each range into part files. A range that didn't finish,
+    because of an error or because its worker process died, is read again
+    by a new pool, continuing after the last page checkpointed, into a new
+    part.
 
     Args:
-        commons_url (str): root domain for commons where indexd lives
-        pages (List[int/str]): List of indexd pages to request
-        num_processes (int): number of concurrent processes being requested
-            (including this one)
-        max_concurrent_requests (int): the maximum number of concurrent requests allowed
-            NOTE: This is the TOTAL number, not just for this process. Used to help
-            determine how many requests a process should be making at one time
+        shards (List[List[str]]): [start, end] did ranges to read, see
+            Gen3Index.get_shards
+        settings (dict): configuration of the worker processes, see _init_worker
+        num_processes (int): number of worker processes
+
+    Returns:
+        Dict[Tuple[int, int], dict]: last checkpoint of each part written, by
+        shard and part number, see _read_journal
 
     Raises:
-        AttributeError: No pages specified to get records from
+        RuntimeError: a range still failed after MAX_SHARD_ATTEMPTS attempts
     """
-    if not pages:
-        raise AttributeError("No pages specified to get records from.")
-
-    pages = pages.strip().split(",")
     loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(
-        _get_records_and_write_to_file(
-            commons_url, pages, num_processes, max_concurrent_requests
-        )
-    )
-    return result
+    attempts = collections.Counter()
+    while True:
+        _, checkpoints = _read_journal(settings["journal"])
+        tasks = _pending_tasks(shards, checkpoints)
+        if not tasks:
+            return checkpoints
+
+        attempts.update(task["shard"] for task in tasks)
+        failed = [
+            task for task in tasks if attempts[task["shard"]] > MAX_SHARD_ATTEMPTS
+        ]
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} key ranges still failed after {MAX_SHARD_ATTEMPTS} "
+                f"attempts, continuing after: {[task['start'] for task in failed]}"
+            )
+        logging.info(f"reading {len(tasks)} of {len(shards)} key ranges")
+
+        # deal the ranges out so key ranges of different density are spread evenly
+        chunks = [tasks[i::num_processes] for i in range(num_processes)]
+        chunks = [chunk for chunk in chunks if chunk]
+        with ProcessPoolExecutor(
+            max_workers=len(chunks), initializer=_init_worker, initargs=(settings,)
+        ) as pool:
+            outcomes = await asyncio.gather(
+                *(
+                    loop.run_in_executor(pool, _download_shards, chunk)
+                    for chunk in chunks
+                ),
+                return_exceptions=True,
+            )
+
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                # its ranges continue from the journal like failed ones
+                logging.error(f"worker process failed: {outcome!r}")
+                continue
+            for result in outcome:
+                if result["error"] is None:
+                    logging.info(
+                        f"key range {result['shard']} part {result['part']} - Done, "
+                        f"{result['pages']} pages, {result['records']} records"
+                    )
+                else:
+                    logging.warning(
+                        f"key range {result['shard']} part {result['part']} - "
+                        f"FAILED after {result['pages']} pages: {result['error']}"
+                    )
+
+
+def _read_journal(path):
+    """
+    Read the journal of a run: its first line holds the key ranges, then
+    each page written adds a checkpoint with the shard and part numbers, the
+    cursor the range continues after, the size of the part up to the end of
+    the page, and whether the range is done.
 
+    Args:
+        path (str): journal file
 
-async def _get_records_and_write_to_file(
-    commons_url, pages, num_processes, max_concurrent_requests
-):
+    Returns:
+        Tuple[List[List[str]], Dict[Tuple[int, int], dict]]: key ranges of the
+        run, and the last checkpoint of each part by shard and part number
+    """
+    shards = None
+    checkpoints = {}
+    with open(path, encoding="utf8") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # cut short when the run was killed, its page isn't counted
+                continue
+            if "shards" in entry:
+                shards = entry["shards"]
+            else:
+                checkpoints[(entry["shard"], entry["part"])] = entry
+    return shards, checkpoints
+
+
+def _pending_tasks(shards, checkpoints):
+    """
+    Ranges that aren't done, each continuing after the last checkpoint of
+    its latest part, into the next part
+
+    Returns:
+        List[dict]: shard number, part number, start and end of each range
+    """
+    latest = {}
+    for shard, part in checkpoints:
+        latest[shard] = max(part, latest.get(shard, part))
+
+    tasks = []
+    for shard, (start, end) in enumerate(shards):
+        part = 0
+        if shard in latest:
+            checkpoint = checkpoints[(shard, latest[shard])]
+            if checkpoint["done"]:
+                continue
+            part = latest[shard] + 1
+            start = checkpoint["cursor"]
+        tasks.append({"shard": shard, "part": part, "start": start, "end": end})
+    return tasks
+
+
+def _token_cache_dir(auth, scratch_dir):
+    """
+    Directory the worker processes share access tokens through, so that
+    they don't each request their own from fence: the one of auth if it has
+    one, so its token is reused too, otherwise one for the run
+
+    Returns:
+        str: token cache directory, None without auth
     """
-    Getting indexd records and writing to a file. This function
-    creates semaphores to limit the number of concurrent http connections that
-    get opened to send requests to indexd.
+    if not auth:
+        return None
+    if auth._token_cache_path:
+        return os.path.dirname(auth._token_cache_path)
+    return os.path.join(scratch_dir, "tokens")
 
-    It then uses asyncio to start a number of coroutines. Steps:
-        1) requests to indexd to get records (writes resulting records to a queue)
-        2) puts a final "DONE" in the queue to stop coroutine that will read from queue
-        3) reading those records from the queue and writing to a file
+
+def _part_filename(scratch_dir, shard, part):
+    return os.path.join(scratch_dir, f"{shard:05d}-{part:02d}.csv")
+
+
+def _init_worker(settings):
+    """
+    Set up a worker process of _download_in_worker_pool
 
     Args:
-        commons_url (str): root domain for commons where indexd lives
-        pages (List[int/str]): List of indexd pages to request
-        num_processes (int): number of concurrent processes being requested
-            (including this one)
+        settings (dict): commons_url, refresh_token of the API key, the
+            auth_endpoint it's exchanged at and token_cache_dir if any,
+            page_size, max_requests and max_adaptive_requests for this process,
+            max_requests_per_second and rate_limit_file if the rate is limited,
+            scratch_dir, where the part files are written, and journal, the
+            file pages are checkpointed in
     """
-    max_requests = int(max_concurrent_requests / num_processes)
-    logging.debug(f"max concurrent requests per process: {max_requests}")
-    lock = asyncio.Semaphore(max_requests)
-    queue = asyncio.Queue()
-    write_to_file_task = asyncio.ensure_future(_parse_from_queue(queue))
-    await asyncio.gather(
-        *(
-            _put_records_from_page_in_queue(page, commons_url, lock, queue)
-            for page in pages
+    _worker.clear()
+    _worker.update(settings)
+    _worker["auth"] = None
+    if settings["refresh_token"]:
+        _worker["auth"] = Gen3Auth(
+            settings["auth_endpoint"],
+            refresh_token=settings["refresh_token"],
+            token_cache_dir=settings["token_cache_dir"],
         )
+    _worker["rate_limiter"] = None
+    if settings["max_requests_per_second"]:
+        _worker["rate_limiter"] = RateLimiter(
+            settings["max_requests_per_second"], state_file=settings["rate_limit_file"]
+        )
+    _worker["journal_fd"] = os.open(settings["journal"], os.O_WRONLY | os.O_APPEND)
+    # closed when the worker process exits
+    multiprocessing.util.Finalize(
+        None, os.close, args=(_worker["journal_fd"],), exitpriority=0
     )
-    await queue.put("DONE")
-    await write_to_file_task
 
 
-async def _put_records_from_page_in_queue(page, commons_url, lock, queue):
+def _download_shards(tasks):
     """
-    Gets a semaphore then requests records for the given page and
-    puts them in a queue.
+    Read key ranges concurrently in a worker process, see _download_shard
 
     Args:
-        commons_url (str): root domain for commons where indexd lives
-        page (int/str): indexd page to request
-        lock (asyncio.Semaphore): semaphones used to limit ammount of concurrent http
-            connections
-        queue (asyncio.Queue): queue to put indexd records in
+        tasks (List[dict]): ranges to read, see _pending_tasks
+
+    Returns:
+        List[dict]: result of each task
+    """
+    # a loop of its own, not the one the process was forked with
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(_async_download_shards(tasks))
+    finally:
+        loop.close()
+
+
+async def _async_download_shards(tasks):
+    """
+    Read key ranges concurrently, sharing one client and connection pool.
+    The number of concurrent requests adapts to indexd's latency and errors.
     """
-    index = Gen3Index(commons_url)
-    async with lock:
-        # default ssl handling unless it's explicitly http://
-        ssl = None
-        if "https" not in commons_url:
-            ssl = False
-
-        records = await index.async_get_records_on_page(
-            page=page, limit=INDEXD_RECORD_PAGE_SIZE, _ssl=ssl
+    max_requests = _worker["max_requests"]
+    logging.debug(f"max concurrent requests per process: {max_requests}")
+    lock = AdaptiveConcurrencyLimiter(
+        initial_limit=max_requests,
+        max_limit=max(max_requests, _worker["max_adaptive_requests"]),
+        name=f"Process_{os.getpid()} indexd",
+    )
+    index = Gen3Index(
+        _worker["commons_url"],
+        auth_provider=_worker["auth"],
+        transport=Gen3Transport(
+            max_connections=lock.max_limit,
+            max_connections_per_host=lock.max_limit,
+            rate_limiter=_worker["rate_limiter"],
+        ),
+    )
+    async with index:
+        results = await asyncio.gather(
+            *(_download_shard(task, lock, index) for task in tasks)
         )
-        await queue.put(records)
+    logging.info(f"Process_{os.getpid()} - concurrency stats: {lock.stats}")
+    return results
 
 
-async def _parse_from_queue(queue):
+async def _download_shard(task, lock, index):
     """
-    Read from the queue and write to a file
+    Write the manifest rows of the records of a key range to its part file,
+    page by page, adding a checkpoint to the journal after each page. An error
+    stops the range after the last page checkpointed.
 
     Args:
-        queue (asyncio.Queue): queue to read indexd records from
+        task (dict): range to read, see _pending_tasks
+        lock (AdaptiveConcurrencyLimiter): limiter for the amount of concurrent http
+            connections
+        index (Gen3Index): client to request the pages with
+
+    Returns:
+        dict: shard and part numbers, number of pages and records written,
+        cursor (the did the range continues after) and the error that stopped
+        the range, or None
     """
     loop = asyncio.get_event_loop()
-    file_name = TMP_FOLDER + f"{os.getpid()}.csv"
-    with open(file_name, "w+", encoding="utf8") as file:
-        logging.info(f"Write to {file_name}")
+    result = {
+        "shard": task["shard"],
+        "part": task["part"],
+        "pages": 0,
+        "records": 0,
+        "cursor": task["start"],
+        "error": None,
+    }
+    filename = _part_filename(_worker["scratch_dir"], task["shard"], task["part"])
+    with open(filename, "w", encoding="utf8") as file:
         csv_writer = csv.writer(file)
+        size = 0
+        try:
+            async for records, cursor in _iter_shard_pages(
+                task["start"], task["end"], lock, index
+            ):
+                rows = [_manifest_row(record) for record in records]
+                await loop.run_in_executor(None, csv_writer.writerows, rows)
+                # on disk before its checkpoint, so a checkpoint never counts
+                # rows that a crash of the process or the node loses
+                file.flush()
+                await loop.run_in_executor(None, os.fsync, file.fileno())
+                size = os.fstat(file.fileno()).st_size
+                await loop.run_in_executor(None, _checkpoint, task, cursor, size)
+                result["pages"] += 1
+                result["records"] += len(records)
+                result["cursor"] = cursor
+            await loop.run_in_executor(
+                None, _checkpoint, task, result["cursor"], size, True
+            )
+        except Exception as exc:
+            logging.warning(
+                f"Process_{os.getpid()} - key range {task['shard']} stopped: {exc}"
+            )
+            result["error"] = f"{type(exc).__name__}: {exc}"
+    return result
+
+
+def _checkpoint(task, cursor, size, done=False):
+    """
+    Add a checkpoint to the journal, see _read_journal. It's appended in one
+    write so the checkpoints of concurrent workers don't interleave, and
+    synced to disk before the range continues.
+    """
+    entry = {
+        "shard": task["shard"],
+        "part": task["part"],
+        "cursor": cursor,
+        "size": size,
+        "done": done,
+    }
+    os.write(_worker["journal_fd"], (json.dumps(entry) + "\n").encode("utf8"))
+    os.fsync(_worker["journal_fd"])
+
+
+async def _iter_shard_pages(start, end, lock, index):
+    """
+    Requests the records of the given did range page by page, following
+    indexd's start cursor. Gets a semaphore for each page. While indexd's
+    circuit is open, waits for it to let requests through again.
 
-        records = await queue.get()
-        while records != "DONE":
-            if records:
-                for record in list(records):
-                    manifest_row = [
-                        record.get("did"),
-                        " ".join(record.get("urls")),
-                        " ".join(record.get("authz")),
-                        " ".join(record.get("acl")),
-                        record.get("hashes", {}).get("md5"),
-                        record.get("size"),
-                        record.get("file_name"),
-                    ]
-                    loop.run_in_executor(None, csv_writer.writerow, manifest_row)
-
-            records = await queue.get()
-
-        file.flush()
-
-
-if __name__ == "__main__":
-    logging.basicConfig(filename="output.log", level=logging.DEBUG)
-    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
-    write_page_records_to_files()
+    Args:
+        start (str): did the range starts after, None for the first did
+        end (str): last did of the range, None for the last did
+        lock (AdaptiveConcurrencyLimiter): limiter for the amount of concurrent http
+            connections
+        index (Gen3Index): client to request the pages with
+
+    Yields:
+        Tuple[List[dict], str]: records of each page within the range, and the
+        did the next page starts after
+    """
+    # default ssl handling unless it's explicitly http://
+    ssl = None
+    if "https" not in _worker["commons_url"]:
+        ssl = False
+
+    while True:
+        try:
+            async with lock:
+                records = await index.async_get_records_on_page(
+                    limit=_worker["page_size"], start=start, _ssl=ssl
+                )
+        except CircuitOpenError as exc:
+            logging.warning(
+                f"Process_{os.getpid()} - pausing {exc.retry_in:.1f} seconds: {exc}"
+            )
+            await asyncio.sleep(exc.retry_in)
+            continue
+
+        if not records:
+            break
+        cursor = records[-1].get("did")
+        if end is not None:
+            # the rest belongs to the next range
+            records = [record for record in records if record.get("did") <= end]
+        if records:
+            yield records, cursor
+        if (end is not None and cursor >= end) or cursor == start:
+            break
+        start = cursor
+
+
+def _manifest_row(record):
+    return [
+        record.get("did"),
+        " ".join(record.get("urls")),
+        " ".join(record.get("authz")),
+        " ".join(record.get("acl")),
+        record.get("hashes", {}).get("md5"),
+        record.get("size"),
+        record.get("file_name"),
+    ]
@@ -41,10 +41,12 @@ import re
 import uuid
 import copy
 import sys
+import time
 
 from gen3.auth import Gen3Auth
-import indexclient.client as client
-
+from gen3.circuit_breaker import CircuitOpenError
+from gen3.index import Gen3Index
+from gen3.transport import Gen3Transport
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 # Pre-defined supported column names
@@ -219,7 +221,9 @@ def _write_csv(filename, files, fieldnames=None):
 
 def _index_record(indexclient, replace_urls, thread_control, fi):
     """
-    Index single file
+    Index single file. While indexd's circuit is open (see
+    gen3.circuit_breaker) the thread pauses and then tries the file again,
+    instead of failing it.
 
     Args:
         indexclient(IndexClient): indexd client
@@ -230,107 +234,25 @@ def _index_record(indexclient, replace_urls, thread_control, fi):
         None
 
     """
-
-    try:
-        urls = (
-            [
-                element.strip().replace("'", "")
-                for element in _standardize_str(fi["url"]).strip()[1:-1].split(" ")
-            ]
-            if "url" in fi and fi["url"] != "[]"
-            else []
-        )
-        authz = (
-            [
-                element.strip().replace("'", "")
-                for element in _standardize_str(fi["authz"]).strip()[1:-1].split(" ")
-            ]
-            if "authz" in fi and fi["authz"] != "[]"
-            else []
-        )
-
-        if "acl" in fi:
-            if fi["acl"].strip().lower() in {"[u'open']", "['open']"}:
-                acl = ["*"]
-            else:
-                acl = (
-                    [
-                        element.strip().replace("'", "")
-                        for element in _standardize_str(fi["acl"])
-                        .strip()[1:-1]
-                        .split(" ")
-                    ]
-                    if "acl" in fi and fi["acl"] != "[]"
-                    else []
+    while True:
+        try:
+            _create_or_update_record(indexclient, replace_urls, fi)
+        except CircuitOpenError as e:
+            logging.warning(
+                "Pausing for {:.1f} seconds before indexing guid {}: {}".format(
+                    e.retry_in, fi.get("GUID"), e
                 )
-        else:
-            acl = []
-
-        doc = None
-
-        if fi.get("GUID"):
-            doc = indexclient.get(fi["GUID"])
-
-        if doc is not None:
-            if doc.size != fi.get("size") or doc.hashes.get("md5") != fi.get("md5"):
-                logging.error(
-                    "The guid {} with different size/hash already exist. Can not index it without getting a new GUID".format(
-                        fi.get("GUID")
-                    )
-                )
-            else:
-                need_update = False
-
-                if replace_urls and set(urls) != set(doc.urls):
-                    doc.urls = urls
-                    need_update = True
-
-                    # indexd doesn't like when records have metadata for non-existing
-                    # urls
-                    new_urls_metadata = copy.deepcopy(doc.urls_metadata)
-                    for url, metadata in doc.urls_metadata.items():
-                        if url not in urls:
-                            del new_urls_metadata[url]
-                    doc.urls_metadata = new_urls_metadata
-
-                elif not replace_urls:
-                    for url in urls:
-                        if url not in doc.urls:
-                            doc.urls.append(url)
-                            need_update = True
-
-                if set(doc.acl) != set(acl):
-                    doc.acl = acl
-                    need_update = True
-
-                if set(doc.authz) != set(authz):
-                    doc.authz = authz
-                    need_update = True
-
-                if need_update:
-                    doc.patch()
-        else:
-            if fi.get("GUID"):
-                guid = fi.get("GUID", "").strip()
-            else:
-                guid = None
-            doc = indexclient.create(
-                did=guid,
-                hashes={"md5": fi.get("md5", "").strip()},
-                size=fi.get("size", 0),
-                acl=acl,
-                authz=authz,
-                urls=urls,
             )
-            fi["GUID"] = doc.did
-
-    except Exception as e:
-        # Don't break for any reason
-        logging.error(
-            "Can not update/create an indexd record with guid {}. Detail {}".format(
-                fi.get("GUID"), e
+            time.sleep(e.retry_in)
+            continue
+        except Exception as e:
+            # Don't break for any reason
+            logging.error(
+                "Can not update/create an indexd record with guid {}. Detail {}".format(
+                    fi.get("GUID"), e
+                )
             )
-        )
+        break
 
     thread_control.mutexLock.acquire()
     thread_control.num_processed_files += 1
@@ -345,6 +267,110 @@ def _index_record(indexclient, replace_urls, thread_control, fi):
     thread_control.mutexLock.release()
 
 
+def _create_or_update_record(indexclient, replace_urls, fi):
+    """
+    Create the indexd record of a file, or update the existing one
+
+    Args:
+        indexclient(IndexClient): indexd client
+        replace_urls(bool): replace urls or not
+        fi(dict): file info
+
+    Returns:
+        None
+
+    """
+    urls = (
+        [
+            element.strip().replace("'", "")
+            for element in _standardize_str(fi["url"]).strip()[1:-1].split(" ")
+        ]
+        if "url" in fi and fi["url"] != "[]"
+        else []
+    )
+    authz = (
+        [
+            element.strip().replace("'", "")
+            for element in _standardize_str(fi["authz"]).strip()[1:-1].split(" ")
+        ]
+        if "authz" in fi and fi["authz"] != "[]"
+        else []
+    )
+
+    if "acl" in fi:
+        if fi["acl"].strip().lower() in {"[u'open']", "['open']"}:
+            acl = ["*"]
+        else:
+            acl = (
+                [
+                    element.strip().replace("'", "")
+                    for element in _standardize_str(fi["acl"]).strip()[1:-1].split(" ")
+                ]
+                if "acl" in fi and fi["acl"] != "[]"
+                else []
+            )
+    else:
+        acl = []
+
+    doc = None
+
+    if fi.get("GUID"):
+        doc = indexclient.get(fi["GUID"])
+
+    if doc is not None:
+        if doc.size != fi.get("size") or doc.hashes.get("md5") != fi.get("md5"):
+            logging.error(
+                "The guid {} with different size/hash already exist. Can not index it without getting a new GUID".format(
+                    fi.get("GUID")
+                )
+            )
+        else:
+            need_update = False
+
+            if replace_urls and set(urls) != set(doc.urls):
+                doc.urls = urls
+                need_update = True
+
+                # indexd doesn't like when records have metadata for non-existing
+                # urls
+                new_urls_metadata = copy.deepcopy(doc.urls_metadata)
+                for url, metadata in doc.urls_metadata.items():
+                    if url not in urls:
+                        del new_urls_metadata[url]
+                doc.urls_metadata = new_urls_metadata
+
+            elif not replace_urls:
+                for url in urls:
+                    if url not in doc.urls:
+                        doc.urls.append(url)
+                        need_update = True
+
+            if set(doc.acl) != set(acl):
+                doc.acl = acl
+                need_update = True
+
+            if set(doc.authz) != set(authz):
+                doc.authz = authz
+                need_update = True
+
+            if need_update:
+                doc.patch()
+    else:
+        if fi.get("GUID"):
+            guid = fi.get("GUID", "").strip()
+        else:
+            guid = None
+        doc = indexclient.create(
+            did=guid,
+            hashes={"md5": fi.get("md5", "").strip()},
+            size=fi.get("size", 0),
+            acl=acl,
+            authz=authz,
+            urls=urls,
+        )
+        fi["GUID"] = doc.did
+
+
 def index_object_manifest(
     commons_url,
     manifest_file,
@@ -390,7 +416,13 @@ def index_object_manifest(
     if not commons_url.endswith(service_location):
         commons_url += "/" + service_location
 
-    indexclient = client.IndexClient(commons_url, "v0", auth=auth)
+    # pooled connections, retries and circuit breaking of the shared transport
+    indexclient = Gen3Index(
+        commons_url,
+        auth_provider=auth,
+        service_location="",
+        transport=Gen3Transport(max_connections_per_host=thread_num),
+    ).client
 
     # if delimter not specified, try to get based on file ext
     if not manifest_file_delimiter:
@@ -38,7 +38,13 @@ Attributes:
     CURRENT_DIR (str): directory this file is in
     MAX_CONCURRENT_REQUESTS (int): maximum number of desired concurrent requests across
         processes/threads
+        NOTE - This is where concurrency starts. The limit then adapts to indexd's
+              latency and errors (see gen3.concurrency), up to
+              MAX_ADAPTIVE_CONCURRENT_REQUESTS.
+    MAX_ADAPTIVE_CONCURRENT_REQUESTS (int): ceiling for the adapted number of concurrent
+        requests
 """
+import aiohttp
 import asyncio
 import click
 import time
@@ -50,9 +56,14 @@ import sys
 import shutil
 import math
 
+from gen3.circuit_breaker import CircuitOpenError
+from gen3.concurrency import AdaptiveConcurrencyLimiter, is_overload_error
 from gen3.index import Gen3Index
+from gen3.rate_limit import RateLimiter
+from gen3.transport import Gen3Transport
 
 MAX_CONCURRENT_REQUESTS = 24
+MAX_ADAPTIVE_CONCURRENT_REQUESTS = 256
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -195,6 +206,8 @@ async def async_verify_object_manifest(
     manifest_row_parsers=manifest_row_parsers,
     manifest_file_delimiter=None,
     output_filename=f"verify-manifest-errors-{time.time()}.log",
+    auth=None,
+    max_requests_per_second=None,
 ):
     """
     Verify all file object records into a manifest csv
@@ -206,6 +219,9 @@ async def async_verify_object_manifest(
         manifest_row_parsers (Dict{indexd_field:func_to_parse_row}): Row parsers
         manifest_file_delimiter (str): delimeter in manifest_file
         output_filename (str): filename for output logs
+        auth (Gen3Auth, optional): auth provider, required to verify records the
+            anonymous user can't read
+        max_requests_per_second (float, optional): maximum rate of requests to indexd
     """
     start_time = time.perf_counter()
     logging.info(f"start time: {start_time}")
@@ -225,6 +241,8 @@ async def async_verify_object_manifest(
         manifest_file_delimiter,
         max_concurrent_requests,
         output_filename.split("/")[-1],
+        auth,
+        max_requests_per_second,
     )
 
     end_time = time.perf_counter()
@@ -238,6 +256,8 @@ async def _verify_all_index_records_in_file(
     manifest_file_delimiter,
     max_concurrent_requests,
     output_filename,
+    auth=None,
+    max_requests_per_second=None,
 ):
     """
     Getting indexd records and writing to a file. This function
@@ -255,10 +275,18 @@ async def _verify_all_index_records_in_file(
         manifest_file_delimiter (str): delimeter in manifest_file
         output_filename (str, optional): filename for output
         max_concurrent_requests (int): the maximum number of concurrent requests allowed
+        auth (Gen3Auth, optional): auth provider
+        max_requests_per_second (float, optional): maximum rate of requests to indexd
     """
     max_requests = int(max_concurrent_requests)
     logging.debug(f"max concurrent requests: {max_requests}")
-    lock = asyncio.Semaphore(max_requests)
+    lock = AdaptiveConcurrencyLimiter(
+        initial_limit=max_requests,
+        max_limit=max(max_requests, MAX_ADAPTIVE_CONCURRENT_REQUESTS),
+        name="indexd",
+    )
+    # enough coroutines to make use of the highest limit
+    num_workers = int(lock.max_limit + (lock.max_limit / 4))
     queue = asyncio.Queue()
     output_queue = asyncio.Queue()
 
@@ -270,17 +298,30 @@ async def _verify_all_index_records_in_file(
                 new_row[key.strip()] = value.strip()
             await queue.put(new_row)
 
-    for _ in range(0, int(max_concurrent_requests + (max_concurrent_requests / 4))):
+    for _ in range(0, num_workers):
         await queue.put("DONE")
 
-    await asyncio.gather(
-        *(
-            _parse_from_queue(queue, lock, commons_url, output_queue)
-            for x in range(
-                0, int(max_concurrent_requests + (max_concurrent_requests / 4))
+    rate_limiter = None
+    if max_requests_per_second:
+        rate_limiter = RateLimiter(max_requests_per_second)
+    # one client and connection pool shared by all the coroutines
+    index = Gen3Index(
+        commons_url,
+        auth_provider=auth,
+        transport=Gen3Transport(
+            max_connections=lock.max_limit,
+            max_connections_per_host=lock.max_limit,
+            rate_limiter=rate_limiter,
+        ),
+    )
+    async with index:
+        await asyncio.gather(
+            *(
+                _parse_from_queue(queue, lock, commons_url, output_queue, index)
+                for x in range(0, num_workers)
             )
         )
-    )
+    logging.info(f"concurrency stats: {lock.stats}")
 
     output_filename = os.path.abspath(output_filename)
     logging.info(
@@ -299,7 +340,7 @@ async def _verify_all_index_records_in_file(
     logging.info(f"done writing output to file {output_filename}")
 
 
-async def _parse_from_queue(queue, lock, commons_url, output_queue):
+async def _parse_from_queue(queue, lock, commons_url, output_queue, index):
     """
     Keep getting items from the queue and verifying that indexd contains the expected
     fields from that row. If there are any issues, log errors into a file. Return
@@ -307,10 +348,11 @@ async def _parse_from_queue(queue, lock, commons_url, output_queue):
 
     Args:
         queue (asyncio.Queue): queue to read indexd records from
-        lock (asyncio.Semaphore): semaphones used to limit ammount of concurrent http
+        lock (AdaptiveConcurrencyLimiter): limiter for the amount of concurrent http
             connections
         commons_url (str): root domain for commons where indexd lives
         output_queue (asyncio.Queue): queue for output
+        index (Gen3Index): client to request records with
     """
     loop = asyncio.get_event_loop()
 
@@ -325,7 +367,7 @@ async def _parse_from_queue(queue, lock, commons_url, output_queue):
         urls = manifest_row_parsers["urls"](row)
         file_name = manifest_row_parsers["file_name"](row)
 
-        actual_record = await _get_record_from_indexd(guid, commons_url, lock)
+        actual_record = await _get_record_from_indexd(guid, commons_url, lock, index)
         if not actual_record:
             output = f"{guid}|no_record|expected {row}|actual None\n"
             await output_queue.put(output)
@@ -392,24 +434,35 @@ async def _parse_from_queue(queue, lock, commons_url, output_queue):
         row = await queue.get()
 
 
-async def _get_record_from_indexd(guid, commons_url, lock):
+async def _get_record_from_indexd(guid, commons_url, lock, index):
     """
-    Gets a semaphore then requests a record for the given guid
+    Gets a semaphore then requests a record for the given guid. While indexd's
+    circuit is open, waits for it to let requests through again. A 429 or 5xx
+    response lowers the limit of the lock and the record is requested again.
 
     Args:
         guid (str): indexd record globally unique id
         commons_url (str): root domain for commons where indexd lives
-        lock (asyncio.Semaphore): semaphones used to limit ammount of concurrent http
+        lock (AdaptiveConcurrencyLimiter): limiter for the amount of concurrent http
             connections
+        index (Gen3Index): client to request the record with
     """
-    index = Gen3Index(commons_url)
-    async with lock:
-        # default ssl handling unless it's explicitly http://
-        ssl = None
-        if "https" not in commons_url:
-            ssl = False
-
-        return await index.async_get_record(guid, _ssl=ssl)
+    # default ssl handling unless it's explicitly http://
+    ssl = None
+    if "https" not in commons_url:
+        ssl = False
+
+    while True:
+        try:
+            async with lock:
+                return await index.async_get_record(guid, _ssl=ssl)
+        except CircuitOpenError as exc:
+            logging.warning(f"pausing {exc.retry_in:.1f} seconds: {exc}")
+            await asyncio.sleep(exc.retry_in)
+        except aiohttp.ClientResponseError as exc:
+            if not is_overload_error(exc):
+                raise
+            logging.warning(f"indexd overloaded, requesting {guid} again: {exc}")
 
 
 if __name__ == "__main__":
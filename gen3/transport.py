@@ -0,0 +1,281 @@
+"""
+Shared HTTP transport for the SDK clients.
+
+Module level ``requests.get/post/...`` calls open a new TCP (and TLS) connection
+for every request. A Gen3Transport owns a keep-alive ``requests.Session`` with a
+connection pool, and the aiohttp sessions used by the asynchronous methods, so
+that Gen3Submission, Gen3File and Gen3Index instances sharing it reuse connections.
+
+Attributes:
+    DEFAULT_POOL_CONNECTIONS (int): number of per-host connection pools to keep
+    DEFAULT_MAX_CONNECTIONS_PER_HOST (int): connections kept alive per host
+    DEFAULT_MAX_CONNECTIONS (int): total connection limit of aiohttp sessions
+    DEFAULT_TIMEOUT (float): seconds to wait to connect and between bytes read
+    DEFAULT_DNS_CACHE_TTL (int): seconds aiohttp caches DNS lookups for
+"""
+import asyncio
+import logging
+import threading
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from gen3.circuit_breaker import (
+    CircuitBreaker,
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_RECOVERY_TIMEOUT,
+    service_name,
+)
+from gen3.retry import RetryPolicy
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 32
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_TIMEOUT = 60
+DEFAULT_DNS_CACHE_TTL = 300
+
+
+class Gen3Transport:
+    """
+    Connection-pooling HTTP layer that can be shared by several SDK clients.
+
+    Synchronous requests go through one ``requests.Session``. Asynchronous
+    requests use an aiohttp session per event loop, which is kept open while
+    the transport is used as an async context manager; outside of it every
+    asynchronous call gets a short-lived session.
+
+    Each service (indexd, sheepdog, peregrine, fence) of each host gets a
+    CircuitBreaker, so requests to a service that keeps failing raise a
+    CircuitOpenError right away instead of waiting for it.
+
+    Args:
+        pool_connections (int): number of per-host connection pools to keep
+        max_connections_per_host (int): connections kept alive (sync) or open at
+            once (async) per host
+        max_connections (int): total number of connections aiohttp opens at once
+        timeout (float or tuple): default timeout in seconds, either one value or
+            a (connect, read) tuple like requests takes
+        dns_cache_ttl (int): seconds aiohttp caches DNS lookups for
+        rate_limiter (RateLimiter): optional limiter every request sent through
+            the transport waits on
+        retry_policy (RetryPolicy): how failed requests are retried; defaults to
+            a RetryPolicy with default settings
+        failure_threshold (int): consecutive failures that open the circuit of a
+            service; None to disable the circuit breakers
+        recovery_timeout (float): seconds an open circuit waits before it lets a
+            probe request through
+
+    Examples:
+        Sharing one transport between clients of the same commons.
+
+        >>> transport = Gen3Transport(max_connections_per_host=64)
+        ... sub = Gen3Submission(endpoint, auth, transport=transport)
+        ... index = Gen3Index(endpoint, auth, transport=transport)
+
+    """
+
+    def __init__(
+        self,
+        pool_connections=DEFAULT_POOL_CONNECTIONS,
+        max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        timeout=DEFAULT_TIMEOUT,
+        dns_cache_ttl=DEFAULT_DNS_CACHE_TTL,
+        rate_limiter=None,
+        retry_policy=None,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        recovery_timeout=DEFAULT_RECOVERY_TIMEOUT,
+    ):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._max_connections = max_connections
+        self._max_connections_per_host = max_connections_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=max_connections_per_host
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # event loop -> [aiohttp.ClientSession, number of open contexts]
+        self._aiohttp_sessions = {}
+        # service name -> CircuitBreaker
+        self._circuit_breakers = {}
+        self._circuit_breakers_lock = threading.Lock()
+
+    def request(self, method, url, idempotent=None, retry_policy=None, **kwargs):
+        """
+        Send a request through the pooled session, retrying it as the retry
+        policy allows. Takes the same arguments as ``requests.request`` and
+        applies the default timeout.
+
+        Args:
+            method (str): HTTP method
+            url (str): url to request
+            idempotent (bool): whether the request is safe to send again after
+                it may have been processed, like a POST that only reads; by
+                default derived from the method
+            retry_policy (RetryPolicy): policy to use instead of the transport's
+            **kwargs: passed to requests.Session.request
+
+        Returns:
+            requests.Response: the last response received
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        circuit_breaker = self.circuit_breaker(url)
+
+        def send():
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            return self.session.request(method, url, **kwargs)
+
+        retry_policy = retry_policy or self.retry_policy
+        return retry_policy.call(
+            lambda: circuit_breaker.call(send), method, url, idempotent=idempotent
+        )
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def circuit_breaker(self, url):
+        """
+        Return the circuit breaker of the service a url belongs to
+
+        Args:
+            url (str): request url
+
+        Returns:
+            CircuitBreaker: breaker shared by all requests to the service
+        """
+        name = service_name(url)
+        with self._circuit_breakers_lock:
+            if name not in self._circuit_breakers:
+                self._circuit_breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=self.failure_threshold,
+                    recovery_timeout=self.recovery_timeout,
+                )
+            return self._circuit_breakers[name]
+
+    def close(self):
+        """
+        Close the pooled connections of the synchronous session
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def new_aiohttp_session(self):
+        """
+        Create an aiohttp session with this transport's connection limits and
+        timeouts. The caller is responsible for closing it.
+
+        Returns:
+            aiohttp.ClientSession: new session bound to the running event loop
+        """
+        connector = aiohttp.TCPConnector(
+            limit=self._max_connections,
+            limit_per_host=self._max_connections_per_host,
+            ttl_dns_cache=self._dns_cache_ttl,
+        )
+        if isinstance(self.timeout, tuple):
+            connect_timeout, read_timeout = self.timeout
+        else:
+            connect_timeout = read_timeout = self.timeout
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        trace_configs = []
+        if self.rate_limiter:
+            # wait for the limiter before every request, including redirects
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_configs.append(trace_config)
+        return aiohttp.ClientSession(
+            connector=connector, timeout=timeout, trace_configs=trace_configs
+        )
+
+    async def _on_request_start(self, session, trace_config_ctx, params):
+        await self.rate_limiter.async_acquire()
+
+    def aiohttp_session(self):
+        """
+        Async context manager giving the aiohttp session to send a request with:
+        the long-lived session of the current event loop when the transport is
+        open, otherwise a new one that is closed on exit.
+
+        Examples:
+            >>> async with transport.aiohttp_session() as session:
+            ...     async with session.get(url) as response:
+            ...         data = await response.json()
+        """
+        return _AiohttpSessionContext(self)
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        entry = self._aiohttp_sessions.get(loop)
+        if entry is None:
+            entry = [self.new_aiohttp_session(), 0]
+            self._aiohttp_sessions[loop] = entry
+        entry[1] += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        loop = asyncio.get_event_loop()
+        entry = self._aiohttp_sessions.get(loop)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._aiohttp_sessions[loop]
+            await entry[0].close()
+            logging.debug("closed shared aiohttp session")
+
+    def _get_open_aiohttp_session(self):
+        entry = self._aiohttp_sessions.get(asyncio.get_event_loop())
+        if entry is None or entry[0].closed:
+            return None
+        return entry[0]
+
+
+class _AiohttpSessionContext:
+    """
+    Returned by Gen3Transport.aiohttp_session
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._owned_session = None
+
+    async def __aenter__(self):
+        session = self._transport._get_open_aiohttp_session()
+        if session is not None:
+            return session
+        self._owned_session = self._transport.new_aiohttp_session()
+        return self._owned_session
+
+    async def __aexit__(self, *exc_info):
+        if self._owned_session is not None:
+            await self._owned_session.close()
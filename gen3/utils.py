@@ -0,0 +1,67 @@
+"""
+Helpers shared across the SDK that don't belong to a single service.
+"""
+import contextlib
+import logging
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, locks become no-ops there
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    Context manager holding an advisory lock on the file at ``path`` so that
+    cooperating processes on the same node can serialize work. The file is
+    created if it doesn't exist.
+
+    Args:
+        path (str): path of the lock file
+        shared (bool): take a shared (read) lock instead of an exclusive one
+        blocking (bool): wait for the lock; otherwise raise BlockingIOError
+            when another process holds it
+    """
+    with open(path, "a") as lock_file:
+        if fcntl is None:
+            logging.debug(f"file locking not supported, not locking {path}")
+            yield lock_file
+            return
+
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        fcntl.flock(lock_file, operation)
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def atomic_write(path, data, mode=0o600):
+    """
+    Write ``data`` to ``path`` so that readers never see a partial file: the
+    data is written to a temporary file in the same directory, which then
+    replaces ``path``.
+
+    Args:
+        path (str): destination file
+        data (str): content to write
+        mode (int): permissions of the written file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
@@ -38,7 +38,6 @@ setup(
         "pandas",
         "indexclient>=1.6.2",
         "aiohttp",
-        "backoff",
         "click",
     ],
     package_data={"": ["LICENSE"]},
@@ -0,0 +1,277 @@
+"""
+AsyncGen3Index tests against a small in-memory indexd served by aiohttp.
+"""
+
+import asyncio
+from unittest.mock import patch
+
+from aiohttp import web
+import pytest
+
+from gen3.index import AsyncGen3Index
+from gen3.record_cache import RecordCache
+from gen3.transport import Gen3Transport
+
+
+def _record(i, **fields):
+    return {
+        "did": f"dg.TEST/{i:04x}",
+        "rev": "r1",
+        "baseid": f"base-{i}",
+        "hashes": {"md5": f"{i:032x}"},
+        "size": i,
+        "urls": [f"s3://bucket/{i}"],
+        "authz": ["/programs/DEV"],
+        **fields,
+    }
+
+
+class FakeIndexd:
+    def __init__(self, records):
+        self.records = {record["did"]: record for record in records}
+        self.requests = []
+
+    def routes(self):
+        return [
+            web.get("/_status", self.status),
+            web.get("/index/", self.list),
+            web.get("/index", self.list),
+            web.post("/index/", self.create),
+            web.get("/index/{guid:.+}/latest", self.latest),
+            web.get("/index/{guid:.+}", self.get),
+            web.put("/index/{guid:.+}", self.update),
+            web.delete("/index/{guid:.+}", self.delete),
+            web.post("/bulk/documents", self.bulk),
+            web.get("/urls", self.urls),
+        ]
+
+    @web.middleware
+    async def log(self, request, handler):
+        self.requests.append((request.method, request.path, dict(request.query)))
+        return await handler(request)
+
+    async def status(self, request):
+        return web.Response(text="Healthy")
+
+    async def list(self, request):
+        records = sorted(self.records.values(), key=lambda r: r["did"])
+        if "start" in request.query:
+            records = [r for r in records if r["did"] > request.query["start"]]
+        for value in request.query.getall("hash", []):
+            algorithm, value = value.split(":")
+            records = [r for r in records if r["hashes"].get(algorithm) == value]
+        if "size" in request.query:
+            records = [r for r in records if str(r["size"]) == request.query["size"]]
+        limit = int(request.query.get("limit", 100))
+        return web.json_response({"records": records[:limit]})
+
+    async def get(self, request):
+        record = self.records.get(request.match_info["guid"])
+        if not record:
+            return web.json_response({"error": "no record found"}, status=404)
+        return web.json_response(record)
+
+    async def latest(self, request):
+        assert request.query["has_version"] == "false"
+        return await self.get(request)
+
+    async def create(self, request):
+        record = await request.json()
+        if None in record.values():
+            return _null_fields_error(record)
+        record = dict(record, rev="r1", baseid=record.get("baseid") or "new")
+        self.records[record["did"]] = record
+        return web.json_response(
+            {"did": record["did"], "rev": "r1", "baseid": record["baseid"]}
+        )
+
+    async def update(self, request):
+        record = self.records[request.match_info["guid"]]
+        if request.query["rev"] != record["rev"]:
+            return web.json_response({"error": "revision mismatch"}, status=409)
+        changes = await request.json()
+        if None in changes.values():
+            return _null_fields_error(changes)
+        record.update(changes, rev=record["rev"] + "+")
+        return web.json_response(
+            {"did": record["did"], "rev": record["rev"], "baseid": record["baseid"]}
+        )
+
+    async def delete(self, request):
+        record = self.records[request.match_info["guid"]]
+        if request.query["rev"] != record["rev"]:
+            return web.json_response({"error": "revision mismatch"}, status=409)
+        del self.records[record["did"]]
+        return web.Response()
+
+    async def bulk(self, request):
+        dids = await request.json()
+        return web.json_response([self.records[d] for d in dids if d in self.records])
+
+    async def urls(self, request):
+        dids = request.query["ids"].split(",")
+        start, limit = int(request.query["start"]), int(request.query["limit"])
+        urls = [
+            {"url": url, "metadata": {}}
+            for did in dids
+            if did in self.records
+            for url in self.records[did]["urls"]
+        ]
+        return web.json_response(
+            {
+                "urls": urls[start : start + limit],
+                "limit": limit,
+                "start": start,
+                "size": None,
+                "hashes": [],
+            }
+        )
+
+
+def _null_fields_error(body):
+    # like indexd's json schema validation
+    fields = sorted(key for key, value in body.items() if value is None)
+    return web.json_response({"error": f"null fields: {fields}"}, status=400)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def indexd(loop):
+    """
+    Serve a FakeIndexd with 20 records and yield (fake, AsyncGen3Index)
+    """
+    fake = FakeIndexd([_record(i) for i in range(20)])
+    app = web.Application(middlewares=[fake.log])
+    app.add_routes(fake.routes())
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+
+    index = AsyncGen3Index(
+        f"http://127.0.0.1:{port}",
+        service_location="",
+        transport=Gen3Transport(),
+        record_cache=RecordCache(),
+    )
+    loop.run_until_complete(index.__aenter__())
+    yield fake, index
+    loop.run_until_complete(index.__aexit__(None, None, None))
+    loop.run_until_complete(runner.cleanup())
+
+
+def test_reads(loop, indexd):
+    fake, index = indexd
+
+    async def read():
+        assert await index.is_healthy()
+        assert await index.get_record("dg.TEST/0003") == _record(3)
+        assert await index.get_record("dg.TEST/0003") == _record(3)
+        assert await index.get_record("missing") is None
+        assert await index.get_latest_version("dg.TEST/0004") == _record(4)
+        match = await index.get_with_params({"hashes": {"md5": f"{5:032x}"}, "size": 5})
+        assert match == _record(5)
+        assert await index.get_with_params({"size": 1000}) is None
+        found, missing = await index.bulk_get_records(["dg.TEST/0001", "missing"])
+        assert found == [_record(1)] and missing == ["missing"]
+
+        records = [r async for r in index.iter_records(page_size=3, end="dg.TEST/000a")]
+        assert [r["did"] for r in records] == [f"dg.TEST/{i:04x}" for i in range(11)]
+        scanned = [
+            r["did"] async for r in index.scan_records(num_shards=4, page_size=3)
+        ]
+        assert sorted(scanned) == sorted(fake.records)
+
+        guids = await index.get_guids_by_hash(
+            [(f"{6:032x}", 6), (f"{6:032x}", 6), (f"{7:032x}", None), ("f" * 32, 1)],
+            max_concurrency=2,
+        )
+        assert guids == {
+            (f"{6:032x}", 6): ["dg.TEST/0006"],
+            (f"{7:032x}", None): ["dg.TEST/0007"],
+            ("f" * 32, 1): [],
+        }
+
+    loop.run_until_complete(read())
+    gets = [r for r in fake.requests if r[1] == "/index/dg.TEST/0003"]
+    assert len(gets) == 1
+    assert index.record_cache.stats()["hits"] == 1
+
+
+def test_writes(loop, indexd):
+    fake, index = indexd
+
+    async def write():
+        created = await index.create_record(
+            {"md5": "a" * 32}, 1, did="dg.TEST/new", urls=["s3://a/b"]
+        )
+        assert created["rev"] == "r1" and created["urls"] == ["s3://a/b"]
+
+        await index.get_record("dg.TEST/0001")
+        fake.requests.clear()
+        updated = await index.update_record(
+            "dg.TEST/0001", file_name="a.txt", rev="r1", refetch=False
+        )
+        assert updated == {
+            "did": "dg.TEST/0001",
+            "rev": "r1+",
+            "baseid": "base-1",
+            "file_name": "a.txt",
+        }
+        assert [r[0] for r in fake.requests] == ["PUT"]
+        # the update dropped the cached record
+        assert (await index.get_record("dg.TEST/0001"))["file_name"] == "a.txt"
+
+        deleted = await index.delete_record("dg.TEST/0002")
+        assert deleted == _record(2)
+        assert await index.get_record("dg.TEST/0002") is None
+
+        results = await index.bulk_upsert(
+            [
+                {"did": "dg.TEST/0003", "authz": ["/programs/PROD"]},
+                {"did": "dg.TEST/0004", "size": 4},
+                {"did": "dg.TEST/0005", "size": 6},
+                {"did": "dg.TEST/0100", "hashes": {"md5": "b" * 32}, "size": 2},
+            ],
+            batch_size=2,
+        )
+        assert [r["result"] for r in results] == [
+            "updated",
+            "unchanged",
+            "failed",
+            "created",
+        ]
+        assert fake.records["dg.TEST/0003"]["authz"] == ["/programs/PROD"]
+        assert "dg.TEST/0100" in fake.records
+
+    loop.run_until_complete(write())
+
+
+def test_urls(loop, indexd):
+    fake, index = indexd
+    guids = [f"dg.TEST/{i:04x}" for i in range(20)]
+
+    async def resolve():
+        with patch("gen3.index.MAX_URL_LENGTH", 200):
+            urls = await index.get_urls(guids=guids + ["missing"], max_concurrency=3)
+        assert sorted(urls) == sorted(f"s3://bucket/{i}" for i in range(20))
+
+        with patch("gen3.index.URLS_PAGE_SIZE", 3):
+            urls = await index.get_urls(guids=guids[:7])
+        assert urls == [f"s3://bucket/{i}" for i in range(7)]
+
+        streamed = [
+            pair async for pair in index.iter_urls(["dg.TEST/0002", "x"], batch_size=1)
+        ]
+        assert streamed == [("dg.TEST/0002", ["s3://bucket/2"]), ("x", None)]
+
+    loop.run_until_complete(resolve())
+    assert len([r for r in fake.requests if r[1] == "/urls"]) > 1
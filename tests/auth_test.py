@@ -0,0 +1,214 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from gen3.auth import Gen3Auth, decode_token
+
+
+def _make_token(exp):
+    """
+    Build an unsigned JWT with the given expiration
+    """
+    header = base64.urlsafe_b64encode(b'{"alg":"none"}').decode().rstrip("=")
+    payload = (
+        base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    )
+    return f"{header}.{payload}.sig"
+
+
+def _mock_fence(mock_requests, *tokens):
+    responses = []
+    for token in tokens:
+        response = MagicMock()
+        response.json.return_value = {"access_token": token}
+        responses.append(response)
+    mock_requests.post.side_effect = responses
+
+
+@pytest.fixture
+def auth():
+    return Gen3Auth(
+        "https://example.com",
+        refresh_token={"api_key": "abc", "key_id": "123"},
+        refresh_skew=60,
+    )
+
+
+def test_decode_token():
+    assert decode_token(_make_token(1234))["exp"] == 1234
+
+
+def test_token_fetched_when_missing(auth):
+    token = _make_token(time.time() + 3600)
+    with patch("gen3.auth.requests") as mock_requests:
+        _mock_fence(mock_requests, token)
+        assert auth._get_auth_value() == "Bearer " + token
+        # a fresh token is reused
+        assert auth._get_auth_value() == "Bearer " + token
+        assert mock_requests.post.call_count == 1
+
+
+def test_expired_token_refreshed_synchronously(auth):
+    expired = _make_token(time.time() - 10)
+    fresh = _make_token(time.time() + 3600)
+    with patch("gen3.auth.requests") as mock_requests:
+        _mock_fence(mock_requests, expired, fresh)
+        auth._get_auth_value()
+        assert auth._get_auth_value() == "Bearer " + fresh
+        assert mock_requests.post.call_count == 2
+
+
+def test_token_refreshed_in_background_before_expiry(auth):
+    expiring = _make_token(time.time() + 30)
+    fresh = _make_token(time.time() + 3600)
+    released = threading.Event()
+    tokens = iter([expiring, fresh])
+
+    def _post(*args, **kwargs):
+        token = next(tokens)
+        if token == fresh:
+            released.wait(5)
+        response = MagicMock()
+        response.json.return_value = {"access_token": token}
+        return response
+
+    with patch("gen3.auth.requests") as mock_requests:
+        mock_requests.post.side_effect = _post
+        auth._get_auth_value()
+        # still valid, so the current token is used while refreshing
+        assert auth._get_auth_value() == "Bearer " + expiring
+        released.set()
+        auth._refresh_thread.join()
+        assert auth._get_auth_value() == "Bearer " + fresh
+        assert mock_requests.post.call_count == 2
+
+
+def test_token_without_exp_is_not_refreshed(auth):
+    with patch("gen3.auth.requests") as mock_requests:
+        _mock_fence(mock_requests, "not-a-jwt")
+        auth._get_auth_value()
+        assert auth._get_auth_value() == "Bearer not-a-jwt"
+        assert mock_requests.post.call_count == 1
+
+
+def _slow_fence(mock_requests, token):
+    def _post(*args, **kwargs):
+        time.sleep(0.1)
+        response = MagicMock()
+        response.json.return_value = {"access_token": token}
+        return response
+
+    mock_requests.post.side_effect = _post
+
+
+def test_concurrent_thread_refreshes_are_coalesced(auth):
+    token = _make_token(time.time() + 3600)
+    with patch("gen3.auth.requests") as mock_requests:
+        _slow_fence(mock_requests, token)
+        threads = [threading.Thread(target=auth._get_auth_value) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert mock_requests.post.call_count == 1
+        assert auth.refresh_stats["issued"] == 1
+        assert auth.refresh_stats["coalesced"] == 15
+
+
+def test_concurrent_coroutine_refreshes_are_coalesced(auth):
+    token = _make_token(time.time() + 3600)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with patch("gen3.auth.requests") as mock_requests:
+        _slow_fence(mock_requests, token)
+        values = loop.run_until_complete(
+            asyncio.gather(*(auth._async_get_auth_value() for _ in range(10)))
+        )
+
+    assert set(values) == {"Bearer " + token}
+    assert mock_requests.post.call_count == 1
+    assert auth.refresh_stats["issued"] == 1
+
+
+def test_401_does_not_refresh_an_already_replaced_token(auth):
+    fresh = _make_token(time.time() + 3600)
+    response = MagicMock()
+    response.status_code = 401
+    response.request.headers = {"Authorization": "Bearer rejected"}
+    response.request.copy.return_value = MagicMock(headers={})
+    with patch("gen3.auth.requests") as mock_requests:
+        _mock_fence(mock_requests, fresh)
+        auth._get_auth_value()
+        auth._handle_401(response)
+
+    assert mock_requests.post.call_count == 1
+    assert auth.refresh_stats["coalesced"] == 1
+    resent = response.connection.send.call_args[0][0]
+    assert resent.headers["Authorization"] == "Bearer " + fresh
+
+
+def test_token_cache_shared_between_instances(tmpdir):
+    token = _make_token(time.time() + 3600)
+    refresh_token = {"api_key": "abc", "key_id": "123"}
+    first = Gen3Auth(
+        "https://example.com", refresh_token=refresh_token, token_cache_dir=tmpdir
+    )
+    second = Gen3Auth(
+        "https://example.com", refresh_token=refresh_token, token_cache_dir=tmpdir
+    )
+    with patch("gen3.auth.requests") as mock_requests:
+        _mock_fence(mock_requests, token)
+        assert first._get_auth_value() == "Bearer " + token
+        assert second._get_auth_value() == "Bearer " + token
+
+    assert mock_requests.post.call_count == 1
+    assert second.refresh_stats["cached"] == 1
+
+
+def test_token_cache_skips_rejected_and_expiring_tokens(tmpdir):
+    refresh_token = {"api_key": "abc", "key_id": "123"}
+    auth = Gen3Auth(
+        "https://example.com",
+        refresh_token=refresh_token,
+        refresh_skew=60,
+        token_cache_dir=tmpdir,
+    )
+    expiring = _make_token(time.time() + 30)
+    fresh = _make_token(time.time() + 3600)
+    auth._write_token_cache(expiring)
+    assert auth._read_token_cache(stale_token=None) is None
+
+    auth._write_token_cache(fresh)
+    assert auth._read_token_cache(stale_token=None) == fresh
+    assert auth._read_token_cache(stale_token=fresh) is None
+
+
+def test_token_cache_keyed_by_commons_and_key_id(tmpdir):
+    auth = Gen3Auth(
+        "https://example.com",
+        refresh_token={"api_key": "abc", "key_id": "123"},
+        token_cache_dir=tmpdir,
+    )
+    other_key = Gen3Auth(
+        "https://example.com",
+        refresh_token={"api_key": "def", "key_id": "456"},
+        token_cache_dir=tmpdir,
+    )
+    other_commons = Gen3Auth(
+        "https://other.example.com",
+        refresh_token={"api_key": "abc", "key_id": "123"},
+        token_cache_dir=tmpdir,
+    )
+    paths = {
+        auth._token_cache_path,
+        other_key._token_cache_path,
+        other_commons._token_cache_path,
+    }
+    assert len(paths) == 3
+    assert "abc" not in auth._token_cache_path
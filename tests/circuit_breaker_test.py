@@ -0,0 +1,114 @@
+import io
+import time
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+
+from gen3.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    service_name,
+)
+from gen3.retry import RetryPolicy
+from gen3.tools.indexing.index_manifest import ThreadControl, _index_record
+from gen3.transport import Gen3Transport
+
+
+def _response(status):
+    response = requests.Response()
+    response.status_code = status
+    response.raw = io.BytesIO(b"")
+    return response
+
+
+def _fail(breaker, times):
+    for _ in range(times):
+        breaker.call(lambda: _response(503))
+
+
+def test_opens_after_threshold_and_fails_fast():
+    breaker = CircuitBreaker("indexd", failure_threshold=3, recovery_timeout=60)
+    _fail(breaker, 2)
+    assert breaker.state == CLOSED
+
+    _fail(breaker, 1)
+    assert breaker.state == OPEN
+    send = MagicMock()
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.call(send)
+    send.assert_not_called()
+    assert 59 < excinfo.value.retry_in <= 60
+
+
+def test_client_errors_and_successes_keep_it_closed():
+    breaker = CircuitBreaker("indexd", failure_threshold=2)
+    _fail(breaker, 1)
+    breaker.call(lambda: _response(404))
+    _fail(breaker, 1)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe():
+    breaker = CircuitBreaker("indexd", failure_threshold=1, recovery_timeout=0.05)
+    _fail(breaker, 1)
+    time.sleep(0.06)
+
+    # one probe at a time while half-open
+    breaker.before_request()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    # a failed probe opens the circuit again
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    time.sleep(0.06)
+    breaker.call(lambda: _response(200))
+    assert breaker.state == CLOSED
+
+
+def test_service_name():
+    assert service_name("https://a.org/index/index/abc") == "indexd at a.org"
+    assert service_name("https://a.org/api/v0/submission/graphql") == (
+        "peregrine at a.org"
+    )
+    assert service_name("https://a.org/api/v0/submission/prog") == "sheepdog at a.org"
+    assert service_name("https://a.org/user/data/download/abc") == "fence at a.org"
+    assert service_name("http://localhost:8080/_status") == "localhost:8080"
+
+
+def test_transport_breaker_per_service():
+    transport = Gen3Transport(
+        retry_policy=RetryPolicy(max_tries=1), failure_threshold=2
+    )
+    transport.session = MagicMock()
+    transport.session.request.return_value = _response(502)
+
+    for _ in range(2):
+        transport.get("https://a.org/index/index/abc")
+    with pytest.raises(CircuitOpenError):
+        transport.get("https://a.org/index/index/abc")
+    assert transport.session.request.call_count == 2
+
+    # other services of the commons are not affected
+    transport.session.request.return_value = _response(200)
+    assert transport.get("https://a.org/api/v0/submission/").status_code == 200
+
+
+def test_index_manifest_pauses_while_open():
+    indexclient = MagicMock()
+    indexclient.get.side_effect = [CircuitOpenError("indexd", 0.01), None]
+    indexclient.create.return_value = MagicMock(did="guid")
+    file_info = {"GUID": "guid", "md5": "abc", "size": 1, "url": "[s3://a/b]"}
+
+    _index_record(indexclient, False, ThreadControl(num_total_files=1), file_info)
+
+    assert indexclient.get.call_count == 2
+    indexclient.create.assert_called_once()
@@ -0,0 +1,88 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import aiohttp
+import pytest
+import requests
+
+from gen3.concurrency import AdaptiveConcurrencyLimiter, is_overload_error
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def _response_error(status):
+    return aiohttp.ClientResponseError(MagicMock(), (), status=status)
+
+
+async def _request(limiter, exc=None, delay=0):
+    try:
+        async with limiter:
+            await asyncio.sleep(delay)
+            if exc:
+                raise exc
+    except type(exc) if exc else ():
+        pass
+
+
+def test_limit_grows_while_healthy(loop):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=4)
+
+    async def _run():
+        for _ in range(20):
+            await _request(limiter)
+
+    loop.run_until_complete(_run())
+    assert limiter.limit == 4
+    assert limiter.stats["increases"] == 2
+
+
+def test_overload_burst_decreases_once(loop):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+
+    async def _run():
+        await asyncio.gather(
+            *(_request(limiter, _response_error(503), delay=0.01) for _ in range(8))
+        )
+
+    loop.run_until_complete(_run())
+    assert limiter.limit == 4
+    assert limiter.stats["overloads"] == 8
+    assert limiter.stats["decreases"] == 1
+
+
+def test_client_errors_do_not_decrease(loop):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+    loop.run_until_complete(_request(limiter, _response_error(404)))
+    assert limiter.limit == 8
+
+
+def test_in_flight_never_exceeds_limit(loop):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=3, max_limit=3)
+    peak = []
+
+    async def _tracked():
+        async with limiter:
+            peak.append(limiter.stats["in_flight"])
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(asyncio.gather(*(_tracked() for _ in range(12))))
+    assert max(peak) == 3
+
+
+def test_is_overload_error():
+    assert is_overload_error(_response_error(429))
+    assert is_overload_error(_response_error(502))
+    assert not is_overload_error(_response_error(403))
+    assert is_overload_error(asyncio.TimeoutError())
+    assert is_overload_error(aiohttp.ServerDisconnectedError())
+
+    response = requests.Response()
+    response.status_code = 500
+    assert is_overload_error(requests.HTTPError(response=response))
+    assert not is_overload_error(ValueError())
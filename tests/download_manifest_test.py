@@ -0,0 +1,250 @@
+"""
+download_manifest tests against a small indexd served by aiohttp in a thread,
+so the worker processes can reach it.
+"""
+
+import asyncio
+import base64
+import csv
+import json
+import threading
+import time
+import uuid
+
+from aiohttp import web
+import pytest
+
+from gen3.auth import Gen3Auth
+from gen3.tools.indexing import download_manifest
+from gen3.utils import file_lock
+
+
+def _record(i):
+    return {
+        "did": f"dg.TEST/{uuid.uuid5(uuid.NAMESPACE_URL, str(i))}",
+        "urls": [f"s3://bucket/{i}.txt"],
+        "authz": ["/programs/DEV"],
+        "acl": ["DEV", "test"],
+        "hashes": {"md5": f"{i:032x}"},
+        "size": i,
+        "file_name": f"{i}.txt",
+    }
+
+
+class FakeIndexd:
+    """
+    Records listed in did order after the start cursor; every
+    fail_every-th request with a start cursor fails, and so do all the
+    requests starting after fail_from. Also hands out access tokens like
+    fence.
+    """
+
+    def __init__(self, records, fail_every=0, fail_from=None):
+        self.records = sorted(records, key=lambda record: record["did"])
+        self.fail_every = fail_every
+        self.fail_from = fail_from
+        self.requests = 0
+        self.token_requests = 0
+        self.authorizations = set()
+
+    async def access_token(self, request):
+        self.token_requests += 1
+        payload = json.dumps({"exp": time.time() + 3600, "n": self.token_requests})
+        payload = base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+        return web.json_response({"access_token": f"e30.{payload}.sig"})
+
+    async def list(self, request):
+        self.authorizations.add(request.headers.get("Authorization"))
+        records = self.records
+        if "start" in request.query:
+            self.requests += 1
+            if (self.fail_every and self.requests % self.fail_every == 0) or (
+                self.fail_from and request.query["start"] > self.fail_from
+            ):
+                return web.json_response({"error": "try again"}, status=400)
+            records = [r for r in records if r["did"] > request.query["start"]]
+        return web.json_response(
+            {"records": records[: int(request.query.get("limit", 100))]}
+        )
+
+
+@pytest.fixture
+def serve():
+    """
+    Serve a FakeIndexd in a thread, yield a function that starts it and
+    returns its url
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runners = []
+
+    async def start(fake):
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/index/index", fake.list),
+                web.get("/index/index/", fake.list),
+                web.post("/user/credentials/cdis/access_token", fake.access_token),
+            ]
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        runners.append(runner)
+        return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    yield lambda fake: asyncio.run_coroutine_threadsafe(start(fake), loop).result()
+
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def _manifest(records):
+    header = ["guid", " urls", " authz", " acl", " md5", " file_size", " file_name"]
+    return [header] + [
+        [
+            r["did"],
+            r["urls"][0],
+            "/programs/DEV",
+            "DEV test",
+            r["hashes"]["md5"],
+            str(r["size"]),
+            r["file_name"],
+        ]
+        for r in sorted(records, key=lambda record: record["did"])
+    ]
+
+
+def _download(url, output, **kwargs):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            download_manifest.async_download_object_manifest(
+                url, output_filename=str(output), **kwargs
+            )
+        )
+    finally:
+        loop.close()
+    with open(output) as file:
+        return list(csv.reader(file))
+
+
+def test_failed_key_ranges_are_read_again(monkeypatch, serve, tmp_path):
+    records = [_record(i) for i in range(100)]
+    monkeypatch.setattr(download_manifest, "INDEXD_RECORD_PAGE_SIZE", 7)
+
+    rows = _download(
+        serve(FakeIndexd(records, fail_every=5)),
+        tmp_path / "manifest.csv",
+        num_processes=2,
+        max_concurrent_requests=4,
+    )
+
+    assert rows == _manifest(records)
+    # the scratch directory of the run is gone
+    assert [path.name for path in tmp_path.iterdir()] == ["manifest.csv"]
+
+
+@pytest.mark.parametrize("token_cache", [True, False])
+def test_workers_share_access_tokens(monkeypatch, serve, tmp_path, token_cache):
+    monkeypatch.setattr(download_manifest, "INDEXD_RECORD_PAGE_SIZE", 7)
+    records = [_record(i) for i in range(100)]
+    fake = FakeIndexd(records)
+    url = serve(fake)
+    auth = Gen3Auth(
+        url,
+        refresh_token={"api_key": "abc", "key_id": "123"},
+        token_cache_dir=str(tmp_path / "tokens") if token_cache else None,
+    )
+
+    rows = _download(
+        url,
+        tmp_path / "manifest.csv",
+        auth=auth,
+        num_processes=3,
+        max_concurrent_requests=6,
+    )
+
+    assert rows == _manifest(records)
+    # the workers share one token, through the caller's cache or one for the run
+    assert fake.token_requests == 1
+    assert len(fake.authorizations - {None}) == 1
+
+
+def test_resume(monkeypatch, serve, tmp_path):
+    records = [_record(i) for i in range(100)]
+    monkeypatch.setattr(download_manifest, "INDEXD_RECORD_PAGE_SIZE", 7)
+    fake = FakeIndexd(records)
+    url = serve(fake)
+    output = tmp_path / "manifest.csv"
+    kwargs = {"num_processes": 2, "max_concurrent_requests": 4}
+    _download(url, output, **kwargs)
+    uninterrupted_requests = fake.requests
+    output.unlink()
+
+    fake.fail_from = sorted(record["did"] for record in records)[60]
+    with pytest.raises(RuntimeError):
+        _download(url, output, **kwargs)
+    assert not output.exists()
+    _, checkpoints = download_manifest._read_journal(
+        str(tmp_path / ".manifest.csv.download" / "journal")
+    )
+    assert sum(checkpoint["done"] for checkpoint in checkpoints.values()) == 2
+
+    fake.fail_from = None
+    fake.requests = 0
+    assert _download(url, output, resume=True, **kwargs) == _manifest(records)
+    # only the pages after the last checkpoints were requested again
+    assert fake.requests < uninterrupted_requests / 2
+    assert [path.name for path in tmp_path.iterdir()] == ["manifest.csv"]
+
+
+def test_second_run_into_the_same_output_fails(serve, tmp_path):
+    records = [_record(i) for i in range(20)]
+    url = serve(FakeIndexd(records))
+    output = tmp_path / "manifest.csv"
+    # a part of a run that is still writing
+    scratch_dir = tmp_path / ".manifest.csv.download"
+    scratch_dir.mkdir()
+    (scratch_dir / "00000-00.csv").write_text("")
+
+    with file_lock(f"{scratch_dir}.lock"):
+        with pytest.raises(RuntimeError, match="another download"):
+            _download(url, output, num_processes=2, max_concurrent_requests=4)
+        assert (scratch_dir / "00000-00.csv").exists()
+
+    assert _download(url, output, num_processes=2, max_concurrent_requests=4) == (
+        _manifest(records)
+    )
+    assert [path.name for path in tmp_path.iterdir()] == ["manifest.csv"]
+
+
+def test_resume_without_key_ranges(tmp_path):
+    # the run died before the journal's header was written
+    scratch_dir = tmp_path / ".manifest.csv.download"
+    scratch_dir.mkdir()
+    (scratch_dir / "journal").write_text("")
+
+    with pytest.raises(RuntimeError, match="rerun without resume"):
+        _download("http://127.0.0.1:1", tmp_path / "manifest.csv", resume=True)
+
+
+@pytest.mark.parametrize("copy_file_range", [True, False])
+def test_append_file(monkeypatch, tmp_path, copy_file_range):
+    if not copy_file_range:
+        monkeypatch.delattr(download_manifest.os, "copy_file_range", raising=False)
+    part = tmp_path / "part.csv"
+    # with the rows of a page cut short at the end
+    part.write_bytes(b"a,b\n" * 100000 + b"c,")
+
+    with open(tmp_path / "manifest.csv", "wb", buffering=0) as outfile:
+        outfile.write(b"header\n")
+        for _ in range(2):
+            with open(part, "rb") as readfile:
+                download_manifest._append_file(readfile, outfile, 400000)
+
+    assert (tmp_path / "manifest.csv").read_bytes() == b"header\n" + b"a,b\n" * 200000
@@ -0,0 +1,119 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from gen3.index import Gen3Index
+from gen3.index_mirror import Gen3IndexMirror
+
+
+def _record(i, rev="r1", authz=None):
+    return {
+        "did": f"dg.TEST/{i:04d}",
+        "rev": rev,
+        "baseid": f"base-{i}",
+        "hashes": {"md5": f"{i % 3:032x}"},
+        "size": i % 2,
+        "authz": authz or ["/programs/DEV"],
+        "updated_date": "2020-01-01T00:00:00",
+    }
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    index = MagicMock()
+    mirror = Gen3IndexMirror(str(tmp_path / "indexd.sqlite"), index)
+    yield mirror
+    mirror.close()
+
+
+def test_sync_writes_only_changes(mirror):
+    records = [_record(i) for i in range(10)]
+    mirror.index.scan_records.return_value = iter(records)
+    assert mirror.sync(num_shards=2) == {
+        "added": 10,
+        "updated": 0,
+        "unchanged": 0,
+        "deleted": 0,
+    }
+    mirror.index.scan_records.assert_called_once_with(num_shards=2, page_size=None)
+    assert len(mirror) == 10
+
+    records = [_record(i) for i in range(1, 10)] + [_record(10)]
+    records[0] = _record(1, rev="r2", authz=["/programs/PROD"])
+    mirror.index.scan_records.return_value = iter(records)
+    assert mirror.sync() == {"added": 1, "updated": 1, "unchanged": 8, "deleted": 1}
+
+    assert mirror.get("dg.TEST/0000") is None
+    assert mirror.get("dg.TEST/0001") == records[0]
+    assert [r["did"] for r in mirror.iter_records()] == [
+        record["did"] for record in records
+    ]
+    last_sync = mirror.last_sync()
+    assert last_sync["updated"] == 1
+    assert last_sync["finished_at"] >= last_sync["started_at"]
+
+
+def test_find(mirror):
+    records = [_record(i) for i in range(6)]
+    records[4]["authz"] = ["/programs/PROD"]
+    mirror.index.scan_records.return_value = iter(records)
+    mirror.sync()
+
+    assert mirror.find(md5=f"{1:032x}") == [records[1], records[4]]
+    assert mirror.find(md5=f"{1:032x}", size=1) == [records[1]]
+    assert mirror.find(authz="/programs/PROD") == [records[4]]
+    assert mirror.find(size=0, authz="/programs/DEV") == [records[0], records[2]]
+    assert len(mirror.find()) == 6
+
+
+def test_interrupted_sync_keeps_records(mirror):
+    mirror.index.scan_records.return_value = iter([_record(i) for i in range(3)])
+    mirror.sync()
+
+    def failing_scan():
+        yield _record(0)
+        raise ConnectionError("indexd went away")
+
+    mirror.index.scan_records.return_value = failing_scan()
+    with pytest.raises(ConnectionError):
+        mirror.sync()
+    assert len(mirror) == 3
+    assert mirror.last_sync()["added"] == 3
+
+
+def test_refresh(mirror):
+    mirror.index.scan_records.return_value = iter([_record(i) for i in range(3)])
+    mirror.sync()
+
+    mirror.index.get_records_in_batches.return_value = iter(
+        [([_record(1, rev="r2"), _record(5)], ["dg.TEST/0002"])]
+    )
+    mirror.refresh(["dg.TEST/0001", "dg.TEST/0002", "dg.TEST/0005"])
+
+    assert mirror.get("dg.TEST/0001")["rev"] == "r2"
+    assert mirror.get("dg.TEST/0002") is None
+    assert mirror.get("dg.TEST/0005") == _record(5)
+    assert len(mirror) == 3
+
+
+def test_sync_needs_index(tmp_path):
+    with Gen3IndexMirror(str(tmp_path / "indexd.sqlite")) as mirror:
+        with pytest.raises(ValueError):
+            mirror.sync()
+
+
+def test_get_guids_by_hash_from_mirror(mirror):
+    mirror.index.scan_records.return_value = iter([_record(i) for i in range(6)])
+    mirror.sync()
+    index = Gen3Index("https://example.com")
+    index.client = MagicMock()
+
+    guids = index.get_guids_by_hash(
+        [(f"{1:032x}", 1), (f"{2:032x}", None), ("f" * 32, 0)], mirror=mirror
+    )
+    assert guids == {
+        (f"{1:032x}", 1): ["dg.TEST/0001"],
+        (f"{2:032x}", None): ["dg.TEST/0002", "dg.TEST/0005"],
+        ("f" * 32, 0): [],
+    }
+    index.client._get.assert_not_called()
@@ -0,0 +1,533 @@
+"""
+Gen3Index tests that don't need an indexd instance: requests are sent to a small
+local aiohttp app or mocked.
+"""
+
+import asyncio
+import time
+import urllib.parse
+import uuid
+from unittest.mock import MagicMock, patch
+
+from aiohttp import web
+import pytest
+
+from gen3.auth import Gen3Auth
+from gen3.index import Gen3Index, _record_changes
+from gen3.records import RecordBatch
+
+RECORD = {
+    "did": "dg.TEST/f2a39f98-6ae1-48a5-8d48-825a0c52a22b",
+    "acl": ["DEV", "test"],
+    "authz": ["/programs/DEV/projects/test"],
+    "hashes": {"md5": "a1234567891234567890123456789012"},
+    "size": 123,
+    "rev": "abc123",
+    "urls": ["s3://testaws/aws/test.txt"],
+    "file_name": None,
+}
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def _serve(loop, routes):
+    """
+    Start a local aiohttp app and return (runner, base url)
+    """
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def _mock_auth(*tokens):
+    auth = Gen3Auth("https://example.com", refresh_token={"api_key": "abc"})
+    responses = []
+    for token in tokens:
+        response = MagicMock()
+        response.json.return_value = {"access_token": token}
+        responses.append(response)
+    return auth, responses
+
+
+def test_async_get_record_sends_bearer_and_retries_401(loop):
+    seen = []
+
+    async def get_record(request):
+        seen.append(request.headers.get("Authorization"))
+        if request.headers.get("Authorization") != "Bearer good":
+            return web.json_response({"error": "expired"}, status=401)
+        return web.json_response(RECORD)
+
+    runner, url = _serve(loop, [web.get("/index/{guid:.*}", get_record)])
+    auth, responses = _mock_auth("expired", "good")
+    index = Gen3Index(url, auth_provider=auth, service_location="")
+    try:
+        with patch("gen3.auth.requests") as mock_requests:
+            mock_requests.post.side_effect = responses
+            record = loop.run_until_complete(index.async_get_record(RECORD["did"]))
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert record == RECORD
+    assert seen == ["Bearer expired", "Bearer good"]
+    assert auth.refresh_stats["issued"] == 2
+
+
+def test_async_get_records_on_page_basic_auth(loop):
+    async def get_page(request):
+        assert request.headers["Authorization"].startswith("Basic ")
+        assert request.query["page"] == "3"
+        return web.json_response({"records": [RECORD]})
+
+    runner, url = _serve(loop, [web.get("/index", get_page)])
+    index = Gen3Index(url, auth_provider=("admin", "admin"), service_location="")
+    try:
+        records = loop.run_until_complete(
+            index.async_get_records_on_page(limit=1, page=3)
+        )
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert records == [RECORD]
+
+
+def test_async_context_manager_reuses_connection(loop):
+    peers = []
+
+    async def get_record(request):
+        peers.append(request.transport.get_extra_info("peername"))
+        return web.json_response(RECORD)
+
+    runner, url = _serve(loop, [web.get("/index/{guid:.*}", get_record)])
+    index = Gen3Index(url, service_location="")
+
+    async def _get_records():
+        async with index:
+            for _ in range(3):
+                await index.async_get_record(RECORD["did"])
+
+    try:
+        loop.run_until_complete(_get_records())
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert len(peers) == 3
+    assert len(set(peers)) == 1
+    assert index._transport._aiohttp_sessions == {}
+
+
+def _paged_get(records):
+    """
+    Fake IndexClient._get serving records with indexd's start/limit cursor
+    """
+    calls = []
+
+    def _get(path, params=None):
+        calls.append(dict(params))
+        start = params.get("start", "")
+        page = [r for r in records if r["did"] > start][: params.get("limit", 100)]
+        response = MagicMock()
+        response.json.return_value = {"records": page}
+        return response
+
+    return _get, calls
+
+
+@pytest.mark.parametrize("dist_resolution", [True, False])
+def test_get_dist_resolution(dist_resolution):
+    index = Gen3Index("https://example.com")
+    with patch.object(index.client, "global_get", return_value=None) as global_get:
+        assert index.get("guid-1", dist_resolution=dist_resolution) is None
+
+    global_get.assert_called_once_with("guid-1", no_dist=not dist_resolution)
+
+
+def test_iter_records_follows_cursor():
+    records = [dict(RECORD, did=f"guid-{i}") for i in range(5)]
+    index = Gen3Index("https://example.com")
+    index.client._get, calls = _paged_get(records)
+
+    assert list(index.iter_records(page_size=2)) == records
+    assert [call.get("start") for call in calls] == [None, "guid-1", "guid-3", "guid-4"]
+
+    pages = list(index.iter_records(page_size=2, start="guid-0", pages=True))
+    assert [len(page) for page in pages] == [2, 2]
+
+
+def test_iter_records_prefetch():
+    records = [dict(RECORD, did=f"guid-{i}") for i in range(5)]
+    index = Gen3Index("https://example.com")
+    index.client._get, calls = _paged_get(records)
+
+    iterator = index.iter_records(page_size=3, prefetch=True)
+    assert next(iterator) == records[0]
+    # the second page is requested while the first is being processed
+    deadline = time.monotonic() + 1
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(calls) == 2
+    assert list(iterator) == records[1:]
+    assert index.get_all_records(limit=3, paginate=True) == records
+
+
+def _uuid_records(count):
+    return sorted(
+        (dict(RECORD, did=f"dg.TEST/{uuid.uuid4()}") for _ in range(count)),
+        key=lambda record: record["did"],
+    )
+
+
+def test_get_shards():
+    index = Gen3Index("https://example.com")
+    index.client._get, _ = _paged_get(_uuid_records(1))
+
+    shards = index.get_shards(4)
+    assert shards == [
+        (None, "dg.TEST/4000"),
+        ("dg.TEST/4000", "dg.TEST/8000"),
+        ("dg.TEST/8000", "dg.TEST/c000"),
+        ("dg.TEST/c000", None),
+    ]
+
+
+def test_scan_records_yields_each_record_once():
+    records = _uuid_records(200)
+    index = Gen3Index("https://example.com")
+    index.client._get, _ = _paged_get(records)
+
+    assert list(index.scan_records(num_shards=5, page_size=7, ordered=True)) == records
+
+    scanned = list(index.scan_records(num_shards=5, page_size=7))
+    assert len(scanned) == len(records)
+    assert sorted(record["did"] for record in scanned) == [
+        record["did"] for record in records
+    ]
+
+    # a shard boundary that is itself a did stays in the lower shard
+    boundary = records[50]["did"]
+    shards = [(None, boundary), (boundary, None)]
+    assert list(index.scan_records(shards=shards, ordered=True)) == records
+
+
+def test_bulk_get_records_batches_and_reports_missing():
+    records = {f"guid-{i}": dict(RECORD, did=f"guid-{i}") for i in range(10)}
+    batches = []
+
+    def _post(path, json=None, **kwargs):
+        batches.append(json)
+        response = MagicMock()
+        # indexd doesn't return records in request order
+        response.json.return_value = [
+            records[d] for d in reversed(json) if d in records
+        ]
+        return response
+
+    index = Gen3Index("https://example.com")
+    index.client._post = _post
+    dids = (f"guid-{i}" for i in [3, 1, 42, 7, 0, 99, 5])
+
+    found, missing = index.bulk_get_records(dids, batch_size=3, max_workers=2)
+
+    assert [record["did"] for record in found] == [f"guid-{i}" for i in [3, 1, 7, 0, 5]]
+    assert missing == ["guid-42", "guid-99"]
+    assert sorted(len(batch) for batch in batches) == [1, 3, 3]
+
+    unordered = list(
+        index.get_records_in_batches(["guid-1", "guid-2"], batch_size=1, ordered=False)
+    )
+    assert sorted(r[0][0]["did"] for r in unordered) == ["guid-1", "guid-2"]
+
+    found, missing = index.bulk_get_records(["guid-1", "guid-42"], compact=True)
+    assert isinstance(found, RecordBatch)
+    assert found.to_dicts() == [records["guid-1"]] and missing == ["guid-42"]
+
+
+def test_async_bulk_get_records(loop):
+    requests_seen = []
+
+    async def bulk_documents(request):
+        dids = await request.json()
+        requests_seen.append(dids)
+        if dids == ["missing"]:
+            return web.json_response({"error": "no record found"}, status=404)
+        return web.json_response([dict(RECORD, did=did) for did in reversed(dids)])
+
+    runner, url = _serve(loop, [web.post("/bulk/documents", bulk_documents)])
+    index = Gen3Index(url, service_location="")
+    try:
+        found, missing = loop.run_until_complete(
+            index.async_bulk_get_records(["a", "b", "c", "missing"], batch_size=3)
+        )
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert [record["did"] for record in found] == ["a", "b", "c"]
+    assert missing == ["missing"]
+    assert len(requests_seen) == 2
+
+
+def test_bulk_upsert(loop):
+    indexed = {
+        f"guid-{i}": dict(RECORD, did=f"guid-{i}", rev="r1", baseid=f"base-{i}")
+        for i in range(4)
+    }
+    # guid-3 was changed by someone else since it was fetched
+    stale = {"guid-3"}
+    writes = []
+
+    async def bulk_documents(request):
+        dids = await request.json()
+        return web.json_response([indexed[d] for d in dids if d in indexed])
+
+    async def create(request):
+        record = await request.json()
+        writes.append(("POST", record.get("did")))
+        did = record.get("did") or f"new-{len(writes)}"
+        indexed[did] = dict(record, did=did, rev="r1")
+        return web.json_response({"did": did, "rev": "r1", "baseid": "base"})
+
+    async def get_record(request):
+        return web.json_response(indexed[request.match_info["guid"]])
+
+    async def update(request):
+        did = request.match_info["guid"]
+        writes.append(("PUT", did))
+        if did in stale:
+            stale.remove(did)
+            indexed[did] = dict(indexed[did], rev="r2")
+        if request.query["rev"] != indexed[did]["rev"]:
+            return web.json_response({"error": "revision mismatch"}, status=409)
+        indexed[did].update(await request.json())
+        return web.json_response({"did": did, "rev": "r3"})
+
+    routes = [
+        web.post("/bulk/documents", bulk_documents),
+        web.post("/index/", create),
+        web.get("/index/{guid}", get_record),
+        web.put("/index/{guid}", update),
+    ]
+    runner, url = _serve(loop, routes)
+    index = Gen3Index(url, service_location="")
+    records = [
+        # same urls in another order
+        {"did": "guid-0", "urls": list(reversed(RECORD["urls"])), "size": 123},
+        {"did": "guid-1", "file_name": "renamed.txt"},
+        {"did": "guid-2", "size": 1},
+        {"did": "guid-3", "acl": ["PROD"]},
+        {"did": "guid-4", "hashes": RECORD["hashes"], "size": 1},
+        {"hashes": RECORD["hashes"], "size": 2},
+    ]
+    try:
+        results = loop.run_until_complete(
+            loop.run_in_executor(None, index.bulk_upsert, records, 4, 2)
+        )
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert [(r["did"], r["result"]) for r in results] == [
+        ("guid-0", "unchanged"),
+        ("guid-1", "updated"),
+        ("guid-2", "failed"),
+        ("guid-3", "updated"),
+        ("guid-4", "created"),
+        (results[5]["did"], "created"),
+    ]
+    assert "size" in results[2]["error"]
+    assert indexed["guid-1"]["file_name"] == "renamed.txt"
+    assert indexed["guid-3"]["acl"] == ["PROD"]
+    assert sorted(writes, key=str) == sorted(
+        [
+            ("PUT", "guid-1"),
+            ("PUT", "guid-3"),
+            ("PUT", "guid-3"),
+            ("POST", "guid-4"),
+            ("POST", None),
+        ],
+        key=str,
+    )
+
+
+def test_record_changes_compares_lists_of_dicts():
+    existing = dict(RECORD, metadata={"parts": [{"n": 1, "md5": "a"}, {"n": 2}]})
+
+    record = {"metadata": {"parts": [{"n": 2}, {"md5": "a", "n": 1}]}}
+    assert _record_changes(existing, record) == {}
+
+    record = {"metadata": {"parts": [{"n": 2}, {"n": 1, "md5": "b"}]}}
+    assert _record_changes(existing, record) == record
+
+
+def test_writes_without_refetch():
+    index = Gen3Index("https://example.com", refetch=False)
+    index.client = MagicMock()
+    written = {"did": RECORD["did"], "rev": "def456", "baseid": "base"}
+    index.client._post.return_value.json.return_value = written
+    index.client._put.return_value.json.return_value = written
+
+    record = index.create_new_version(
+        "guid", RECORD["hashes"], RECORD["size"], urls=RECORD["urls"]
+    )
+    assert record["rev"] == "def456"
+    assert record["urls"] == RECORD["urls"]
+
+    record = index.update_blank(RECORD["did"], "abc123", RECORD["hashes"], 123)
+    assert record == dict(written, hashes=RECORD["hashes"], size=123)
+
+    # with the rev of the record, updating it is a single request
+    record = index.update_record(RECORD["did"], file_name="a.txt", rev="abc123")
+    assert record == dict(written, file_name="a.txt")
+    assert index.client._put.call_args.kwargs["params"] == {"rev": "abc123"}
+    index.client.get.assert_not_called()
+    index.client._get.assert_not_called()
+
+    # otherwise the record is fetched for its rev
+    index.client.get.return_value.to_json.return_value = dict(RECORD)
+    record = index.update_record(RECORD["did"], acl=["PROD"])
+    assert record == dict(RECORD, acl=["PROD"], **written)
+    assert index.client._put.call_args.kwargs["data"] == '{"acl": ["PROD"]}'
+
+    # refetching per call
+    index.client.get.return_value.to_json.return_value = dict(RECORD, rev="def456")
+    record = index.create_blank("uploader", refetch=True)
+    assert record == dict(RECORD, rev="def456")
+
+
+def test_get_guids_by_hash(tmp_path):
+    records = _uuid_records(10)
+    for i, record in enumerate(records):
+        record.update(hashes={"md5": f"{i % 3:032x}"}, size=i % 2)
+    queries = []
+
+    def _get(path, params=None, **kwargs):
+        queries.append(dict(params))
+        matches = [
+            r
+            for r in records
+            if r["hashes"]["md5"] == params["hash"].split(":")[1]
+            and ("size" not in params or r["size"] == params["size"])
+            and r["did"] > params.get("start", "")
+        ]
+        response = MagicMock()
+        response.json.return_value = {"records": matches[:2]}
+        return response
+
+    index = Gen3Index("https://example.com")
+    index.client._get = _get
+    files = [(f"{0:032x}", 0), (f"{1:032x}", None), (f"{0:032x}", 0), ("f" * 32, 1)]
+    with patch("gen3.index.HASH_LOOKUP_PAGE_SIZE", 2):
+        guids = index.get_guids_by_hash(files, max_workers=2)
+
+    assert guids == {
+        (f"{0:032x}", 0): [records[i]["did"] for i in [0, 6]],
+        (f"{1:032x}", None): [records[i]["did"] for i in [1, 4, 7]],
+        ("f" * 32, 1): [],
+    }
+    # one lookup per distinct pair, plus one per extra page
+    assert len(queries) == 5
+
+
+def test_diff_records():
+    snapshot = _uuid_records(10)
+    for i, record in enumerate(snapshot):
+        record.update(rev=f"r{i}")
+    records = [dict(record) for record in snapshot]
+    del records[0], records[5]
+    records[1].update(rev="new", authz=["/programs/PROD"], urls=["s3://b/c"])
+    # a new rev without changes to the compared fields
+    records[2].update(rev="new", updated_date="2021-01-01")
+    added = [dict(RECORD, did=f"dg.TEST/{uuid.uuid4()}") for _ in range(2)]
+    records = sorted(records + added, key=lambda record: record["did"])
+
+    index = Gen3Index("https://example.com")
+    index.client._get, _ = _paged_get(records)
+    changes = list(index.diff_records(iter(snapshot), num_shards=3, page_size=2))
+
+    assert sorted((c.change, c.did) for c in changes) == sorted(
+        [("removed", snapshot[0]["did"]), ("removed", snapshot[6]["did"])]
+        + [("modified", snapshot[2]["did"])]
+        + [("added", record["did"]) for record in added]
+    )
+    assert [c.did for c in changes] == sorted(c.did for c in changes)
+    modified = next(c for c in changes if c.change == "modified")
+    assert modified.fields == ("urls", "authz")
+    assert modified.old == snapshot[2] and modified.new["rev"] == "new"
+
+    with pytest.raises(ValueError):
+        list(index.diff_records(reversed(snapshot)))
+
+
+def test_get_urls_splits_long_guid_lists():
+    guids = [f"dg.TEST/{uuid.UUID(int=i)}" for i in range(200)]
+    requests = []
+
+    def _get(path, params=None, **kwargs):
+        requests.append(dict(params))
+        start, limit = params["start"], params["limit"]
+        urls = [
+            {"url": f"s3://bucket/{guid}", "metadata": {}}
+            for guid in params["ids"].split(",")
+        ]
+        response = MagicMock()
+        response.json.return_value = {
+            "urls": urls[start : start + limit],
+            "limit": limit,
+            "start": start,
+            "size": params["size"],
+            "hashes": [],
+        }
+        return response
+
+    index = Gen3Index("https://example.com")
+    index.client._get = _get
+    with patch("gen3.index.MAX_URL_LENGTH", 1000):
+        urls = index.get_urls(guids=guids, size=10, max_workers=4)
+
+    assert sorted(urls) == sorted(f"s3://bucket/{guid}" for guid in guids)
+    assert len(requests) > 1
+    for params in requests:
+        assert params["size"] == 10
+        url = index.client.url_for("urls") + "?" + urllib.parse.urlencode(params)
+        assert len(url) <= 1000
+
+    requests.clear()
+    with patch("gen3.index.URLS_PAGE_SIZE", 2):
+        urls = index.get_urls(guids=guids[:5])
+    assert urls == [f"s3://bucket/{guid}" for guid in guids[:5]]
+    ids = ",".join(guids[:5])
+    assert requests == [
+        {"size": None, "hash": None, "ids": ids, "limit": 2, "start": start}
+        for start in (0, 2, 4)
+    ]
+
+
+def test_iter_urls():
+    records = {f"guid-{i}": dict(RECORD, did=f"guid-{i}") for i in range(5)}
+    records["guid-2"]["urls"] = ["s3://a/2", "gs://a/2"]
+    records["guid-3"]["urls"] = []
+
+    def _post(path, json=None, **kwargs):
+        response = MagicMock()
+        response.json.return_value = [records[d] for d in json if d in records]
+        return response
+
+    index = Gen3Index("https://example.com")
+    index.client._post = _post
+    guids = (f"guid-{i}" for i in [2, 42, 3, 1])
+
+    assert list(index.iter_urls(guids, batch_size=2)) == [
+        ("guid-2", ["s3://a/2", "gs://a/2"]),
+        ("guid-42", None),
+        ("guid-3", []),
+        ("guid-1", RECORD["urls"]),
+    ]
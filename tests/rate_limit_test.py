@@ -0,0 +1,78 @@
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from gen3.rate_limit import RateLimiter
+from gen3.transport import Gen3Transport
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def _elapsed(func, calls):
+    start = time.monotonic()
+    for _ in range(calls):
+        func()
+    return time.monotonic() - start
+
+
+def test_rate_spaces_requests():
+    limiter = RateLimiter(50)
+    # the first request goes through immediately, the other 10 wait 20ms each
+    assert 0.18 <= _elapsed(limiter.acquire, 11) < 0.5
+
+
+def test_burst_goes_through_at_once():
+    limiter = RateLimiter(10, burst=5)
+    assert _elapsed(limiter.acquire, 5) < 0.05
+    assert _elapsed(limiter.acquire, 1) >= 0.08
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+
+
+def test_state_file_is_shared(tmp_path):
+    state_file = str(tmp_path / "rate")
+    first = RateLimiter(20, state_file=state_file)
+    second = RateLimiter(20, state_file=state_file)
+
+    def _acquire_both():
+        first.acquire()
+        second.acquire()
+
+    # 10 requests at 20 per second between the two limiters
+    assert 0.4 <= _elapsed(_acquire_both, 5) < 0.8
+
+
+def test_async_acquire(loop):
+    limiter = RateLimiter(50)
+
+    async def _acquire_all():
+        await asyncio.gather(*(limiter.async_acquire() for _ in range(11)))
+
+    start = time.monotonic()
+    loop.run_until_complete(_acquire_all())
+    assert 0.18 <= time.monotonic() - start < 0.5
+
+
+def test_transport_waits_on_limiter():
+    limiter = RateLimiter(1000)
+    transport = Gen3Transport(rate_limiter=limiter)
+    with patch.object(limiter, "acquire") as acquire, patch.object(
+        transport.session, "request", return_value=MagicMock(status_code=200)
+    ) as request:
+        transport.get("https://example.com/index/_status")
+
+    acquire.assert_called_once_with()
+    request.assert_called_once_with(
+        "GET", "https://example.com/index/_status", timeout=transport.timeout
+    )
@@ -0,0 +1,127 @@
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from gen3.index import Gen3Index
+from gen3.record_cache import RecordCache
+
+V1 = {"did": "guid-1", "baseid": "base", "rev": "r1", "size": 1}
+V2 = {"did": "guid-2", "baseid": "base", "rev": "r1", "size": 2}
+OTHER = {"did": "guid-3", "baseid": "other", "rev": "r1", "size": 3}
+
+
+def _document(record):
+    document = MagicMock(**record)
+    document.to_json.return_value = dict(record)
+    return document
+
+
+def test_hits_misses_and_copies():
+    cache = RecordCache()
+    assert cache.get(("get_record", "guid-1")) is None
+    cache.put(("get_record", "guid-1"), V1)
+
+    record = cache.get(("get_record", "guid-1"))
+    assert record == V1
+    record["size"] = 100
+    assert cache.get(("get_record", "guid-1")) == V1
+    # rev checks aren't lookups
+    assert cache.rev("guid-1") == "r1"
+    assert cache.rev("guid-2") is None
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 1,
+        "hit_rate": 2 / 3,
+        "evictions": 0,
+        "size": 1,
+    }
+
+
+def test_ttl_and_lru_bounds():
+    cache = RecordCache(max_size=2, ttl=0.05)
+    cache.put(("get_record", "guid-1"), V1)
+    cache.put(("get_record", "guid-2"), V2)
+    cache.get(("get_record", "guid-1"))
+    # guid-2 is the least recently used
+    cache.put(("get_record", "guid-3"), OTHER)
+    assert cache.get(("get_record", "guid-2")) is None
+    assert cache.get(("get_record", "guid-1")) == V1
+    assert cache.stats()["evictions"] == 1
+
+    time.sleep(0.06)
+    assert cache.get(("get_record", "guid-1")) is None
+    assert cache.get(("get_record", "guid-3")) is None
+    assert len(cache) == 0
+
+    with pytest.raises(ValueError):
+        RecordCache(max_size=0)
+
+
+def test_invalidate_drops_every_version():
+    cache = RecordCache()
+    cache.put(("get_record", "guid-1"), V1)
+    cache.put(("get_latest_version", "guid-1", False), V2)
+    cache.put(("get", "alias"), OTHER)
+    cache.put(("get_record", "guid-3"), OTHER)
+
+    cache.invalidate("guid-1")
+    assert cache.get(("get_record", "guid-1")) is None
+    assert cache.get(("get_latest_version", "guid-1", False)) is None
+    assert cache.get(("get", "alias")) == OTHER
+
+    # records looked up by an alias are dropped by their did
+    cache.invalidate("guid-3")
+    assert len(cache) == 0
+
+
+def test_index_lookups_use_cache():
+    index = Gen3Index(
+        "https://example.com", service_location="", record_cache=RecordCache()
+    )
+    index.client = MagicMock()
+    index.client.get.return_value = _document(V1)
+    index.client.get_latest_version.return_value = _document(V2)
+
+    for _ in range(3):
+        assert index.get_record("guid-1") == V1
+        assert index.get_latest_version("guid-1") == V2
+    assert index.client.get.call_count == 1
+    assert index.client.get_latest_version.call_count == 1
+    assert index.record_cache.stats()["hits"] == 4
+
+    # records that were not found are looked up again
+    index.client.get.return_value = None
+    assert index.get_record("missing") is None
+    assert index.get_record("missing") is None
+    assert index.client.get.call_count == 3
+
+
+def test_index_writes_invalidate_cache():
+    index = Gen3Index(
+        "https://example.com", service_location="", record_cache=RecordCache()
+    )
+    index.client = MagicMock()
+    index.client.get.return_value = _document(V1)
+    index.client.get_latest_version.return_value = _document(V1)
+    index.get_record("guid-1")
+    index.get_latest_version("guid-1")
+
+    index.client._post.return_value.json.return_value = {
+        "did": "guid-2",
+        "baseid": "base",
+        "rev": "r1",
+    }
+    index.client.get.return_value = _document(V2)
+    index.client.get_latest_version.return_value = _document(V2)
+    assert index.create_new_version("guid-1", {"md5": "abc"}, 2) == V2
+    assert index.get_latest_version("guid-1") == V2
+
+    updated = dict(V2, rev="r2")
+    index.client.get.return_value = _document(updated)
+    index.update_record("guid-2", file_name="b.txt")
+    assert index.get_record("guid-2") == updated
+
+    index.delete_record("guid-2")
+    index.client.get.return_value = None
+    assert index.get_record("guid-2") is None
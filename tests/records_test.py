@@ -0,0 +1,79 @@
+import json
+import tracemalloc
+import uuid
+
+import pytest
+
+from gen3.records import RecordBatch
+
+
+def _record(i):
+    url = f"s3://bucket/project/{uuid.UUID(int=i)}/file_{i}.bam"
+    return {
+        "did": f"dg.TEST/{uuid.uuid4()}",
+        "baseid": str(uuid.uuid4()),
+        "rev": uuid.uuid4().hex[:8],
+        "form": "object",
+        "size": i * 1000,
+        "hashes": {"md5": uuid.uuid4().hex},
+        "file_name": f"file_{i}.bam",
+        "version": None,
+        "uploader": None,
+        "urls": [url],
+        "acl": ["*"],
+        "authz": [f"/programs/DEV/projects/P{i % 20}"],
+        "metadata": {},
+        "urls_metadata": {url: {}},
+        "created_date": "2020-05-14T20:31:02.123456",
+        "updated_date": f"2021-05-14T20:31:{i % 60:02d}",
+        "description": None,
+        "content_created_date": None,
+        "content_updated_date": None,
+    }
+
+
+def test_records_come_back_unchanged():
+    records = [_record(i) for i in range(5)]
+    records[1].update(
+        did="not-a-uuid",
+        hashes={"md5": "A" * 32, "sha256": "b" * 64},
+        size=None,
+        updated_date="2021-05-14",
+        urls_metadata={records[1]["urls"][0]: {"state": "validated"}},
+    )
+    del records[2]["baseid"], records[2]["description"]
+    records[3].update(urls=[], urls_metadata={}, metadata={"a": [1, {"b": 2}]})
+    records[4].update(acl=["*", 1], authz=[], version="2", created_date=None)
+
+    batch = RecordBatch(records)
+    assert len(batch) == 5
+    assert batch.to_dicts() == records
+    assert batch[-1] == records[4]
+    assert batch[1:3] == records[1:3]
+    assert "baseid" not in batch[2]
+    with pytest.raises(IndexError):
+        batch[5]
+
+    assert batch.column("did") == [record["did"] for record in records]
+    assert batch.column("baseid")[2] is None
+    assert batch.column("description") == [None] * 5
+
+    # records read from the batch are copies
+    batch[3]["metadata"]["a"].append(3)
+    assert batch[3] == records[3]
+
+
+def test_takes_much_less_memory():
+    text = json.dumps([_record(i) for i in range(5000)])
+
+    tracemalloc.start()
+    try:
+        records = json.loads(text)
+        as_dicts = tracemalloc.get_traced_memory()[0]
+        batch = RecordBatch(records)
+        as_batch = tracemalloc.get_traced_memory()[0] - as_dicts
+    finally:
+        tracemalloc.stop()
+
+    assert as_dicts / as_batch > 5
+    assert batch.to_dicts() == records
@@ -0,0 +1,211 @@
+import asyncio
+import email.utils
+import io
+import time
+from unittest.mock import MagicMock
+
+import aiohttp
+from aiohttp import web
+import pytest
+import requests
+
+from gen3.index import AsyncGen3Index, Gen3Index
+from gen3.retry import RetryPolicy, parse_retry_after
+from gen3.transport import Gen3Transport
+
+FAST = RetryPolicy(max_tries=4, base_delay=0.001, max_delay=0.01)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def _response(status, retry_after=None):
+    response = requests.Response()
+    response.status_code = status
+    response.raw = io.BytesIO(b"")
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return response
+
+
+def _sender(*outcomes):
+    """
+    Return a send function giving the outcomes in order and the list of calls
+    """
+    calls = []
+    outcomes = list(outcomes)
+
+    def send():
+        calls.append(time.monotonic())
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return send, calls
+
+
+def test_should_retry():
+    policy = RetryPolicy()
+    assert policy.should_retry("GET", status=503)
+    assert policy.should_retry("PUT", status=500)
+    assert not policy.should_retry("GET", status=404)
+    assert not policy.should_retry("POST", status=503)
+    assert policy.should_retry("POST", status=503, idempotent=True)
+    assert policy.should_retry("POST", status=429)
+
+    assert policy.should_retry("GET", exc=requests.ConnectionError())
+    assert not policy.should_retry("POST", exc=requests.ReadTimeout())
+    assert policy.should_retry("POST", exc=requests.ConnectTimeout())
+    assert not policy.should_retry("GET", exc=ValueError())
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after("soon") is None
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < parse_retry_after(date) <= 30
+
+
+def test_retries_until_success():
+    send, calls = _sender(_response(503), requests.ConnectionError(), _response(200))
+    response = FAST.call(send, "GET")
+    assert response.status_code == 200
+    assert len(calls) == 3
+
+
+def test_gives_up_after_max_tries():
+    send, calls = _sender(*[_response(502)] * 4)
+    assert FAST.call(send, "GET").status_code == 502
+    assert len(calls) == 4
+
+    send, calls = _sender(*[requests.ConnectionError()] * 4)
+    with pytest.raises(requests.ConnectionError):
+        FAST.call(send, "GET")
+    assert len(calls) == 4
+
+
+def test_post_is_not_retried_unless_safe():
+    send, calls = _sender(_response(503))
+    assert FAST.call(send, "POST").status_code == 503
+    assert len(calls) == 1
+
+    send, calls = _sender(_response(429), _response(201))
+    assert FAST.call(send, "POST").status_code == 201
+    assert len(calls) == 2
+
+
+def test_honors_retry_after():
+    policy = RetryPolicy(max_tries=2, base_delay=0.001)
+    send, calls = _sender(_response(429, retry_after="0.2"), _response(200))
+    policy.call(send, "GET")
+    assert calls[1] - calls[0] >= 0.2
+
+    # waiting longer than max_delay is not worth it
+    send, calls = _sender(_response(503, retry_after="120"))
+    assert policy.call(send, "GET").status_code == 503
+    assert len(calls) == 1
+
+
+def test_deadline():
+    policy = RetryPolicy(max_tries=100, base_delay=0.05, max_delay=0.05, deadline=0.2)
+    send, calls = _sender(*[_response(503)] * 100)
+    start = time.monotonic()
+    policy.call(send, "GET")
+    assert time.monotonic() - start <= 0.25
+    assert 2 <= len(calls) < 10
+
+
+def test_transport_retries_idempotent_post():
+    transport = Gen3Transport(retry_policy=FAST)
+    transport.session = MagicMock()
+    transport.session.request.side_effect = [_response(503), _response(200)]
+    response = transport.post("https://example.com/graphql", idempotent=True)
+    assert response.status_code == 200
+    assert transport.session.request.call_count == 2
+
+
+def test_async_get_record_retries(loop):
+    statuses = [503, 200]
+
+    async def get_record(request):
+        status = statuses.pop(0)
+        return web.json_response({"did": "guid"}, status=status)
+
+    app = web.Application()
+    app.add_routes([web.get("/index/{guid}", get_record)])
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+
+    index = Gen3Index(
+        f"http://127.0.0.1:{port}",
+        service_location="",
+        transport=Gen3Transport(retry_policy=FAST),
+    )
+    try:
+        record = loop.run_until_complete(index.async_get_record("guid"))
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert record == {"did": "guid"}
+    assert statuses == []
+
+
+def test_rev_guarded_writes_are_not_retried():
+    transport = Gen3Transport(retry_policy=FAST)
+    transport.session = MagicMock()
+    index = Gen3Index("https://example.com", transport=transport)
+
+    # the write may have landed, sent again it would get a 409
+    transport.session.request.side_effect = [_response(503), _response(200)]
+    with pytest.raises(requests.HTTPError):
+        index.client._put("index", "guid", params={"rev": "r1"}, data="{}")
+    transport.session.request.side_effect = [_response(503), _response(200)]
+    with pytest.raises(requests.HTTPError):
+        index.client._delete("index", "guid", params={"rev": "r1"})
+    assert transport.session.request.call_count == 2
+
+    # a 429 is rejected before the write is processed
+    transport.session.request.reset_mock()
+    transport.session.request.side_effect = [_response(429), _response(200)]
+    index.client._put("index", "guid", params={"rev": "r1"}, data="{}")
+    assert transport.session.request.call_count == 2
+
+
+def test_async_rev_guarded_writes_are_not_retried(loop):
+    statuses = [503, 200]
+
+    async def update(request):
+        return web.json_response({"did": "guid", "rev": "r2"}, status=statuses.pop(0))
+
+    app = web.Application()
+    app.add_routes([web.put("/index/{guid}", update)])
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+
+    index = AsyncGen3Index(
+        f"http://127.0.0.1:{port}",
+        service_location="",
+        transport=Gen3Transport(retry_policy=FAST),
+    )
+    try:
+        with pytest.raises(aiohttp.ClientResponseError):
+            loop.run_until_complete(
+                index.update_record("guid", file_name="a", rev="r1", refetch=False)
+            )
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+    assert statuses == [200]
@@ -10,7 +10,7 @@ def test_get(sub):
         get_dictionary_all
 
     """
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.get().text = '{ "key": "value" }'
         assert sub.get_programs()
@@ -30,7 +30,7 @@ def test_exportnode(sub):
         export_node
 
     """
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.get().text = '{ "key": "value" }'
         resp = sub.export_node("DEV", "test", "experiment", "json", "node_file.json")
@@ -41,7 +41,7 @@ def test_exportnode(sub):
 
 def test_create_program(sub):
 
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         p = sub.create_program(
@@ -56,7 +56,7 @@ def test_create_program(sub):
 
 def test_delete_program(sub):
 
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         sub.delete_program("programmjm")
@@ -64,7 +64,7 @@ def test_delete_program(sub):
 
 def test_create_project(sub):
 
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         pj = sub.create_project(
@@ -83,21 +83,21 @@ def test_create_project(sub):
 
 def test_delete_project(sub):
 
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         dpj = sub.delete_project("programmjm", "projectmjm")
 
 
 def test_open_project(sub):
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         assert sub.open_project("programmjm", "projectmjm")
 
 
 def test_submit_record(sub):
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         rec = sub.submit_record(
@@ -113,7 +113,7 @@ def test_submit_record(sub):
 
 
 def test_export_record(sub):
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.get().text = '{ "key": "value" }'
         sub.export_record("prog1", "proj1", "id", "json", "record_file.json")
@@ -123,14 +123,14 @@ def test_export_record(sub):
 
 
 def test_delete_record(sub):
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.json.return_value = '{ "key": "value" }'
         sub.delete_record("prog1", "proj1", "id")
 
 
 def test_query(sub):
-    with patch("gen3.submission.requests") as mock_request:
+    with patch.object(sub, "_transport") as mock_request:
         mock_request.status_code = 200
         mock_request.post().text = '{ "key": "value" }'
         res = sub.query("{ experiment { submitter_id } }")
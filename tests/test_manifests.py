@@ -6,14 +6,20 @@ import shutil
 import logging
 from unittest.mock import MagicMock, patch
 
+from aiohttp import web
+
+from gen3.concurrency import AdaptiveConcurrencyLimiter
+from gen3.index import Gen3Index
+from gen3.retry import RetryPolicy
 from gen3.tools.indexing import async_verify_object_manifest
 from gen3.tools.indexing import download_manifest
-from gen3.tools.indexing.download_manifest import TMP_FOLDER
 from gen3.tools.indexing import async_download_object_manifest
 from gen3.tools.indexing.index_manifest import (
     index_object_manifest,
     _get_and_verify_fileinfos_from_tsv_manifest,
 )
+from gen3.tools.indexing.verify_manifest import _get_record_from_indexd
+from gen3.transport import Gen3Transport
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -80,6 +86,47 @@ def test_verify_manifest(mock_index):
     assert "no_record" in logs["dg.TEST/9c205cd7-c399-4503-9f49-5647188bde66"]
 
 
+def test_verify_manifest_backs_off_when_indexd_is_overloaded():
+    """
+    Test that 429 responses lower the concurrency limit of verify manifest's
+    requests, and that the record is requested again.
+    """
+    record = {"did": "dg.TEST/1", "urls": []}
+    statuses = [429, 429]
+
+    async def get_record(request):
+        if statuses:
+            return web.json_response({"error": "slow down"}, status=statuses.pop())
+        return web.json_response(record)
+
+    async def verify():
+        app = web.Application()
+        app.add_routes([web.get("/index/{guid:.*}", get_record)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        index = Gen3Index(
+            url,
+            service_location="",
+            transport=Gen3Transport(retry_policy=RetryPolicy(max_tries=1)),
+        )
+        lock = AdaptiveConcurrencyLimiter(initial_limit=8)
+        try:
+            return await _get_record_from_indexd("dg.TEST/1", url, lock, index), lock
+        finally:
+            await runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    actual_record, lock = loop.run_until_complete(verify())
+
+    assert actual_record == record
+    assert lock.limit < 8
+    assert lock.stats["overloads"] == 2
+
+
 def test_download_manifest(monkeypatch, gen3_index):
     """
     Test that dowload manifest generates a file with expected content.
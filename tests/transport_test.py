@@ -0,0 +1,81 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from gen3.file import Gen3File
+from gen3.index import Gen3Index
+from gen3.submission import Gen3Submission
+from gen3.transport import Gen3Transport
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def test_request_uses_pooled_session_and_default_timeout():
+    transport = Gen3Transport(max_connections_per_host=5, timeout=12)
+    adapter = transport.session.get_adapter("https://example.com")
+    assert adapter._pool_maxsize == 5
+
+    with patch.object(
+        transport.session, "request", return_value=MagicMock(status_code=200)
+    ) as mock_request:
+        transport.get("https://example.com/a")
+        transport.post("https://example.com/b", json={}, timeout=3)
+
+    assert mock_request.call_args_list[0][1]["timeout"] == 12
+    assert mock_request.call_args_list[1][1]["timeout"] == 3
+
+
+def test_aiohttp_session_reused_while_open(loop):
+    transport = Gen3Transport()
+
+    async def _sessions():
+        async with transport.aiohttp_session() as first:
+            pass
+        async with transport:
+            async with transport.aiohttp_session() as second:
+                pass
+            async with transport.aiohttp_session() as third:
+                pass
+        return first, second, third
+
+    first, second, third = loop.run_until_complete(_sessions())
+    assert first.closed
+    assert second is third
+    assert second.closed
+    assert transport._aiohttp_sessions == {}
+
+
+def test_index_client_requests_go_through_transport():
+    transport = Gen3Transport()
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"fileCount": 3}
+    index = Gen3Index("https://example.com", transport=transport)
+    with patch.object(transport, "request", return_value=response) as mock_request:
+        assert index.get_stats() == {"fileCount": 3}
+
+    mock_request.assert_called_once_with("GET", "https://example.com/index/_stats")
+
+
+def test_submission_and_file_wait_without_timeout_by_default():
+    transport = Gen3Transport(timeout=12)
+    response = MagicMock(status_code=200, text='{"data": {}, "url": "u"}')
+    with patch.object(
+        transport.session, "request", return_value=response
+    ) as mock_request:
+        Gen3Submission("https://example.com", None, transport=transport).query("{}")
+        Gen3File("https://example.com", None, transport=transport).get_presigned_url(
+            "guid"
+        )
+        Gen3Submission(
+            "https://example.com", None, transport=transport, timeout=30
+        ).get_programs()
+
+    timeouts = [call[1]["timeout"] for call in mock_request.call_args_list]
+    assert timeouts == [None, None, 30]